@@ -0,0 +1,305 @@
+"""
+Replay multi-turn conversations against a model of Anthropic's prompt cache.
+
+Every user turn is turned into a request payload by function.py itself
+(_process_messages + _prepare_payload, so the real breakpoint planner is
+exercised) and run through an offline cache with the API's semantics:
+
+- the prefix is tools -> system -> messages, hashed block by block
+- each cache_control breakpoint checks for an entry at its own block and
+  up to 20 blocks back, and the longest hit is read
+- entries are written at every breakpoint past the hit, but only for
+  prefixes of at least 1024 tokens
+- entries live 5 minutes or 1 hour (``ttl`` on the marker) and every read
+  refreshes them
+
+CACHE_TTL "auto" runs on the simulated clock, and its predicted tail hit
+rate is reported next to the simulated one.
+
+For each caching strategy it reports cache read / write tokens, input cost
+and an estimated time to first token. Nothing is sent to the API.
+
+Conversations are either synthetic (a mix of fast and slow repliers, some
+with a pasted document) or an OpenWebUI chat export (Settings -> Chats ->
+Export), whose message timestamps give the gaps between turns.
+
+Usage (needs the same environment as function.py, i.e. open_webui installed):
+
+    python benchmarks/cache_simulator.py [chat-export.json] [--system prompt.txt]
+"""
+
+import argparse
+import importlib.util
+import json
+import random
+import statistics
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Sonnet 4.5, $ per million input tokens
+PRICE_INPUT = 3.00
+PRICE_CACHE_READ = 0.30
+PRICE_CACHE_WRITE = {300: 3.75, 3600: 6.00}
+
+# Time to first token: fixed overhead plus prefill per uncached token and
+# per cached token (fits the published ~11.5s -> ~2.4s for a 100k prompt)
+TTFT_BASE = 0.5
+TTFT_UNCACHED = 0.11e-3
+TTFT_CACHED = 0.02e-3
+
+MIN_CACHEABLE_TOKENS = 1024
+LOOKBACK_BLOCKS = 20
+TTL_SECONDS = {None: 300, "5m": 300, "1h": 3600}
+
+
+def load_pipe_module():
+    path = Path(__file__).resolve().parent.parent / "function.py"
+    spec = importlib.util.spec_from_file_location("function", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ==================== CONVERSATIONS ====================
+
+
+def synthetic_conversations(count: int = 40, seed: int = 7) -> List[Dict[str, Any]]:
+    """
+    Chats sharing one system prompt: a quarter each reply within a minute,
+    every few minutes, after 10-30 minutes and after a few hours; one in
+    three starts with a ~20k-token document.
+    """
+    rng = random.Random(seed)
+    conversations = []
+    for c in range(count):
+        pace = c % 4
+        start = rng.uniform(0, 4 * 3600)
+        turns = rng.randint(4, 20)
+        t = start
+        messages = []
+        for turn in range(turns):
+            text = f"chat {c} question {turn} " + "lorem ipsum dolor sit amet " * rng.randint(5, 60)
+            if turn == 0 and c % 3 == 0:
+                text += "\n\n<document>\n" + "quarterly revenue grew in all regions " * 2000 + "\n</document>"
+            messages.append({"role": "user", "content": text, "timestamp": t})
+            messages.append({"role": "assistant", "content": "answer " + "consectetur adipiscing " * rng.randint(40, 400)})
+            gap = (rng.uniform(10, 60), rng.uniform(120, 420), rng.uniform(600, 1800), rng.uniform(5400, 18000))[pace]
+            t += gap
+        conversations.append({"id": f"synthetic-{c}", "messages": messages})
+    return conversations
+
+
+def load_chat_export(path: str) -> List[Dict[str, Any]]:
+    """Conversations from an OpenWebUI chat export (or a list of {messages})"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    conversations = []
+    for item in data if isinstance(data, list) else [data]:
+        chat = item.get("chat", item)
+        messages = [
+            {"role": m["role"], "content": m.get("content", ""), "timestamp": m.get("timestamp")}
+            for m in chat.get("messages", [])
+            if m.get("role") in ("user", "assistant", "system")
+        ]
+        if messages:
+            conversations.append({"id": item.get("id", str(len(conversations))), "messages": messages})
+    return conversations
+
+
+def requests_in_time_order(conversations: List[Dict[str, Any]]) -> Iterator[Tuple[float, str, List[Dict[str, Any]]]]:
+    """(time, conversation id, history up to and including the user turn)"""
+    turns = []
+    for conversation in conversations:
+        messages = conversation["messages"]
+        last = 0.0
+        for i, message in enumerate(messages):
+            if message["role"] != "user":
+                continue
+            # Exports without timestamps: assume a two minute rhythm
+            timestamp = message.get("timestamp")
+            last = last + 120 if timestamp is None else timestamp
+            history = [{"role": m["role"], "content": m["content"]} for m in messages[:i + 1]]
+            turns.append((last, conversation["id"], history))
+    turns.sort(key=lambda turn: turn[0])
+    return iter(turns)
+
+
+# ==================== CACHE MODEL ====================
+
+
+class PromptCacheModel:
+    """Prefix cache shared by every conversation of one API key"""
+
+    def __init__(self, estimate_tokens: Callable[[Any], int]):
+        self.estimate_tokens = estimate_tokens
+        self.entries: Dict[int, Tuple[float, int]] = {}  # prefix hash -> (expires, ttl)
+
+    def _blocks(self, payload: Dict[str, Any]) -> List[Tuple[int, int, Optional[int]]]:
+        """(prefix hash, prefix tokens, ttl if marked) for every block in prefix order"""
+        blocks = []
+        # Model and thinking settings are part of the cache key
+        prefix = hash((payload["model"], json.dumps(payload.get("thinking"), sort_keys=True)))
+        tokens = 0
+
+        def add(role: str, block: Any) -> None:
+            nonlocal prefix, tokens
+            marker = block.get("cache_control") if isinstance(block, dict) else None
+            if marker:
+                block = {k: v for k, v in block.items() if k != "cache_control"}
+            prefix = hash((prefix, role, json.dumps(block, sort_keys=True)))
+            tokens += self.estimate_tokens(block)
+            blocks.append((prefix, tokens, TTL_SECONDS[marker.get("ttl")] if marker else None))
+
+        for tool in payload.get("tools", []):
+            add("tools", tool)
+        system = payload.get("system")
+        for block in [system] if isinstance(system, str) else system or []:
+            add("system", block)
+        for message in payload["messages"]:
+            content = message["content"]
+            for block in [content] if isinstance(content, str) else content:
+                add(message["role"], block)
+        return blocks
+
+    def request(self, payload: Dict[str, Any], now: float) -> Dict[str, int]:
+        blocks = self._blocks(payload)
+        breakpoints = [i for i, block in enumerate(blocks) if block[2] is not None]
+
+        # Longest live entry at a breakpoint or within the lookback window
+        read = -1
+        for b in breakpoints:
+            for j in range(b, max(-1, b - LOOKBACK_BLOCKS - 1), -1):
+                entry = self.entries.get(blocks[j][0])
+                if entry and entry[0] >= now:
+                    read = max(read, j)
+                    break
+        if read >= 0:
+            prefix, _, _ = blocks[read]
+            self.entries[prefix] = (now + self.entries[prefix][1], self.entries[prefix][1])
+
+        written = {300: 0, 3600: 0}
+        covered = blocks[read][1] if read >= 0 else 0
+        for b in breakpoints:
+            prefix, tokens, ttl = blocks[b]
+            if b <= read or tokens < MIN_CACHEABLE_TOKENS:
+                continue
+            written[ttl] += tokens - covered
+            covered = tokens
+            self.entries[prefix] = (now + ttl, ttl)
+
+        total = blocks[-1][1] if blocks else 0
+        cache_read = blocks[read][1] if read >= 0 else 0
+        return {
+            "input_tokens": total - covered,
+            "cache_read_input_tokens": cache_read,
+            "cache_creation_5m": written[300],
+            "cache_creation_1h": written[3600],
+        }
+
+
+# ==================== STRATEGIES ====================
+
+
+def legacy_caching(payload: Dict[str, Any]) -> None:
+    """The pre-planner behaviour: system prompt + 2nd-to-last user message"""
+    marker = {"type": "ephemeral"}
+    system = payload.get("system")
+    if isinstance(system, str):
+        payload["system"] = [{"type": "text", "text": system, "cache_control": marker}]
+    users = [m for m in payload["messages"] if m["role"] == "user"]
+    if len(users) >= 2 and isinstance(users[-2]["content"], list):
+        users[-2]["content"][-1] = {**users[-2]["content"][-1], "cache_control": marker}
+
+
+# name -> (valve overrides, post-processing of the prepared payload)
+STRATEGIES: Dict[str, Tuple[Dict[str, Any], Optional[Callable[[Dict[str, Any]], None]]]] = {
+    "none": ({"ENABLE_PROMPT_CACHING": False}, None),
+    "legacy": ({"ENABLE_PROMPT_CACHING": False}, legacy_caching),
+    "planner-5m": ({"CACHE_TTL": "5min"}, None),
+    "planner-1h": ({"CACHE_TTL": "1hour"}, None),
+    "planner-auto": ({"CACHE_TTL": "auto"}, None),
+    "planner-no-tools": ({"CACHE_TTL": "5min", "CACHE_TOOLS": False}, None),
+}
+
+
+def simulate(module, conversations, system: Optional[str], overrides, post) -> Tuple[List[Dict[str, Any]], Any]:
+    pipe = module.Pipe()
+    pipe.valves.ANTHROPIC_API_KEY = "simulated"
+    for name, value in overrides.items():
+        setattr(pipe.valves, name, value)
+    profile = pipe._get_profile(pipe.user_valves)
+    cache = PromptCacheModel(pipe._estimate_tokens)
+
+    # The TTL selector reads simulated time and is scored on simulated usage
+    clock = [0.0]
+    pipe._cache_ttl.clock = lambda: clock[0]
+
+    results = []
+    for now, conversation_id, history in requests_in_time_order(conversations):
+        clock[0] = now
+        chat_system = system
+        if history and history[0]["role"] == "system":
+            chat_system = chat_system or history[0]["content"]
+            history = history[1:]
+        processed = pipe._process_messages(history, conversation_id)
+        payload = pipe._prepare_payload({"stream": True}, processed, chat_system, profile, conversation_id)
+        if post:
+            post(payload)
+        usage = cache.request(payload, now)
+        pipe._cache_ttl.observe(conversation_id, usage)
+        results.append(usage)
+    return results, pipe._cache_ttl
+
+
+def summarize(name: str, results: List[Dict[str, Any]]) -> str:
+    read = sum(r["cache_read_input_tokens"] for r in results)
+    write_5m = sum(r["cache_creation_5m"] for r in results)
+    write_1h = sum(r["cache_creation_1h"] for r in results)
+    uncached = sum(r["input_tokens"] for r in results)
+    total = read + write_5m + write_1h + uncached
+    cost = (
+        uncached * PRICE_INPUT + read * PRICE_CACHE_READ
+        + write_5m * PRICE_CACHE_WRITE[300] + write_1h * PRICE_CACHE_WRITE[3600]
+    ) / 1e6
+    ttft = sorted(
+        TTFT_BASE + (r["input_tokens"] + r["cache_creation_5m"] + r["cache_creation_1h"]) * TTFT_UNCACHED
+        + r["cache_read_input_tokens"] * TTFT_CACHED
+        for r in results
+    )
+    p95 = ttft[min(len(ttft) - 1, int(len(ttft) * 0.95))]
+    return (
+        f"{name:<18}{read / 1e3:>10,.0f}{(write_5m + write_1h) / 1e3:>10,.0f}{uncached / 1e3:>10,.0f}"
+        f"{read / total:>8.0%}{cost:>10.2f}{statistics.mean(ttft):>9.2f}{p95:>8.2f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("export", nargs="?", help="OpenWebUI chat export (JSON); synthetic chats if omitted")
+    parser.add_argument("--system", help="file with the system prompt used for every chat")
+    parser.add_argument("--strategy", action="append", choices=sorted(STRATEGIES), help="limit to these strategies")
+    args = parser.parse_args()
+
+    module = load_pipe_module()
+    conversations = load_chat_export(args.export) if args.export else synthetic_conversations()
+    if args.system:
+        system = Path(args.system).read_text(encoding="utf-8")
+    else:
+        system = None if args.export else "You are the research assistant of Example Corp. " * 400
+
+    requests = sum(1 for _ in requests_in_time_order(conversations))
+    print(f"{len(conversations)} conversations, {requests} requests")
+    print(f"{'strategy':<18}{'read k':>10}{'write k':>10}{'input k':>10}{'hit':>8}{'cost $':>10}{'ttft s':>9}{'p95 s':>8}")
+    for name in args.strategy or STRATEGIES:
+        overrides, post = STRATEGIES[name]
+        results, selector = simulate(module, conversations, system, overrides, post)
+        print(summarize(name, results))
+        if overrides.get("CACHE_TTL") == "auto" and selector.predictions:
+            print(
+                f"{'':<18}tail hit rate: predicted {selector.predicted_hit_rate:.0%}, "
+                f"simulated {selector.actual_hit_rate:.0%} over {selector.predictions} turns"
+            )
+
+
+if __name__ == "__main__":
+    main()
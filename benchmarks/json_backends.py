@@ -0,0 +1,137 @@
+"""
+Compare JSON backends on Claude SSE streams and request payloads.
+
+Decodes every `data:` line of one or more recorded streams with each
+installed backend (the per-event cost in stream_response) and encodes a
+long-conversation payload (the per-request cost in _send_with_retry).
+
+Record a stream with:
+
+    curl -sN https://api.anthropic.com/v1/messages \
+        -H "x-api-key: $ANTHROPIC_API_KEY" -H "anthropic-version: 2023-06-01" \
+        -H "content-type: application/json" \
+        -d '{"model": "claude-sonnet-4-5-20250929", "max_tokens": 4096, "stream": true,
+             "messages": [{"role": "user", "content": "Explain TCP slow start"}]}' \
+        > stream.sse
+
+Usage (needs the same environment as function.py, i.e. open_webui installed):
+
+    python benchmarks/json_backends.py [stream.sse ...]
+
+Without arguments a synthetic stream shaped like a Claude response is used
+(thinking and text deltas, a web search result block, citations).
+"""
+
+import importlib.util
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+
+def load_pipe_module():
+    path = Path(__file__).resolve().parent.parent / "function.py"
+    spec = importlib.util.spec_from_file_location("function", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def available_backends(module) -> Dict[str, Tuple[Callable[[Any], Any], Callable[[Any], bytes]]]:
+    """function.py's JSON_BACKENDS that are installed, stdlib (the baseline) first"""
+    backends = {}
+    for name in sorted(module.JSON_BACKENDS, key=lambda name: name != "stdlib"):
+        try:
+            backends[name] = module.load_json_backend(name)
+        except ImportError:
+            pass
+    return backends
+
+
+def read_events(path: str) -> List[bytes]:
+    """The data payloads of a recorded SSE stream"""
+    with open(path, "rb") as f:
+        raw = f.read().replace(b"\r\n", b"\n")
+    events = []
+    for block in raw.split(b"\n\n"):
+        data = [line[5:].lstrip(b" ") for line in block.split(b"\n") if line.startswith(b"data:")]
+        if data and data != [b"[DONE]"]:
+            events.append(b"\n".join(data))
+    return events
+
+
+def synthetic_events() -> List[bytes]:
+    """A ~2.5k-event response with thinking, a web search and cited text"""
+    def ev(d: Dict[str, Any]) -> bytes:
+        return json.dumps(d).encode()
+
+    events = [ev({"type": "message_start", "message": {
+        "id": "msg_01", "type": "message", "role": "assistant", "content": [],
+        "model": "claude-sonnet-4-5-20250929", "stop_reason": None,
+        "usage": {"input_tokens": 1520, "cache_read_input_tokens": 12000, "output_tokens": 1}}})]
+    events.append(ev({"type": "content_block_start", "index": 0, "content_block": {"type": "thinking", "thinking": ""}}))
+    for i in range(800):
+        events.append(ev({"type": "content_block_delta", "index": 0,
+                          "delta": {"type": "thinking_delta", "thinking": f"considering step {i} of the problem, "}}))
+    events.append(ev({"type": "content_block_stop", "index": 0}))
+    events.append(ev({"type": "content_block_start", "index": 1, "content_block": {
+        "type": "web_search_tool_result", "tool_use_id": "srvtoolu_01",
+        "content": [{"type": "web_search_result", "title": f"Result {i}", "url": f"https://example.com/{i}",
+                     "encrypted_content": "Eq" + "x" * 3000, "page_age": "2 days ago"} for i in range(10)]}}))
+    events.append(ev({"type": "content_block_stop", "index": 1}))
+    events.append(ev({"type": "content_block_start", "index": 2, "content_block": {"type": "text", "text": ""}}))
+    for i in range(1600):
+        events.append(ev({"type": "content_block_delta", "index": 2, "delta": {"type": "text_delta", "text": " word"}}))
+        if i % 200 == 0:
+            events.append(ev({"type": "content_block_delta", "index": 2, "delta": {"type": "citations_delta", "citation": {
+                "type": "web_search_result_location", "url": "https://example.com/1", "title": "Result 1",
+                "encrypted_index": "Eo" + "y" * 200, "cited_text": "a quoted sentence from the page " * 4}}}))
+        if i % 400 == 0:
+            events.append(ev({"type": "ping"}))
+    events.append(ev({"type": "content_block_stop", "index": 2}))
+    events.append(ev({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 2400}}))
+    events.append(ev({"type": "message_stop"}))
+    return events
+
+
+def synthetic_payload() -> Dict[str, Any]:
+    """A 300-turn conversation (~0.9 MB of JSON)"""
+    messages = []
+    for i in range(300):
+        messages.append({"role": "user", "content": [{"type": "text", "text": f"question {i} " + "lorem ipsum dolor " * 50}]})
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": f"answer {i} " + "sit amet, consectetur " * 80}]})
+    return {"model": "claude-sonnet-4-5-20250929", "max_tokens": 8192, "stream": True,
+            "system": "You are a helpful assistant. " * 100, "messages": messages,
+            "thinking": {"type": "enabled", "budget_tokens": 4000},
+            "tools": [{"type": "web_search_20250305", "name": "web_search", "max_uses": 5}]}
+
+
+def best_of(fn: Callable[[], Any], repeat: int = 7) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(paths: List[str]) -> None:
+    module = load_pipe_module()
+    events = [e for path in paths for e in read_events(path)] if paths else synthetic_events()
+    payload = synthetic_payload()
+    source = ", ".join(paths) if paths else "synthetic stream"
+    print(f"{len(events)} events ({sum(map(len, events)) / 1e3:.0f} KB) from {source}")
+    print(f"{'backend':<10}{'decode us/event':>16}{'events/s':>12}{'encode ms/payload':>20}")
+
+    baseline = None
+    for name, (loads, dumps) in available_backends(module).items():
+        decode = best_of(lambda: [loads(e) for e in events]) / len(events)
+        encode = best_of(lambda: dumps(payload))
+        baseline = baseline or decode
+        print(f"{name:<10}{decode * 1e6:>16.2f}{1 / decode:>12,.0f}{encode * 1e3:>20.2f}"
+              f"   ({baseline / decode:.1f}x decode vs stdlib)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
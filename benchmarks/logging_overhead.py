@@ -0,0 +1,126 @@
+"""
+Per-event logging cost of the stream loop, before and after lazy logging.
+
+"before" replays what the stream loop logged for every input_json_delta
+event before LOG_LEVEL defaulted to INFO: one INFO and two DEBUG records
+built with f-strings, whether or not the level let them through.
+
+"after" is the current loop: the DEBUG level is checked once per stream,
+and at DEBUG one event in LOG_EVENT_SAMPLE_RATE logs a lazy %-style
+record with structured fields (log_fields).
+
+The root handler formats into os.devnull. LOG_NONBLOCKING routes the
+module's records through the pipe's QueueHandler, so the caller pays for
+enqueueing and the listener thread does the write. The last rows are the
+caller-side cost of one record that is emitted.
+
+Usage (needs the same environment as function.py, i.e. open_webui installed):
+
+    python benchmarks/logging_overhead.py
+"""
+
+import importlib.util
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable
+
+EVENTS = 20_000
+
+
+def load_pipe_module():
+    path = Path(__file__).resolve().parent.parent / "function.py"
+    spec = importlib.util.spec_from_file_location("function", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def before(logger: logging.Logger) -> None:
+    """The pre-overhaul input_json_delta branch, minus the parsing itself"""
+    buffer = ""
+    for i in range(EVENTS):
+        partial_json = f'"fragment {i}", '
+        logger.info(f"input_json_delta received, fragment: {partial_json[:50]}")
+        buffer += partial_json
+        logger.debug(f"Buffer now: {buffer[:100]}")
+        logger.debug(f"Buffer not yet complete JSON, continuing to accumulate...")
+
+
+def after(module, sample_rate: int) -> Callable[[logging.Logger], None]:
+    def run(logger: logging.Logger) -> None:
+        """The stream loop's per-event guard"""
+        debug = logger.isEnabledFor(logging.DEBUG)
+        event_count = 0
+        for _ in range(EVENTS):
+            event_type = "content_block_delta"
+            event_count += 1
+            if debug and event_count % sample_rate == 0:
+                logger.debug(
+                    "stream event n=%d type=%s", event_count, event_type,
+                    extra=module.log_fields("stream_event", n=event_count, type=event_type)
+                )
+    return run
+
+
+def one_record(module) -> Callable[[logging.Logger], None]:
+    def run(logger: logging.Logger) -> None:
+        for i in range(EVENTS):
+            logger.info(
+                "Stream complete: events=%d searches=%d citations=%d output_tokens=%s", i, 1, 3, 812,
+                extra=module.log_fields("stream_complete", events=i, searches=1, citations=3)
+            )
+    return run
+
+
+class JsonFormatter(logging.Formatter):
+    """What a structured-logging deployment would use on the root handler"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            "level": record.levelname, "message": record.getMessage(),
+            "event": getattr(record, "event", None), **getattr(record, "fields", {})
+        }, default=str)
+
+
+def measure(module, level: str, nonblocking: bool, fn: Callable[[logging.Logger], None]) -> float:
+    pipe = module.Pipe()
+    pipe.valves.LOG_LEVEL = level
+    pipe.valves.LOG_NONBLOCKING = nonblocking
+    pipe._configure_logging()
+    try:
+        start = time.perf_counter()
+        fn(module.logger)
+        return (time.perf_counter() - start) / EVENTS
+    finally:
+        pipe._stop_log_listener()
+
+
+def main() -> None:
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    sink = open(os.devnull, "w")
+    handler = logging.StreamHandler(sink)
+    handler.setFormatter(JsonFormatter())
+    root.addHandler(handler)
+    module = load_pipe_module()
+
+    cases = [
+        ("before, LOG_LEVEL=DEBUG (old default)", "DEBUG", False, before),
+        ("before, LOG_LEVEL=INFO", "INFO", False, before),
+        ("after, DEBUG sampled 1/100", "DEBUG", False, after(module, 100)),
+        ("after, DEBUG sampled 1/100, queue", "DEBUG", True, after(module, 100)),
+        ("after, INFO (default)", "INFO", True, after(module, 100)),
+        ("one emitted record, direct", "INFO", False, one_record(module)),
+        ("one emitted record, queue", "INFO", True, one_record(module)),
+    ]
+    print(f"{'case':<42}{'us/event':>10}")
+    for label, level, nonblocking, fn in cases:
+        print(f"{label:<42}{min(measure(module, level, nonblocking, fn) for _ in range(3)) * 1e6:>10.2f}")
+    sink.close()
+
+
+if __name__ == "__main__":
+    main()
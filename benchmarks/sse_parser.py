@@ -0,0 +1,139 @@
+"""
+Compare SSEParser with line loops on Claude SSE streams.
+
+- naive split: decode, split on LF and keep the ``data:`` payloads. It
+  ignores ``event:``, ``id:``, ``retry:``, multi-line data and CR line
+  endings, so it is a lower bound on parsing cost, not an alternative.
+- aiter_lines: what stream_response did before SSEParser, i.e. httpx's
+  text and line decoders (the body of ``Response.aiter_lines``) followed
+  by the ``data:`` prefix and ``[DONE]`` checks.
+- SSEParser: ``feed`` plus the ping / ``[DONE]`` checks stream_response
+  does now.
+
+Each stream is cut into chunks of a fixed size (large reads) and into one
+chunk per event (a live stream, where tokens arrive one event at a time),
+and measured with and without decoding the JSON payloads through the
+pipe's selected backend.
+
+Usage (needs the same environment as function.py, i.e. open_webui installed):
+
+    python benchmarks/sse_parser.py [stream.sse ...]
+
+Without arguments the synthetic stream from json_backends.py is used; see
+that file for how to record a real one.
+"""
+
+import importlib.util
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, List
+
+from httpx._decoders import LineDecoder, TextDecoder
+
+from json_backends import synthetic_events
+
+
+def load_pipe_module():
+    path = Path(__file__).resolve().parent.parent / "function.py"
+    spec = importlib.util.spec_from_file_location("function", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_stream() -> bytes:
+    return b"".join(
+        b"event: " + json.loads(data)["type"].encode() + b"\ndata: " + data + b"\n\n"
+        for data in synthetic_events()
+    )
+
+
+def split_fixed(stream: bytes, size: int) -> List[bytes]:
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def split_events(stream: bytes) -> List[bytes]:
+    return [event + b"\n\n" for event in stream.split(b"\n\n") if event]
+
+
+def naive_split(chunks: List[bytes], loads: Callable[[Any], Any]) -> int:
+    count = 0
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + chunk.decode("utf-8")).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.startswith("data: "):
+                loads(line[6:])
+                count += 1
+    return count
+
+
+def aiter_lines(chunks: List[bytes], loads: Callable[[Any], Any]) -> int:
+    count = 0
+    text_decoder = TextDecoder("utf-8")
+    line_decoder = LineDecoder()
+    for chunk in chunks:
+        for line in line_decoder.decode(text_decoder.decode(chunk)):
+            if not line or not line.startswith("data: "):
+                continue
+            raw = line[6:]
+            if raw.strip() == "[DONE]":
+                return count
+            loads(raw)
+            count += 1
+    return count
+
+
+def sse_parser(module, chunks: List[bytes], loads: Callable[[Any], Any]) -> int:
+    count = 0
+    parser = module.SSEParser()
+    for chunk in chunks:
+        for event, data in parser.feed(chunk):
+            if event == b"ping":
+                continue
+            if data == b"[DONE]":
+                return count
+            loads(data)
+            count += 1
+    return count
+
+
+def best_of(fns: List[Callable[[], int]], repeat: int = 25) -> List[float]:
+    """Minimum time of each function, run interleaved so drift hits all alike"""
+    timings = [[] for _ in fns]
+    for _ in range(repeat):
+        for fn, runs in zip(fns, timings):
+            start = time.perf_counter()
+            fn()
+            runs.append(time.perf_counter() - start)
+    return [min(runs) for runs in timings]
+
+
+def main(paths: List[str]) -> None:
+    module = load_pipe_module()
+    if paths:
+        stream = b"".join(Path(path).read_bytes().replace(b"\r\n", b"\n") for path in paths)
+    else:
+        stream = synthetic_stream()
+    events = naive_split([stream], lambda data: None)
+    print(f"{events} events ({len(stream) / 1e3:.0f} KB) from {', '.join(paths) or 'synthetic stream'}, "
+          f"JSON backend: {module.JSON_BACKEND}")
+    print(f"{'chunking':<16}{'decode':<8}{'naive split':>13}{'aiter_lines':>13}{'SSEParser':>13}"
+          f"{'vs naive':>10}{'vs aiter_lines':>16}")
+
+    for label, chunks in (("4 KiB reads", split_fixed(stream, 4096)), ("event per read", split_events(stream))):
+        for decode, loads in (("no", lambda data: None), ("yes", module.json_loads)):
+            naive, lines, parser = (events / t for t in best_of([
+                lambda: naive_split(chunks, loads),
+                lambda: aiter_lines(chunks, loads),
+                lambda: sse_parser(module, chunks, loads),
+            ]))
+            print(f"{label:<16}{decode:<8}{naive:>13,.0f}{lines:>13,.0f}{parser:>13,.0f}"
+                  f"{parser / naive:>10.2f}{parser / lines:>16.2f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,23 +4,103 @@ author: Enhanced by AI
 version: 4.1.0
 license: MIT
 description: Production-ready Claude Sonnet 4.5 with <think> tags for reasoning, web search, skills, and clean UX
-requirements: requests, pydantic
+requirements: httpx, pydantic
 """
 
 import os
 import json
+import pickle
+import time
+import base64
+import hashlib
+import tempfile
+import queue
+import random
+import re
+import asyncio
 import logging
+from io import BytesIO
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque, OrderedDict
 from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from enum import Enum
-from typing import Any, Dict, Generator, List, Optional, Literal
-import requests
-from pydantic import BaseModel, Field
+from contextlib import aclosing
+from types import MappingProxyType
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, List, Mapping, Optional, Literal, Tuple, Union
+import httpx
+from pydantic import BaseModel, Field, model_validator
 from open_webui.utils.misc import pop_system_message
 
+try:
+    from PIL import Image
+except ImportError:  # Image preprocessing is skipped without Pillow
+    Image = None
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
 
+def log_fields(event: str, **fields: Any) -> Dict[str, Any]:
+    """
+    ``extra=`` for a structured record: sets ``record.event`` and
+    ``record.fields`` so a JSON formatter on the root handler can emit them
+    as keys. The text message stays as it is for plain formatters.
+    """
+    return {"event": event, "fields": fields}
+
+
+# ==================== JSON BACKENDS ====================
+
+# Tried in order at import time; ANTHROPIC_JSON_BACKEND=<name> forces one
+JSON_BACKENDS = ("msgspec", "orjson", "stdlib")
+
+
+def _stdlib_loads(data: Any) -> Any:
+    # Decoding first is faster than letting json.loads sniff the bytes
+    return json.loads(data.decode("utf-8") if isinstance(data, (bytes, bytearray)) else data)
+
+
+def _stdlib_dumps(value: Any) -> bytes:
+    # Compact, ASCII escapes (faster than ensure_ascii=False)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def load_json_backend(name: str) -> Tuple[Callable[[Any], Any], Callable[[Any], bytes]]:
+    """
+    Return (loads, dumps) for a backend. loads accepts bytes or str, dumps
+    returns bytes, and decode errors are ValueError subclasses for all of
+    them. Raises ImportError if the package is not installed.
+    """
+    if name == "orjson":
+        import orjson
+        return orjson.loads, orjson.dumps
+    if name == "msgspec":
+        import msgspec
+        return msgspec.json.decode, msgspec.json.encode
+    if name == "stdlib":
+        return _stdlib_loads, _stdlib_dumps
+    raise ImportError(f"Unknown JSON backend: {name}")
+
+
+def _select_json_backend() -> Tuple[str, Callable[[Any], Any], Callable[[Any], bytes]]:
+    requested = os.getenv("ANTHROPIC_JSON_BACKEND", "").strip().lower()
+    candidates = (requested, "stdlib") if requested else JSON_BACKENDS
+    for name in candidates:
+        try:
+            return (name,) + load_json_backend(name)
+        except ImportError:
+            if requested:
+                logger.warning("JSON backend %s unavailable, falling back to stdlib", name)
+    raise RuntimeError("No JSON backend available")
+
+
+JSON_BACKEND, json_loads, json_dumps = _select_json_backend()
+
+
 # ==================== ENUMS & DATA CLASSES ====================
 
 
@@ -40,31 +120,1315 @@ class CitationData:
     encrypted_index: str = ""
 
 
+@dataclass(frozen=True, slots=True)
+class RequestProfile:
+    """
+    Request settings derived from Valves + UserValves.
+
+    Built once per valve change and shared by every request with the same
+    settings, so the tool dicts must be treated as read-only.
+    """
+    headers: Mapping[str, str]
+    tools: Tuple[Dict[str, Any], ...]
+    thinking: Optional[Mapping[str, Any]]
+
+
+@dataclass(slots=True)
+class CacheBreakpoint:
+    """A planned cache_control marker and the size of the prefix it closes"""
+    kind: str  # "tools", "system", "document", "lookback" or "tail"
+    prefix_tokens: int
+    message_index: Optional[int] = None
+    new_tokens: int = 0  # Tokens added since the previous turn (tail only)
+    ttl: str = "5m"
+
+
 @dataclass
 class WebSearchResult:
     """Web search result data"""
     query: str
     results: List[Dict[str, Any]] = field(default_factory=list)
-    partial_json_buffer: str = ""  # Accumulate partial JSON fragments
 
 
 @dataclass
+class ServerToolCall:
+    """
+    Server tool invocation (web_search, code_execution, ...) whose input
+    streams in as input_json_delta fragments.
+
+    Fragments are only collected while the block is open and parsed once
+    at content_block_stop, keeping accumulation linear in the input size.
+    """
+    name: str
+    input: Dict[str, Any] = field(default_factory=dict)
+    fragments: List[str] = field(default_factory=list)
+
+    def finalize(self) -> Dict[str, Any]:
+        """Parse the accumulated fragments into the tool input"""
+        if self.fragments:
+            raw = "".join(self.fragments)
+            self.fragments = []
+            try:
+                parsed = json_loads(raw)
+            except ValueError:
+                logger.warning("Failed to parse %s input: %.100s", self.name, raw)
+                return self.input
+            if isinstance(parsed, dict):
+                self.input = parsed
+        return self.input
+
+
+@dataclass(slots=True)
 class StreamingState:
-    """State management for streaming responses"""
+    """
+    State management for streaming responses.
+
+    Streamed text is only retained when a feature needs it: set
+    ``thinking_chunks`` / ``response_chunks`` to a list to capture deltas,
+    and join once via ``thinking_text()`` / ``response_text()``.
+    """
     thinking_state: ThinkingState = ThinkingState.NOT_STARTED
-    thinking_buffer: str = ""
-    response_buffer: str = ""
+    thinking_chunks: Optional[List[str]] = None
+    response_chunks: Optional[List[str]] = None
     web_searches: List[WebSearchResult] = field(default_factory=list)
     citations: List[CitationData] = field(default_factory=list)
     current_block_index: int = 0
     current_block_type: Optional[str] = None
     current_search: Optional[WebSearchResult] = None
-    current_search_results: List[Dict[str, Any]] = field(default_factory=list)
-    all_events: List[Dict[str, Any]] = field(default_factory=list)  # Store all events for citation extraction
+    current_tool: Optional[ServerToolCall] = None
+    output_chars: int = 0  # Thinking + text streamed so far (for abort accounting)
+    usage: Dict[str, Any] = field(default_factory=dict)
+    usage_offset: Dict[str, Any] = field(default_factory=dict)  # Usage of the legs before a stall continuation
+    prefill_whitespace: str = ""  # Trailing whitespace cut off the continuation prefill, already shown
+    debug: bool = False  # DEBUG logging enabled, resolved once per stream
+    conversation_id: Optional[str] = None
+    recent_events: Optional[Deque[Dict[str, Any]]] = None  # Debug-only replay buffer (bounded)
+
+    def thinking_text(self) -> str:
+        """Captured thinking text ("" when capture is off)"""
+        return "".join(self.thinking_chunks) if self.thinking_chunks else ""
+
+    def response_text(self) -> str:
+        """Captured response text ("" when capture is off)"""
+        return "".join(self.response_chunks) if self.response_chunks else ""
+
+
+def add_usage(base: Dict[str, Any], usage: Dict[str, Any]) -> Dict[str, Any]:
+    """``usage`` with the counts in ``base`` added (nested counters too); keys only in ``base`` are left out"""
+    total = {}
+    for key, value in usage.items():
+        prior = base.get(key)
+        if isinstance(value, dict) and isinstance(prior, dict):
+            total[key] = add_usage(prior, value)
+        elif type(value) in (int, float) and type(prior) in (int, float):
+            total[key] = prior + value
+        else:
+            total[key] = value
+    return total
+
+
+@dataclass
+class RetryBudget:
+    """Retries used so far by one user request (shared by all its attempts)"""
+    attempts: int = 0
+    waited: float = 0.0
+
+
+class RetryableStreamError(Exception):
+    """Upstream failed in a retryable way before any output was produced"""
+
+    def __init__(self, error: Dict[str, Any]):
+        super().__init__(error.get("message", ""))
+        self.error = error
+
+
+# ==================== SSE PARSER ====================
+
+
+class SSEParser:
+    """
+    Incremental Server-Sent Events parser working on raw byte chunks.
+
+    Implements the field rules of the WHATWG SSE spec (data, event, id,
+    retry, comments, CR / LF / CRLF line endings, leading BOM). All complete
+    events in a chunk are split off the raw buffer in one pass; a run of
+    plain ``event: X`` / ``data: Y`` events (everything Anthropic sends) is
+    split by a single regex call, other LF streams per event, and streams
+    that use CR line endings fall back to a line scanner.
+
+    Events are ``(event, data)`` byte-string pairs; ``id`` and ``retry`` are
+    stream state and are read from ``last_event_id`` / ``retry`` instead of
+    being copied into every event.
+    """
+
+    # "event: X\ndata: Y\n\n" at a line start; "." stops at LF
+    EVENT_RUN = re.compile(rb"^event: (.*)\ndata: (.*)\n\n", re.MULTILINE)
+    EVENT_RUN_MIN_BYTES = 1024
+
+    def __init__(self):
+        self._buffer = b""
+        self._data: List[bytes] = []
+        self._event = b""
+        self._started = False
+        self._lf_only = True
+        self.last_event_id = ""
+        self.retry: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> List[Tuple[bytes, bytes]]:
+        """Add a chunk and return all events completed by it"""
+        buffered = self._buffer
+        if buffered:
+            buf = buffered + chunk
+            # Most chunks of a large event complete nothing; only the new
+            # bytes (and the LF before them) can hold the blank line
+            if self._lf_only and 13 not in chunk and buf.find(b"\n\n", len(buffered) - 1) == -1:
+                self._buffer = buf
+                return []
+        else:
+            buf = chunk
+
+        if not self._started:
+            if len(buf) < 3 and b"\xef\xbb\xbf".startswith(buf):
+                self._buffer = buf
+                return []
+            if buf.startswith(b"\xef\xbb\xbf"):
+                buf = buf[3:]
+            self._started = True
+
+        # Int membership: bytes.__contains__ with a bytes needle is several
+        # times slower in CPython
+        if self._lf_only and 13 in chunk:
+            self._lf_only = False
+
+        if not self._lf_only:
+            return self._feed_lines(buf)
+
+        # A live stream mostly delivers one complete event per read
+        if buf.endswith(b"\n\n"):
+            lines = buf.split(b"\n")
+            if len(lines) == 4:
+                head, data = lines[0], lines[1]
+                if head.startswith(b"event: ") and data.startswith(b"data: ") and head != b"event: ":
+                    self._buffer = b""
+                    return [(head[7:], data[6:])]
+
+        # Everything up to the last blank line is a run of complete events
+        end = buf.rfind(b"\n\n") + 2
+        if end == 1:
+            self._buffer = buf
+            return []
+        if end < len(buf):
+            complete = buf[:end]
+            self._buffer = buf[end:]
+        else:
+            complete = buf
+            self._buffer = b""
+
+        # Fast path for runs of several events (large reads): the run is
+        # exactly a sequence of EVENT_RUN matches when every LF in it belongs
+        # to one (three per event). An empty event name means "message", so
+        # that rare case takes the general path. Below ~1 KiB the fixed cost
+        # of the regex call is more than splitting per event.
+        if end > self.EVENT_RUN_MIN_BYTES:
+            events = self.EVENT_RUN.findall(complete)
+            if complete.count(b"\n") == 3 * len(events) and complete.find(b"event: \n") == -1:
+                return events
+
+        events = []
+        for segment in complete[:-2].split(b"\n\n"):
+            # "event: X\ndata: Y" or a lone "data: Y" with other fields
+            # around it, e.g. an id line
+            head, _, data = segment.partition(b"\n")
+            if head.startswith(b"event: ") and head != b"event: ":
+                if data.startswith(b"data: ") and 10 not in data:
+                    events.append((head[7:], data[6:]))
+                    continue
+            elif not data and head.startswith(b"data: "):
+                events.append((b"message", head[6:]))
+                continue
+
+            for line in segment.split(b"\n"):
+                if line:
+                    self._process_field(line)
+                else:
+                    self._dispatch(events)
+            self._dispatch(events)
+
+        return events
+
+    def close(self) -> List[Tuple[bytes, bytes]]:
+        """Finish the stream; a trailing lone CR still terminates its line"""
+        events = self.feed(b"\n") if self._buffer.endswith(b"\r") else []
+        self._buffer = b""
+        self._data = []
+        self._event = b""
+        return events
+
+    def _feed_lines(self, buf: bytes) -> List[Tuple[bytes, bytes]]:
+        """Line-by-line scan handling CR, LF and CRLF terminators"""
+        events: List[Tuple[bytes, bytes]] = []
+        pos = 0
+        size = len(buf)
+
+        while pos < size:
+            lf = buf.find(b"\n", pos)
+            cr = buf.find(b"\r", pos, size if lf == -1 else lf)
+            if cr != -1:
+                # CR may be the first half of a CRLF split across chunks
+                if cr + 1 == size:
+                    break
+                end = cr
+                nxt = cr + 2 if buf[cr + 1] == 0x0A else cr + 1
+            elif lf != -1:
+                end = lf
+                nxt = lf + 1
+            else:
+                break
+
+            if end == pos:
+                self._dispatch(events)
+            else:
+                self._process_field(buf[pos:end])
+            pos = nxt
+
+        self._buffer = buf[pos:]
+        return events
+
+    def _process_field(self, line: bytes) -> None:
+        """Apply one non-empty line (without terminator) to the pending event"""
+        if line.startswith(b":"):
+            # Comment line
+            return
+
+        name, colon, value = line.partition(b":")
+        if colon and value.startswith(b" "):
+            value = value[1:]
+
+        if name == b"data":
+            self._data.append(value)
+        elif name == b"event":
+            self._event = value
+        elif name == b"id":
+            if b"\x00" not in value:
+                self.last_event_id = value.decode("utf-8", "replace")
+        elif name == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+        # Unknown fields are ignored per spec
+
+    def _dispatch(self, events: List[Tuple[bytes, bytes]]) -> None:
+        """Emit the pending event (if it has data) and reset field buffers"""
+        data = self._data
+        if data:
+            events.append((self._event or b"message", data[0] if len(data) == 1 else b"\n".join(data)))
+            self._data = []
+        self._event = b""
+
+
+# ==================== RATE LIMITING ====================
+
+
+def seconds_until(timestamp: str) -> Optional[float]:
+    """Seconds from now until an RFC 3339 timestamp (None if unparseable)"""
+    try:
+        reset = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if reset.tzinfo is None:
+        reset = reset.replace(tzinfo=timezone.utc)
+    return max(0.0, (reset - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """
+    Continuously refilling token bucket, re-synced from the server's view
+    (limit / remaining / reset) on every response.
+    """
+
+    __slots__ = ("capacity", "tokens", "rate", "updated")
+
+    def __init__(self):
+        self.capacity = 0.0  # 0 = limit not known yet, never waits
+        self.tokens = 0.0
+        self.rate = 0.0
+        self.updated = 0.0
+
+    def sync(self, limit: float, remaining: float, reset_in: Optional[float], reserved: float = 0.0) -> None:
+        """Adopt the server-reported state of this limit, minus ``reserved`` tokens it cannot know about"""
+        self.capacity = limit
+        self.tokens = min(remaining, limit) - reserved
+        if reset_in and remaining < limit:
+            # Reset is when the bucket is full again
+            self.rate = (limit - remaining) / reset_in
+        else:
+            # Limits are per minute and replenish continuously
+            self.rate = limit / 60
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until ``amount`` tokens are available"""
+        if not self.capacity or not self.rate:
+            return 0.0
+        self._refill(now)
+        deficit = min(amount, self.capacity) - self.tokens
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def consume(self, amount: float) -> None:
+        if self.capacity:
+            self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    Client-side pacing for the requests / input-tokens / output-tokens
+    limits reported in anthropic-ratelimit-* response headers.
+
+    The headers describe the organization-wide state, so workers sharing a
+    key converge on the same view. Each caller reserves its tokens on
+    arrival (a bucket may go negative) and sleeps until the refill covers
+    them, so callers are released in arrival order while waiting side by
+    side, each for at most its own ``max_wait``.
+    """
+
+    LIMITS = ("requests", "input-tokens", "output-tokens")
+
+    def __init__(self):
+        self.buckets: Dict[str, TokenBucket] = {name: TokenBucket() for name in self.LIMITS}
+        # Debited by callers still sleeping, i.e. not yet seen by the server
+        self.reserved: Dict[str, float] = {name: 0.0 for name in self.LIMITS}
+
+    def update(self, headers: httpx.Headers) -> None:
+        """Re-sync buckets from a response's rate-limit headers"""
+        for name, bucket in self.buckets.items():
+            limit = headers.get(f"anthropic-ratelimit-{name}-limit")
+            remaining = headers.get(f"anthropic-ratelimit-{name}-remaining")
+            if limit is None or remaining is None:
+                continue
+            try:
+                limit_value = float(limit)
+                remaining_value = float(remaining)
+            except ValueError:
+                continue
+            reset = headers.get(f"anthropic-ratelimit-{name}-reset")
+            bucket.sync(limit_value, remaining_value, seconds_until(reset) if reset else None, self.reserved[name])
+
+    def wait_time(self, input_tokens: int) -> float:
+        """Seconds until a request with ``input_tokens`` fits every limit"""
+        now = time.monotonic()
+        return max(
+            self.buckets["requests"].wait_time(1, now),
+            self.buckets["input-tokens"].wait_time(input_tokens, now),
+            # Output is unknown up front - just wait until the bucket is not empty
+            self.buckets["output-tokens"].wait_time(1, now)
+        )
+
+    async def acquire(self, input_tokens: int, max_wait: float, on_wait=None) -> float:
+        """
+        Debit the request, then wait until the buckets have refilled past
+        it, at most ``max_wait`` seconds from the call. Returns the time
+        waited; after ``max_wait`` the request is let through and the server
+        decides.
+        """
+        # No await between measuring and debiting, so this is atomic on the
+        # event loop and later callers see this reservation
+        deadline = time.monotonic() + min(self.wait_time(input_tokens), max_wait)
+        self.buckets["requests"].consume(1)
+        self.buckets["input-tokens"].consume(input_tokens)
+        wait = deadline - time.monotonic()
+        if wait <= 0:
+            return 0.0
+
+        self.reserved["requests"] += 1
+        self.reserved["input-tokens"] += input_tokens
+        try:
+            if on_wait is not None:
+                await on_wait(wait)
+            await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+        finally:
+            self.reserved["requests"] -= 1
+            self.reserved["input-tokens"] -= input_tokens
+        return wait
+
+
+# ==================== ADMISSION CONTROL ====================
+
+
+class AdmissionTimeout(Exception):
+    """A request waited longer than QUEUE_TIMEOUT for a slot"""
+
+
+@dataclass(slots=True)
+class AdmissionWaiter:
+    """A request queued for an upstream slot"""
+    seq: int
+    user_id: str
+    weight: float
+    future: asyncio.Future
+
+
+class AdmissionController:
+    """
+    Caps concurrent upstream requests globally and per user.
+
+    Each user has a FIFO of waiters. When a slot frees up it goes to the
+    eligible user with the fewest active requests relative to their weight
+    (ties go to the oldest waiter), so one user with many tabs cannot
+    starve everyone else.
+    """
+
+    def __init__(self):
+        self.global_limit = 0
+        self.user_limit = 0
+        self.active_total = 0
+        self.active: Dict[str, int] = {}
+        self.waiting: Dict[str, Deque[AdmissionWaiter]] = {}
+        self._seq = 0
+
+    def configure(self, global_limit: int, user_limit: int) -> None:
+        """Apply current limits (0 = unlimited) and admit anyone they now allow"""
+        self.global_limit = max(0, global_limit)
+        self.user_limit = max(0, user_limit)
+        self._schedule()
+
+    def _has_room(self, user_id: str) -> bool:
+        if self.global_limit and self.active_total >= self.global_limit:
+            return False
+        if self.user_limit and self.active.get(user_id, 0) >= self.user_limit:
+            return False
+        return True
+
+    def _admit(self, user_id: str) -> None:
+        self.active_total += 1
+        self.active[user_id] = self.active.get(user_id, 0) + 1
+
+    def _schedule(self) -> None:
+        """Hand free slots to waiters in weighted-fair order"""
+        while True:
+            best: Optional[AdmissionWaiter] = None
+            best_key = None
+            for user_id, queue_ in self.waiting.items():
+                if not queue_ or not self._has_room(user_id):
+                    continue
+                head = queue_[0]
+                key = (self.active.get(user_id, 0) / head.weight, head.seq)
+                if best_key is None or key < best_key:
+                    best, best_key = head, key
+            if best is None:
+                return
+            self._remove(best)
+            self._admit(best.user_id)
+            best.future.set_result(None)
+
+    def _remove(self, waiter: AdmissionWaiter) -> None:
+        queue_ = self.waiting.get(waiter.user_id)
+        if queue_ and waiter in queue_:
+            queue_.remove(waiter)
+            if not queue_:
+                del self.waiting[waiter.user_id]
+
+    def position(self, waiter: AdmissionWaiter) -> int:
+        """1-based queue position estimate under the weighted-fair order"""
+        def key(user_id: str, index: int, item: AdmissionWaiter):
+            return ((self.active.get(user_id, 0) + index) / item.weight, item.seq)
+
+        user_queue = self.waiting.get(waiter.user_id, ())
+        if waiter not in user_queue:
+            return 1
+        mine = key(waiter.user_id, user_queue.index(waiter), waiter)
+        return 1 + sum(
+            1
+            for user_id, queue_ in self.waiting.items()
+            for index, other in enumerate(queue_)
+            if key(user_id, index, other) < mine
+        )
+
+    def try_acquire(self, user_id: str) -> bool:
+        """Take a slot only if one is free and nobody is queued (background work)"""
+        if self.waiting or not self._has_room(user_id):
+            return False
+        self._admit(user_id)
+        return True
+
+    async def acquire(
+        self,
+        user_id: str,
+        weight: float,
+        timeout: float,
+        on_position=None
+    ) -> None:
+        """Wait for a slot; ``on_position`` is awaited whenever the position changes"""
+        if not self.waiting and self._has_room(user_id):
+            self._admit(user_id)
+            return
+
+        self._seq += 1
+        waiter = AdmissionWaiter(
+            seq=self._seq,
+            user_id=user_id,
+            weight=max(weight, 0.01),
+            future=asyncio.get_running_loop().create_future()
+        )
+        self.waiting.setdefault(user_id, deque()).append(waiter)
+        self._schedule()
+
+        deadline = time.monotonic() + timeout
+        last_position = None
+        try:
+            while not waiter.future.done():
+                position = self.position(waiter)
+                if on_position is not None and position != last_position:
+                    last_position = position
+                    await on_position(position)
+                    if waiter.future.done():
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AdmissionTimeout()
+                # Wake up periodically to refresh the reported position
+                await asyncio.wait((waiter.future,), timeout=min(remaining, 2.0))
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted while giving up - hand the slot back
+                self.release(user_id)
+            else:
+                waiter.future.cancel()
+                self._remove(waiter)
+            raise
+
+    def release(self, user_id: str) -> None:
+        """Free a slot and admit the next waiter"""
+        self.active_total = max(0, self.active_total - 1)
+        count = self.active.get(user_id, 0) - 1
+        if count > 0:
+            self.active[user_id] = count
+        else:
+            self.active.pop(user_id, None)
+        self._schedule()
+
+
+# ==================== IMAGE PREPROCESSING ====================
+
+# Claude downsamples anything past ~1568 px on the long edge or ~1.15 MP
+MAX_IMAGE_PIXELS = 1_150_000
+
+
+def preprocess_image(data: bytes, media_type: str, max_edge: int, quality: int) -> Tuple[bytes, str]:
+    """
+    Downscale an image to the model's effective resolution and re-encode it.
+
+    Opaque images become JPEG, images with transparency stay PNG. The
+    original is returned when it is already small enough, animated, or
+    when re-encoding would not make it smaller. Runs in a worker process.
+    """
+    with Image.open(BytesIO(data)) as img:
+        if getattr(img, "is_animated", False):
+            return data, media_type
+        width, height = img.size
+        scale = min(1.0, max_edge / max(width, height), (MAX_IMAGE_PIXELS / (width * height)) ** 0.5)
+        if scale >= 1.0 and media_type == "image/jpeg":
+            return data, media_type
+
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+        img = img.convert("RGBA" if has_alpha else "RGB")
+        if scale < 1.0:
+            img = img.resize(
+                (max(1, round(width * scale)), max(1, round(height * scale))),
+                Image.LANCZOS
+            )
+
+        out = BytesIO()
+        if has_alpha:
+            img.save(out, format="PNG")
+            encoded_type = "image/png"
+        else:
+            # 4:4:4 chroma keeps coloured text in screenshots sharp
+            img.save(out, format="JPEG", quality=quality, optimize=True, subsampling=0)
+            encoded_type = "image/jpeg"
+
+    encoded = out.getvalue()
+    if scale >= 1.0 and len(encoded) >= len(data):
+        return data, media_type
+    return encoded, encoded_type
+
+
+# ==================== MESSAGE MEMO ====================
+
+
+def content_hash(data: str, known: Dict[str, Optional[str]]) -> str:
+    """
+    SHA-256 of base64 image data.
+
+    ``known`` holds the image strings of a conversation's memoized messages
+    (see ProcessedMessageCache.hashes). Those are the same objects every
+    turn and str objects cache their own hash, so a repeat lookup costs O(1)
+    instead of re-hashing megabytes. Other strings are hashed every time.
+    """
+    digest = known.get(data)
+    if digest is None:
+        digest = hashlib.sha256(data.encode()).hexdigest()
+        if data in known:
+            known[data] = digest
+    return digest
+
+
+class ProcessedMessageCache:
+    """
+    Per-conversation memo of processed messages, keyed by message content.
+
+    A conversation keeps only the messages of its latest turn, so edited or
+    deleted history drops out on the next turn. Whole conversations are
+    evicted least recently used first once the memoized content exceeds
+    the size limit. The SHA-256 of each memoized image is kept with its
+    conversation, so it is bounded by the same limit.
+    """
+
+    def __init__(self):
+        self.conversations: "OrderedDict[str, Tuple[Dict[tuple, Dict[str, Any]], int, Dict[str, Optional[str]]]]" = OrderedDict()
+        self.size = 0
+
+    def get(self, conversation_id: str) -> Dict[tuple, Dict[str, Any]]:
+        entry = self.conversations.get(conversation_id)
+        if entry is None:
+            return {}
+        self.conversations.move_to_end(conversation_id)
+        return entry[0]
+
+    def hashes(self, conversation_id: str) -> Dict[str, Optional[str]]:
+        """Image data of the conversation's memo -> SHA-256 (None until computed), for content_hash"""
+        entry = self.conversations.get(conversation_id)
+        return entry[2] if entry is not None else {}
+
+    def put(self, conversation_id: str, memo: Dict[tuple, Dict[str, Any]], size: int, max_size: int) -> None:
+        old = self.conversations.pop(conversation_id, None)
+        if old is not None:
+            self.size -= old[1]
+        if size > max_size:
+            return
+        old_hashes = old[2] if old is not None else {}
+        hashes = {}
+        for entry in memo.values():
+            for block in entry["content"]:
+                source = block.get("source") or {}
+                if block.get("type") == "image" and source.get("type") == "base64":
+                    hashes[source["data"]] = old_hashes.get(source["data"])
+        self.conversations[conversation_id] = (memo, size, hashes)
+        self.size += size
+        while self.size > max_size:
+            _, (_, evicted_size, _) = self.conversations.popitem(last=False)
+            self.size -= evicted_size
+
+
+# ==================== PAYLOAD ENCODING ====================
+
+
+def freeze(value: Any) -> Any:
+    """Hashable, type-exact key for a JSON value (True, 1 and 1.0 stay distinct)"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return ("{", tuple((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return ("[", tuple(freeze(v) for v in value))
+    return (type(value), value)
+
+
+class PayloadEncoder:
+    """
+    Encodes request payloads to JSON bytes, reusing the encoded bytes of
+    messages, system blocks and tools seen on earlier requests.
+
+    Each turn re-sends the whole history, but only the new tail (and the
+    message that carries the moving cache breakpoint) has to be encoded.
+    Entries are evicted least recently used once the cached bytes exceed
+    the size limit.
+    """
+
+    CACHED_FIELDS = frozenset(("system", "tools"))
+
+    def __init__(self):
+        self.cache: "OrderedDict[Any, bytes]" = OrderedDict()
+        self.size = 0
+
+    def encode(self, payload: Dict[str, Any], max_size: int) -> bytes:
+        if max_size <= 0:
+            return json_dumps(payload)
+        # One flat list and a single join: every intermediate concatenation
+        # of a multi-megabyte body costs a fresh allocation and page faults
+        parts = []
+        for key, value in payload.items():
+            parts.append(b"," if parts else b"{")
+            parts.append(json_dumps(key))
+            parts.append(b":")
+            if key == "messages":
+                parts.append(b"[")
+                for i, message in enumerate(value):
+                    if i:
+                        parts.append(b",")
+                    parts.append(self._encode_cached(message, self._message_key(message), max_size))
+                parts.append(b"]")
+            elif key in self.CACHED_FIELDS:
+                parts.append(self._encode_cached(value, freeze(value), max_size))
+            else:
+                parts.append(json_dumps(value))
+        parts.append(b"}" if parts else b"{}")
+        return b"".join(parts)
+
+    @staticmethod
+    def _message_key(message: Dict[str, Any]) -> Any:
+        """Cheap key for the common {role, content: [text blocks]} shape"""
+        content = message.get("content")
+        if len(message) != 2 or not isinstance(content, list):
+            return freeze(message)
+        parts = [message["role"]]
+        for block in content:
+            if len(block) == 2 and block.get("type") == "text":
+                parts.append(block["text"])
+            else:
+                parts.append(freeze(block))
+        return tuple(parts)
+
+    def _encode_cached(self, value: Any, key: Any, max_size: int) -> bytes:
+        encoded = self.cache.get(key)
+        if encoded is not None:
+            self.cache.move_to_end(key)
+            return encoded
+        encoded = json_dumps(value)
+        if len(encoded) <= max_size:
+            self.cache[key] = encoded
+            self.size += len(encoded)
+            while self.size > max_size:
+                _, evicted = self.cache.popitem(last=False)
+                self.size -= len(evicted)
+        return encoded
+
+
+# ==================== CACHE TTL SELECTION ====================
+
+
+@dataclass(slots=True)
+class ConversationTurns:
+    """Turn timing of one conversation and its pending hit prediction"""
+    last_request: float
+    gaps: Deque[float]
+    prediction: Optional[Tuple[float, int, int]] = None  # (p_hit, static tokens, tail tokens)
+    awaiting: Optional[Tuple[float, int, int]] = None  # Last turn's prediction, checked on this turn
+
+
+class CacheTtlSelector:
+    """
+    Picks the 5-minute or 1-hour cache TTL for each breakpoint.
+
+    The chance that the next request arrives within a TTL is estimated from
+    recent gaps: the conversation's own turns for its document and tail
+    breakpoints (all conversations' turns until it has some), and the gaps
+    between any two requests for the shared tools and system prompt. Each
+    breakpoint gets the TTL with the lower expected cost for the next turn,
+    i.e. the write now plus a read on a hit or a new write on a miss.
+
+    The hit probability predicted for each tail is checked against the
+    cache read the API reports on the conversation's next turn.
+    """
+
+    TTL_SECONDS = {"5m": 300, "1h": 3600}
+    WRITE_PRICE = {"5m": 1.25, "1h": 2.0}  # Multiples of the base input price
+    READ_PRICE = 0.1
+    MAX_GAPS = 16
+    MAX_CONVERSATIONS = 1024
+    REPORT_EVERY = 100
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.conversations: "OrderedDict[str, ConversationTurns]" = OrderedDict()
+        self.turn_gaps: Deque[float] = deque(maxlen=256)  # Pooled prior for new conversations
+        self.request_gaps: Deque[float] = deque(maxlen=256)
+        self.last_request: Optional[float] = None
+        self.predictions = 0
+        self.predicted_hits = 0.0
+        self.actual_hits = 0
+
+    @property
+    def predicted_hit_rate(self) -> Optional[float]:
+        return self.predicted_hits / self.predictions if self.predictions else None
+
+    @property
+    def actual_hit_rate(self) -> Optional[float]:
+        return self.actual_hits / self.predictions if self.predictions else None
+
+    def _turn(self, conversation_id: str, now: float) -> ConversationTurns:
+        turns = self.conversations.pop(conversation_id, None)
+        if turns is None:
+            turns = ConversationTurns(last_request=now, gaps=deque(maxlen=self.MAX_GAPS))
+            if len(self.conversations) >= self.MAX_CONVERSATIONS:
+                self.conversations.popitem(last=False)
+        else:
+            gap = now - turns.last_request
+            turns.gaps.append(gap)
+            self.turn_gaps.append(gap)
+            turns.last_request = now
+        self.conversations[conversation_id] = turns
+        turns.awaiting, turns.prediction = turns.prediction, None
+        return turns
+
+    def _choose(self, gaps: Deque[float], breakpoint: CacheBreakpoint) -> Tuple[str, float]:
+        best = None
+        for ttl, seconds in self.TTL_SECONDS.items():
+            # Add-one-half smoothing keeps a few gaps from giving certainty
+            p_hit = (sum(1 for gap in gaps if gap <= seconds) + 0.5) / (len(gaps) + 1)
+            write = self.WRITE_PRICE[ttl]
+            cost = (
+                write * breakpoint.new_tokens
+                + breakpoint.prefix_tokens * (p_hit * self.READ_PRICE + (1 - p_hit) * write)
+            )
+            if best is None or cost < best[2]:
+                best = (ttl, p_hit, cost)
+        return best[0], best[1]
+
+    def return_probability(self, conversation_id: str, elapsed: float, window: float) -> float:
+        """Chance that a conversation idle for ``elapsed`` seconds gets its next turn within ``window``"""
+        turns = self.conversations.get(conversation_id)
+        gaps = [gap for gap in (turns.gaps if turns is not None else ()) if gap > elapsed]
+        if not gaps:
+            gaps = [gap for gap in self.turn_gaps if gap > elapsed]
+        return (sum(1 for gap in gaps if gap <= elapsed + window) + 0.5) / (len(gaps) + 1)
+
+    def assign(self, conversation_id: Optional[str], plan: List[CacheBreakpoint], default_ttl: str) -> None:
+        """Record a request and set the ttl of each planned breakpoint"""
+        now = self.clock()
+        if self.last_request is not None:
+            self.request_gaps.append(now - self.last_request)
+        self.last_request = now
+
+        turns = self._turn(conversation_id, now) if conversation_id else None
+        turn_gaps = turns.gaps if turns is not None and turns.gaps else self.turn_gaps
+        static_tokens = 0
+        for breakpoint in plan:
+            gaps = self.request_gaps if breakpoint.kind in ("tools", "system") else turn_gaps
+            if not gaps:
+                breakpoint.ttl = default_ttl
+                p_hit = None
+            else:
+                breakpoint.ttl, p_hit = self._choose(gaps, breakpoint)
+            if breakpoint.kind == "tail":
+                if turns is not None and p_hit is not None:
+                    turns.prediction = (p_hit, static_tokens, breakpoint.prefix_tokens)
+            elif breakpoint.kind != "lookback":
+                static_tokens = breakpoint.prefix_tokens
+
+        # A 1-hour entry may not follow a 5-minute one in the prefix
+        long_ttl = False
+        for breakpoint in reversed(plan):
+            long_ttl = long_ttl or breakpoint.ttl == "1h"
+            if long_ttl:
+                breakpoint.ttl = "1h"
+
+    def observe(self, conversation_id: Optional[str], usage: Dict[str, Any]) -> None:
+        """Score last turn's prediction against this turn's reported cache read"""
+        turns = self.conversations.get(conversation_id) if conversation_id else None
+        if turns is None or turns.awaiting is None:
+            return
+        p_hit, static_tokens, tail_tokens = turns.awaiting
+        turns.awaiting = None
+        # Token counts are estimates, so a read past the midpoint between the
+        # shared prefix and last turn's tail counts as reading the tail
+        hit = usage.get("cache_read_input_tokens", 0) >= (static_tokens + tail_tokens) / 2
+        self.predictions += 1
+        self.predicted_hits += p_hit
+        self.actual_hits += hit
+        if self.predictions % self.REPORT_EVERY == 0:
+            logger.info(
+                "Cache TTL selection: predicted hit rate %.0f%%, actual %.0f%% over %d turns",
+                self.predicted_hit_rate * 100, self.actual_hit_rate * 100, self.predictions,
+                extra=log_fields(
+                    "cache_ttl_stats", predicted_hit_rate=self.predicted_hit_rate,
+                    actual_hit_rate=self.actual_hit_rate, turns=self.predictions
+                )
+            )
+
+
+# ==================== CACHE KEEPALIVE ====================
+
+
+@dataclass(slots=True)
+class KeepaliveEntry:
+    """A conversation whose cached prefix may be refreshed before it expires"""
+    body: bytes  # Encoded refresh request: the last turn's prefix with minimal output
+    headers: Dict[str, str]
+    user_id: str
+    prefix_tokens: int
+    ttl: float
+    last_turn: float
+    touched: float  # Last request that read or wrote the cached prefix
+    max_output_tokens: int  # A refresh's max_tokens, i.e. the most output it can bill
+    refreshes: int = 0  # Since the last real turn
+    credit_tokens: int = 0  # Previous turn's prefix, kept alive by refreshes
+
+
+class CacheKeepalive:
+    """
+    Keeps the prompt cache of recently active conversations warm.
+
+    Shortly before a conversation's cached tail expires, the same prefix is
+    sent again with minimal output, which refreshes the entry's TTL. This
+    is done only when the chance that the user returns within the next TTL
+    makes the expected write savings larger than the refresh itself, and
+    only while the global and per-user hourly budgets allow it. A real turn
+    that reads the cache after a refresh is credited with the write and
+    prefill time it avoided.
+    """
+
+    PRICE_INPUT = 3.0 / 1e6  # $ per token (Sonnet 4.5)
+    PRICE_OUTPUT = 15.0 / 1e6
+    PRICE_WEB_SEARCH = 10.0 / 1e3  # $ per search
+    PREFILL_SECONDS_PER_TOKEN = 0.09e-3  # Uncached minus cached prefill time
+    LEAD_SECONDS = 30.0
+    MAX_ENTRIES = 256
+    MAX_BYTES = 64 * 1024 * 1024  # Encoded refresh requests held, all entries
+
+    def __init__(self):
+        self.entries: "OrderedDict[str, KeepaliveEntry]" = OrderedDict()
+        self.size = 0
+        self.budgets: Dict[str, TokenBucket] = {}  # "" = global, else per user
+        self.refreshes = 0
+        self.cost = 0.0
+        self.saved_tokens = 0
+        self.saved_cost = 0.0
+        self.saved_seconds = 0.0
+
+    def track(self, conversation_id: str, entry: KeepaliveEntry) -> None:
+        old = self.entries.pop(conversation_id, None)
+        if old is not None:
+            self.size -= len(old.body)
+            if old.refreshes:
+                entry.credit_tokens = old.prefix_tokens
+        self.entries[conversation_id] = entry
+        self.size += len(entry.body)
+        # The least recently active conversations go first
+        while self.entries and (len(self.entries) > self.MAX_ENTRIES or self.size > self.MAX_BYTES):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+
+    def drop(self, conversation_id: str, entry: Optional[KeepaliveEntry] = None) -> None:
+        """Stop refreshing a conversation (only while it is still ``entry``, if given)"""
+        current = self.entries.get(conversation_id)
+        if current is not None and (entry is None or current is entry):
+            del self.entries[conversation_id]
+            self.size -= len(current.body)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def due(self, now: float, max_idle: float) -> List[Tuple[str, KeepaliveEntry]]:
+        """Entries about to expire; idle or already expired ones are dropped"""
+        due = []
+        for conversation_id, entry in list(self.entries.items()):
+            expires = entry.touched + entry.ttl
+            if now - entry.last_turn > max_idle or now >= expires:
+                self.drop(conversation_id)
+            elif expires - now <= self.LEAD_SECONDS:
+                due.append((conversation_id, entry))
+        return due
+
+    def refresh_cost(self, entry: KeepaliveEntry, p_return: float) -> Optional[float]:
+        """Most a refresh can cost ($), or None when it is not worth it"""
+        write = CacheTtlSelector.WRITE_PRICE["1h" if entry.ttl > 300 else "5m"]
+        cost = (
+            entry.prefix_tokens * CacheTtlSelector.READ_PRICE * self.PRICE_INPUT
+            + entry.max_output_tokens * self.PRICE_OUTPUT
+        )
+        saving = p_return * entry.prefix_tokens * (write - CacheTtlSelector.READ_PRICE) * self.PRICE_INPUT
+        return cost if saving > cost else None
+
+    def _bucket(self, key: str, per_hour: float, now: float) -> TokenBucket:
+        bucket = self.budgets.get(key)
+        if bucket is None or bucket.capacity != per_hour:
+            bucket = TokenBucket()
+            bucket.capacity = bucket.tokens = per_hour
+            bucket.rate = per_hour / 3600
+            bucket.updated = now
+            self.budgets[key] = bucket
+        return bucket
+
+    def affordable(self, user_id: str, cost: float, budget: float, user_budget: float, now: float) -> bool:
+        """Whether both hourly budgets ($) have room for ``cost``"""
+        # wait_time caps the amount at capacity, so a refresh larger than a
+        # whole budget would otherwise pass whenever the bucket is full
+        if cost > min(budget, user_budget):
+            return False
+        return all(
+            bucket.wait_time(cost, now) == 0
+            for bucket in (self._bucket("", budget, now), self._bucket(user_id, user_budget, now))
+        )
+
+    def record_refresh(self, conversation_id: str, entry: KeepaliveEntry, usage: Dict[str, Any], now: float) -> float:
+        """Account a refresh from its reported usage; returns its $ cost"""
+        write = CacheTtlSelector.WRITE_PRICE["1h" if entry.ttl > 300 else "5m"]
+        cache_read = usage.get("cache_read_input_tokens", 0)
+        cost = (
+            usage.get("input_tokens", 0) * self.PRICE_INPUT
+            + cache_read * CacheTtlSelector.READ_PRICE * self.PRICE_INPUT
+            + usage.get("cache_creation_input_tokens", 0) * write * self.PRICE_INPUT
+            + usage.get("output_tokens", 0) * self.PRICE_OUTPUT
+            + (usage.get("server_tool_use") or {}).get("web_search_requests", 0) * self.PRICE_WEB_SEARCH
+        )
+        for key in ("", entry.user_id):
+            if key in self.budgets:
+                self.budgets[key].consume(cost)
+        self.refreshes += 1
+        self.cost += cost
+        entry.refreshes += 1
+        entry.touched = now
+        if not cache_read:
+            # The entry was already gone; this refresh re-wrote it, but one
+            # miss means the TTL estimate is off, so stop here
+            self.drop(conversation_id, entry)
+        return cost
+
+    def observe(self, conversation_id: Optional[str], usage: Dict[str, Any]) -> bool:
+        """Credit a real turn that read a prefix kept alive by refreshes"""
+        entry = self.entries.get(conversation_id) if conversation_id else None
+        if entry is None or not entry.credit_tokens:
+            return False
+        credit, entry.credit_tokens = entry.credit_tokens, 0
+        cache_read = usage.get("cache_read_input_tokens", 0)
+        if cache_read < credit / 2:
+            return False
+        saved = min(cache_read, credit)
+        write = CacheTtlSelector.WRITE_PRICE["1h" if entry.ttl > 300 else "5m"]
+        self.saved_tokens += saved
+        self.saved_cost += saved * (write - CacheTtlSelector.READ_PRICE) * self.PRICE_INPUT
+        self.saved_seconds += saved * self.PREFILL_SECONDS_PER_TOKEN
+        return True
+
+
+# ==================== CACHE WARMUP ====================
+
+
+class SystemPromptRegistry:
+    """
+    Usage counts of the cacheable system prompts sent.
+
+    The most used prompts are what the cache warmup writes ahead of real
+    traffic. Prompts are recorded exactly as sent (after OpenWebUI fills in
+    template variables such as the user's name and memories), because only
+    an identical prefix is a cache hit. Without a ``path`` they are only
+    kept in memory; with one they are stored like FileIdCache: a small JSON
+    file, written atomically when a new prompt appears and on shutdown.
+    """
+
+    MAX_ENTRIES = 32
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.entries: Dict[str, List[Any]] = {}  # sha256 -> [text, count, last_used]
+        self.dirty = False
+        self._loaded = False
+
+    def load(self) -> None:
+        """Read the registry once; a missing or corrupt file starts empty"""
+        if self._loaded or self.path is None:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable system prompt registry %s: %s", self.path, e)
+            return
+        self.entries = {key: list(entry) for key, entry in stored.items()}
+
+    def record(self, text: str) -> bool:
+        """Count one use of a prompt; True when it was not known yet"""
+        key = hashlib.sha256(text.encode()).hexdigest()
+        entry = self.entries.get(key)
+        self.dirty = True
+        if entry is not None:
+            entry[1] += 1
+            entry[2] = time.time()
+            return False
+        self.entries[key] = [text, 1, time.time()]
+        if len(self.entries) > self.MAX_ENTRIES:
+            # Drop the least used (oldest on ties), never the new one
+            victim = min(
+                (k for k in self.entries if k != key),
+                key=lambda k: (self.entries[k][1], self.entries[k][2])
+            )
+            del self.entries[victim]
+        return True
+
+    def top(self, count: int) -> List[str]:
+        ranked = sorted(self.entries.values(), key=lambda entry: (entry[1], entry[2]), reverse=True)
+        return [entry[0] for entry in ranked[:count]]
+
+    def last_used(self, text: str) -> float:
+        """When a prompt was last sent (0 if never)"""
+        entry = self.entries.get(hashlib.sha256(text.encode()).hexdigest())
+        return entry[2] if entry is not None else 0.0
+
+    def save(self) -> None:
+        if not self.dirty or self.path is None:
+            return
+        try:
+            write_json_atomic(self.path, self.entries)
+            self.dirty = False
+        except OSError as e:
+            logger.warning("Could not write system prompt registry %s: %s", self.path, e)
+
+
+# ==================== FILE UPLOAD CACHE ====================
+
+
+def write_json_atomic(path: str, value: Any) -> None:
+    """Write JSON through a temp file and rename, so readers never see half a file"""
+    directory = os.path.dirname(path) or "."
+    tmp_path = None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class FileIdCache:
+    """
+    Persistent content-hash -> Files API file_id index.
+
+    Entries are kept in LRU order and expire after ``ttl`` seconds. The
+    index is a small JSON file written atomically; lookups only touch
+    memory and are persisted with the next upload or on shutdown.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: "OrderedDict[str, List[Any]]" = OrderedDict()  # key -> [file_id, last_used]
+        self.dirty = False
+        self._loaded = False
+
+    def load(self) -> None:
+        """Read the index once; a missing or corrupt file starts empty"""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable file cache index %s: %s", self.path, e)
+            return
+        for key, (file_id, last_used) in sorted(stored.items(), key=lambda kv: kv[1][1]):
+            self.entries[key] = [file_id, last_used]
+
+    def get(self, key: str, ttl: float) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        now = time.time()
+        if ttl > 0 and now - entry[1] > ttl:
+            return None
+        entry[1] = now
+        self.entries.move_to_end(key)
+        self.dirty = True
+        return entry[0]
+
+    def put(self, key: str, file_id: str, max_entries: int, ttl: float) -> List[str]:
+        """Store a file_id; returns the file_ids evicted by TTL or size"""
+        now = time.time()
+        # An expired entry for the same content is replaced, not kept
+        previous = self.entries.get(key)
+        evicted = [previous[0]] if previous is not None and previous[0] != file_id else []
+        self.entries[key] = [file_id, now]
+        self.entries.move_to_end(key)
+        for old_key in [k for k, (_, used) in self.entries.items() if ttl > 0 and now - used > ttl]:
+            evicted.append(self.entries.pop(old_key)[0])
+        while max_entries > 0 and len(self.entries) > max_entries:
+            evicted.append(self.entries.popitem(last=False)[1][0])
+        self.dirty = True
+        return evicted
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        try:
+            write_json_atomic(self.path, self.entries)
+            self.dirty = False
+        except OSError as e:
+            logger.warning("Could not write file cache index %s: %s", self.path, e)
+
+
+# ==================== OUTPUT COALESCING ====================
+
+
+THINK_OPEN = "\n<think>\n"
+THINK_CLOSE = "\n</think>\n\n"
+THINK_CLOSE_FINAL = "\n</think>\n"
+
+# Chunks that mark a structural boundary in the output and are never held back
+STRUCTURAL_CHUNKS = frozenset((THINK_OPEN, THINK_CLOSE, THINK_CLOSE_FINAL))
+
+
+class OutputCoalescer:
+    """
+    Batch small stream chunks into fewer, larger yields.
+
+    Chunks are buffered until ``window`` seconds have passed since the first
+    buffered chunk or ``max_chars`` characters are pending, then emitted as
+    one string.
+    """
+
+    __slots__ = ("window", "max_chars", "_parts", "_size", "_started")
+
+    def __init__(self, window: float, max_chars: int):
+        self.window = window
+        self.max_chars = max_chars
+        self._parts: List[str] = []
+        self._size = 0
+        self._started = 0.0
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._parts)
+
+    def push(self, text: str, force: bool = False) -> Optional[str]:
+        """Buffer a chunk; return the batch if it is due (or forced), else None"""
+        if not self._parts:
+            self._started = time.monotonic()
+        self._parts.append(text)
+        self._size += len(text)
+        if force or self._size >= self.max_chars or time.monotonic() - self._started >= self.window:
+            return self.flush()
+        return None
+
+    def time_left(self) -> Optional[float]:
+        """Seconds until the pending batch is due (None if nothing is pending)"""
+        if not self._parts:
+            return None
+        return max(0.0, self._started + self.window - time.monotonic())
+
+    def flush(self) -> str:
+        """Return and clear everything buffered"""
+        text = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        return text
 
 
 # ==================== MAIN PIPE CLASS ====================
 
+DOMAIN_FILTER_CONFLICT = "Cannot use both allowed_domains and blocked_domains. Please use only one."
+
 
 class Pipe:
     """Claude Sonnet 4.5 Complete Integration for OpenWebUI"""
@@ -89,6 +1453,124 @@ class Pipe:
             default=300,
             description="API request timeout in seconds"
         )
+        STREAM_IDLE_TIMEOUT: float = Field(
+            default=60.0,
+            description="Seconds without stream data before a stream counts as stalled (0 = use REQUEST_TIMEOUT)"
+        )
+        STREAM_STALL_RETRIES: int = Field(
+            default=2,
+            description="Times a stalled stream is reconnected and continued from the text already shown (0 = off)"
+        )
+
+        # Connection Pool
+        HTTP_POOL_MAX_CONNECTIONS: int = Field(
+            default=100,
+            description="Maximum concurrent connections to the Anthropic API"
+        )
+        HTTP_POOL_MAX_KEEPALIVE: int = Field(
+            default=20,
+            description="Maximum idle keep-alive connections kept in the pool"
+        )
+        HTTP_KEEPALIVE_EXPIRY: float = Field(
+            default=30.0,
+            description="Seconds an idle keep-alive connection is kept open"
+        )
+        ENABLE_HTTP2: bool = Field(
+            default=False,
+            description="Multiplex requests over HTTP/2 (requires the 'h2' package)"
+        )
+
+        # Retries
+        RETRY_MAX_ATTEMPTS: int = Field(
+            default=3,
+            description="Retries for overloaded (529), rate limited (429), 5xx and connection errors (0 = off)"
+        )
+        RETRY_BASE_DELAY: float = Field(
+            default=0.5,
+            description="Initial backoff in seconds, doubled per attempt with jitter"
+        )
+        RETRY_MAX_DELAY: float = Field(
+            default=20.0,
+            description="Longest single wait in seconds; longer retry-after hints are not waited out"
+        )
+        RETRY_BUDGET_SECONDS: float = Field(
+            default=60.0,
+            description="Total time a request may spend waiting between retries"
+        )
+
+        # Admission Control
+        MAX_CONCURRENT_REQUESTS: int = Field(
+            default=64,
+            description="Maximum upstream requests in flight on this worker (0 = unlimited)"
+        )
+        MAX_CONCURRENT_PER_USER: int = Field(
+            default=3,
+            description="Maximum upstream requests in flight per user (0 = unlimited)"
+        )
+        ADMIN_QUEUE_WEIGHT: float = Field(
+            default=1.0,
+            description="Fair-queuing weight of admins relative to regular users (1.0 = equal share)"
+        )
+        QUEUE_TIMEOUT: float = Field(
+            default=120.0,
+            description="Seconds a request may wait for a free slot before failing"
+        )
+
+        # Client-side Rate Limiting
+        ENABLE_RATE_LIMITER: bool = Field(
+            default=True,
+            description="Pace requests using the anthropic-ratelimit-* headers to avoid 429s"
+        )
+        RATE_LIMIT_MAX_WAIT: float = Field(
+            default=30.0,
+            description="Longest a request waits for rate-limit capacity before being sent anyway"
+        )
+
+        # Message Processing
+        MESSAGE_CACHE_MAX_MB: float = Field(
+            default=64.0,
+            description="Memory for memoized processed messages across conversations, in MB of message text (0 = off)"
+        )
+        PAYLOAD_CACHE_MAX_MB: float = Field(
+            default=32.0,
+            description="Memory for pre-encoded JSON of already-sent messages, system prompts and tools (0 = off)"
+        )
+
+        # Image Preprocessing
+        ENABLE_IMAGE_PREPROCESSING: bool = Field(
+            default=True,
+            description="Downscale and recompress pasted images before sending (requires Pillow)"
+        )
+        IMAGE_MAX_EDGE: int = Field(
+            default=1568,
+            description="Longest image edge in pixels; larger images are downscaled"
+        )
+        IMAGE_JPEG_QUALITY: int = Field(
+            default=85,
+            description="JPEG quality used when re-encoding opaque images (1-95)"
+        )
+        IMAGE_PREPROCESS_WORKERS: int = Field(
+            default=2,
+            description="Worker processes for image preprocessing (0 = use a thread)"
+        )
+
+        # Image Upload Cache
+        ENABLE_IMAGE_FILE_CACHE: bool = Field(
+            default=False,
+            description="Upload pasted images once via the Files API and reference them by file_id on later turns"
+        )
+        IMAGE_CACHE_MAX_ENTRIES: int = Field(
+            default=1000,
+            description="Image hashes remembered in the local file_id index (least recently used are evicted)"
+        )
+        IMAGE_CACHE_TTL_HOURS: float = Field(
+            default=168.0,
+            description="Hours a cached file_id is reused after its last use (0 = no expiry)"
+        )
+        IMAGE_CACHE_PATH: str = Field(
+            default="",
+            description="Path of the file_id index (empty = anthropic_file_cache.json in DATA_DIR or the temp dir)"
+        )
 
         # Extended Thinking
         ENABLE_EXTENDED_THINKING: bool = Field(
@@ -105,17 +1587,49 @@ class Pipe:
             default=True,
             description="Enable prompt caching (reduces cost up to 90%)"
         )
-        CACHE_TTL: Literal["5min", "1hour"] = Field(
-            default="5min",
-            description="Cache duration: 5min (cheaper) or 1hour (longer sessions)"
+        CACHE_TTL: Literal["5min", "1hour", "auto"] = Field(
+            default="auto",
+            description="Cache duration: 5min (cheaper), 1hour (longer sessions) or auto (per breakpoint, from each conversation's reply pace)"
         )
         CACHE_SYSTEM_PROMPT: bool = Field(
             default=True,
             description="Automatically cache system prompts"
         )
+        CACHE_TOOLS: bool = Field(
+            default=True,
+            description="Cache the tools array (shared by every conversation with the same tools)"
+        )
         CACHE_USER_MESSAGES: bool = Field(
             default=True,
-            description="Cache recent user messages for stable cache points"
+            description="Cache the conversation (document prefix and rolling tail)"
+        )
+        ENABLE_CACHE_KEEPALIVE: bool = Field(
+            default=False,
+            description="Refresh the cache of recently active conversations shortly before it expires"
+        )
+        CACHE_KEEPALIVE_MAX_IDLE_MINUTES: float = Field(
+            default=20.0,
+            description="Stop refreshing a conversation this many minutes after its last turn"
+        )
+        CACHE_KEEPALIVE_BUDGET_USD: float = Field(
+            default=1.0,
+            description="Keepalive spend cap per hour across all users ($)"
+        )
+        CACHE_KEEPALIVE_USER_BUDGET_USD: float = Field(
+            default=0.25,
+            description="Keepalive spend cap per hour for each user ($)"
+        )
+        ENABLE_CACHE_WARMUP: bool = Field(
+            default=False,
+            description="Write the most used system prompts and the tools to the prompt cache at startup and after valve changes"
+        )
+        CACHE_WARMUP_MAX_PROMPTS: int = Field(
+            default=3,
+            description="Number of most used system prompts to warm"
+        )
+        CACHE_WARMUP_PERSIST_PROMPTS: bool = Field(
+            default=False,
+            description="Save the most used system prompts under DATA_DIR so a restart can warm them (stored as sent, including user names and memories)"
         )
 
         # Web Search
@@ -176,11 +1690,40 @@ class Pipe:
             description="Display token usage statistics"
         )
 
+        # Stream Output
+        STREAM_COALESCE_MS: int = Field(
+            default=40,
+            description="Batch streamed text for up to this many milliseconds per update (0 = send every delta)"
+        )
+        STREAM_COALESCE_MAX_CHARS: int = Field(
+            default=1024,
+            description="Send a batch early once this many characters are pending"
+        )
+
         # Logging
+        DEBUG_EVENT_BUFFER_SIZE: int = Field(
+            default=0,
+            description="Keep the last N raw stream events and log them when a stream fails (0 = off)"
+        )
         LOG_LEVEL: Literal["DEBUG", "INFO", "WARNING", "ERROR"] = Field(
-            default="DEBUG",
+            default="INFO",
             description="Logging verbosity level"
         )
+        LOG_EVENT_SAMPLE_RATE: int = Field(
+            default=100,
+            description="At DEBUG, log one in N stream events (1 = every event)"
+        )
+        LOG_NONBLOCKING: bool = Field(
+            default=True,
+            description="Write log records from a background thread instead of the event loop"
+        )
+
+        @model_validator(mode="after")
+        def _check_domain_filters(self):
+            """Reject conflicting web search domain filters when valves are saved"""
+            if self.WEB_SEARCH_DOMAIN_ALLOWLIST and self.WEB_SEARCH_DOMAIN_BLOCKLIST:
+                raise ValueError(DOMAIN_FILTER_CONFLICT)
+            return self
 
     class UserValves(BaseModel):
         """Per-user configurable settings"""
@@ -196,8 +1739,21 @@ class Pipe:
 
     API_VERSION = "2023-06-01"
     API_BASE_URL = "https://api.anthropic.com/v1"
+    FILES_API_BETA = "files-api-2025-04-14"
+    # Evicted uploads are deleted this long after eviction, so requests
+    # (and their retries) that looked them up earlier can still send them
+    FILE_DELETE_DELAY_SECONDS = 900.0
+    EXTENDED_CACHE_TTL_BETA = "extended-cache-ttl-2025-04-11"
     MODEL_ID = "claude-sonnet-4-5-20250929"
 
+    # Prompt caching limits: breakpoints per request, minimum cacheable prefix
+    # (Sonnet / Opus) and how many blocks the API searches back from a
+    # breakpoint for an earlier cache entry
+    CACHE_MAX_BREAKPOINTS = 4
+    CACHE_MIN_TOKENS = 1024
+    CACHE_LOOKBACK_BLOCKS = 20
+    CACHE_BREAKPOINT_PRIORITY = ("tail", "lookback", "system", "document", "tools")
+
     def __init__(self):
         self.type = "manifold"
         self.id = "claude_complete_v4"
@@ -209,14 +1765,114 @@ class Pipe:
         )
         self.user_valves = self.UserValves()
 
-        # Set logging level
-        log_level = getattr(logging, self.valves.LOG_LEVEL)
-        logger.setLevel(log_level)
+        # Shared HTTP client, created lazily on first request
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_config: Optional[tuple] = None
+        self._retired_clients: List[httpx.AsyncClient] = []
+
+        # Shared view of the organization's rate limits
+        self._rate_limiter = RateLimiter()
+
+        # Global / per-user concurrency caps
+        self._admission = AdmissionController()
+
+        # Request profiles for the current valves, keyed by user valves
+        self._profiles: Dict[tuple, RequestProfile] = {}
+        self._profile_valves: Optional[tuple] = None
+
+        # Stream event dispatch tables (see STREAM EVENT HANDLERS)
+        self._event_handlers = self._bind_handlers(self.EVENT_HANDLERS)
+        self._block_start_handlers = self._bind_handlers(self.BLOCK_START_HANDLERS)
+        self._block_stop_handlers = self._bind_handlers(self.BLOCK_STOP_HANDLERS)
+        self._delta_handlers = self._bind_handlers(self.DELTA_HANDLERS)
+
+        # Processed messages of recent conversations, reused across turns
+        self._message_cache = ProcessedMessageCache()
+        self._payload_encoder = PayloadEncoder()
+
+        # Reply pace per conversation, for CACHE_TTL "auto" and the keepalive
+        self._cache_ttl = CacheTtlSelector()
+        self._keepalive = CacheKeepalive()
+        self._keepalive_task: Optional[asyncio.Task] = None
+
+        # Cache warmup: system prompts in use, valves last warmed for
+        self._prompt_registry: Optional[SystemPromptRegistry] = None
+        self._warmup_valves: Optional[tuple] = None
+        self._warmup_task: Optional[asyncio.Task] = None
+
+        # Image preprocessing workers and results memoized by content hash
+        self._image_executor: Optional[Executor] = None
+        self._image_executor_workers: Optional[int] = None
+        self._image_processes_broken = False
+        self._processed_images: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+
+        # Content hash -> Files API file_id, loaded on first use; evicted
+        # file_ids -> when they may be deleted
+        self._file_cache: Optional[FileIdCache] = None
+        self._pending_deletes: Dict[str, float] = {}
+        self._delete_task: Optional[asyncio.Task] = None
+
+        # Streams torn down because the client went away: estimated output
+        # tokens not generated, and the max_tokens-based upper bound
+        self.aborted_streams = 0
+        self.aborted_tokens_saved = 0
+        self.aborted_tokens_saved_max = 0
+        # Output tokens of recently completed streams, for that estimate
+        self._output_lengths: Deque[int] = deque(maxlen=200)
+
+        # Logging setup, re-applied when the logging valves change
+        self._log_config: Optional[tuple] = None
+        self._configure_logging()
+
+        logger.info("Claude Sonnet 4.5 Complete v4.0.0 initialized (json=%s)", JSON_BACKEND)
+
+    def _configure_logging(self) -> None:
+        """
+        Apply LOG_LEVEL and, with LOG_NONBLOCKING, route this module's records
+        through a queue drained by a background thread into the root handlers.
+        """
+        config = (self.valves.LOG_LEVEL, self.valves.LOG_NONBLOCKING)
+        if config == self._log_config:
+            return
+        self._log_config = config
+
+        logger.setLevel(getattr(logging, self.valves.LOG_LEVEL))
+
+        self._stop_log_listener()
+
+        if self.valves.LOG_NONBLOCKING:
+            targets = logging.getLogger().handlers
+            if not targets:
+                return
+            log_queue: queue.SimpleQueue = queue.SimpleQueue()
+            handler = QueueHandler(log_queue)
+            # Kept on the handler (as logging.config does on 3.12+) so a
+            # later instance can find and stop it
+            handler.listener = QueueListener(log_queue, *targets, respect_handler_level=True)
+            handler.listener.start()
+            logger.addHandler(handler)
+            logger.propagate = False
+
+    def _stop_log_listener(self) -> None:
+        """
+        Remove the queue handler and flush and stop its writer thread.
 
-        logger.info("Claude Sonnet 4.5 Complete v4.0.0 initialized")
+        Also covers one installed by a previously loaded copy of this module:
+        OpenWebUI reloads a function under the same module name, so the new
+        Pipe shares the logger but not the old instance's attributes.
+        """
+        for handler in list(logger.handlers):
+            if isinstance(handler, QueueHandler):
+                logger.removeHandler(handler)
+                listener = getattr(handler, "listener", None)
+                if listener is not None:
+                    listener.stop()
+        logger.propagate = True
 
     def pipes(self) -> List[Dict[str, str]]:
         """Return available model configurations"""
+        # OpenWebUI lists models at startup and after valve saves
+        self._schedule_cache_warmup()
         return [
             {
                 "id": "claude-sonnet-4.5-complete",
@@ -226,6 +1882,34 @@ class Pipe:
 
     # ==================== HELPER METHODS ====================
 
+    def _get_profile(self, user_valves) -> RequestProfile:
+        """
+        Return the request profile for the current valves.
+
+        The valve values are the cache key, so a save in the admin UI (or any
+        in-place change) rebuilds the profiles on the next request.
+        """
+        valves_key = tuple(self.valves.__dict__.values())
+        if valves_key != self._profile_valves:
+            # Validators do not run on in-place assignment, so check here too
+            if self.valves.WEB_SEARCH_DOMAIN_ALLOWLIST and self.valves.WEB_SEARCH_DOMAIN_BLOCKLIST:
+                raise ValueError(DOMAIN_FILTER_CONFLICT)
+            self._profiles = {}
+            self._profile_valves = valves_key
+
+        user_key = tuple(user_valves.__dict__.values())
+        profile = self._profiles.get(user_key)
+        if profile is None:
+            thinking = self._configure_thinking()
+            profile = RequestProfile(
+                headers=MappingProxyType(self._get_headers(user_valves)),
+                tools=tuple(self._configure_tools(user_valves)),
+                thinking=MappingProxyType(thinking) if thinking else None
+            )
+            self._profiles[user_key] = profile
+            logger.debug("Built request profile: tools=%d, thinking=%s", len(profile.tools), bool(thinking))
+        return profile
+
     def _should_enable_code_execution(self, user_valves) -> bool:
         """Check if code execution should be enabled"""
         if not user_valves.ENABLE_MY_CODE_EXECUTION:
@@ -259,8 +1943,9 @@ class Pipe:
         # Prompt caching
         if self.valves.ENABLE_PROMPT_CACHING:
             betas.append("prompt-caching-2024-07-31")
+            # "auto" adds it per request, only when a 1-hour marker is used
             if self.valves.CACHE_TTL == "1hour":
-                betas.append("extended-cache-ttl-2025-04-11")
+                betas.append(self.EXTENDED_CACHE_TTL_BETA)
 
         # Web search
         if self.valves.ENABLE_WEB_SEARCH and user_valves.ENABLE_MY_WEB_SEARCH:
@@ -270,7 +1955,7 @@ class Pipe:
         if self._should_enable_code_execution(user_valves):
             betas.append("code-execution-2025-08-25")
             betas.append("skills-2025-10-02")
-            betas.append("files-api-2025-04-14")
+            betas.append(self.FILES_API_BETA)
 
         # Interleaved thinking (only when thinking + tools both enabled)
         if self.valves.ENABLE_EXTENDED_THINKING and self._has_tools(user_valves):
@@ -284,7 +1969,7 @@ class Pipe:
 
         if betas:
             headers["anthropic-beta"] = ",".join(betas)
-            logger.debug(f"Beta headers: {headers['anthropic-beta']}")
+            logger.debug("Beta headers: %s", headers["anthropic-beta"])
 
         return headers
 
@@ -319,7 +2004,7 @@ class Pipe:
                     tool["blocked_domains"] = domains
 
             tools.append(tool)
-            logger.debug(f"Web search tool configured: max_uses={tool['max_uses']}")
+            logger.debug("Web search tool configured: max_uses=%d", tool["max_uses"])
 
         # Code execution with skills
         if self._should_enable_code_execution(user_valves):
@@ -351,7 +2036,7 @@ class Pipe:
 
             if skill_ids:
                 tool["container"] = {"skill_ids": skill_ids}
-                logger.debug(f"Skills configured: {skill_ids}")
+                logger.debug("Skills configured: %s", skill_ids)
 
             tools.append(tool)
 
@@ -365,23 +2050,23 @@ class Pipe:
         # Clamp budget to recommended range
         budget = max(1024, min(self.valves.THINKING_BUDGET_TOKENS, 16000))
 
-        logger.debug(f"Extended thinking enabled with budget: {budget} tokens")
+        logger.debug("Extended thinking enabled with budget: %d tokens", budget)
         return {
             "type": "enabled",
             "budget_tokens": budget
         }
 
-    def _calculate_max_tokens(self, requested_max: int) -> int:
+    def _calculate_max_tokens(self, requested_max: int, thinking: Optional[Mapping[str, Any]]) -> int:
         """
         Calculate appropriate max_tokens accounting for thinking budget.
 
         With extended thinking: max_tokens must accommodate both thinking and response.
         Without thinking: just use the requested amount (capped at 8192).
         """
-        if not self.valves.ENABLE_EXTENDED_THINKING:
+        if not thinking:
             return min(requested_max, 8192)
 
-        thinking_budget = max(1024, min(self.valves.THINKING_BUDGET_TOKENS, 16000))
+        thinking_budget = thinking["budget_tokens"]
 
         # Reserve at least 2000 tokens for the actual response
         min_required = thinking_budget + 2000
@@ -391,60 +2076,185 @@ class Pipe:
         result = min(calculated, 8192)
 
         logger.debug(
-            f"Max tokens calculation: requested={requested_max}, "
-            f"thinking_budget={thinking_budget}, result={result}"
+            "Max tokens calculation: requested=%s, thinking_budget=%d, result=%d",
+            requested_max, thinking_budget, result
         )
         return result
 
-    def _apply_caching(self, payload: Dict[str, Any]) -> Dict[str, Any]:
-        """
-        Apply prompt caching breakpoints to system prompt and user messages.
+    @staticmethod
+    def _cache_control(ttl: str) -> Dict[str, str]:
+        """cache_control marker for a "5m" or "1h" TTL"""
+        if ttl == "1h":
+            return {"type": "ephemeral", "ttl": "1h"}
+        return {"type": "ephemeral"}
+
+    @staticmethod
+    def _uses_extended_cache_ttl(payload: Dict[str, Any]) -> bool:
+        """Whether any block carries a 1-hour marker (markers only go on last blocks)"""
+        blocks = []
+        if payload.get("tools"):
+            blocks.append(payload["tools"][-1])
+        if isinstance(payload.get("system"), list):
+            blocks.extend(payload["system"])
+        for message in payload.get("messages", []):
+            if isinstance(message["content"], list) and message["content"]:
+                blocks.append(message["content"][-1])
+        return any(block.get("cache_control", {}).get("ttl") == "1h" for block in blocks)
+
+    @staticmethod
+    def _add_beta(headers: Dict[str, str], beta: str) -> None:
+        betas = headers.get("anthropic-beta", "")
+        if beta not in betas:
+            headers["anthropic-beta"] = f"{betas},{beta}" if betas else beta
+
+    def _message_tokens(self, message: Dict[str, Any]) -> int:
+        """_estimate_tokens for one message, with a fast path for text blocks"""
+        content = message.get("content")
+        if isinstance(content, str):
+            return len(content) // 4
+        tokens = 0
+        for block in content or ():
+            block_type = block.get("type")
+            if block_type == "text":
+                tokens += len(block.get("text", "")) // 4
+            elif block_type == "image":
+                tokens += self.IMAGE_TOKEN_ESTIMATE
+            else:
+                tokens += self._estimate_tokens(block)
+        return tokens
+
+    @staticmethod
+    def _count_cache_markers(payload: Dict[str, Any]) -> int:
+        """cache_control markers the client already placed"""
+        count = 0
+        for key in ("tools", "system"):
+            value = payload.get(key)
+            if isinstance(value, list):
+                count += sum(1 for block in value if "cache_control" in block)
+        for message in payload.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, list):
+                count += sum(1 for block in content if "cache_control" in block)
+        return count
 
-        Caching strategy:
-        1. Cache last item in system prompt array
-        2. Cache 2nd-to-last user message (creates stable cache point)
+    def _plan_cache_breakpoints(self, payload: Dict[str, Any]) -> List[CacheBreakpoint]:
         """
-        if not self.valves.ENABLE_PROMPT_CACHING:
-            return payload
-
-        cache_control = {"type": "ephemeral"}
-        cache_points = 0
-
-        # Cache system prompt
-        if self.valves.CACHE_SYSTEM_PROMPT and "system" in payload:
-            system_content = payload["system"]
-
-            if isinstance(system_content, str):
-                # Convert string to array with cache control
-                payload["system"] = [{
-                    "type": "text",
-                    "text": system_content,
-                    "cache_control": cache_control
-                }]
-                cache_points += 1
-            elif isinstance(system_content, list) and len(system_content) > 0:
-                # Add cache control to last item
-                payload["system"][-1]["cache_control"] = cache_control
-                cache_points += 1
-
-        # Cache user messages (2nd-to-last user message)
+        Choose where the cache_control markers go.
+
+        The cached prefix runs tools -> system -> messages. Candidates are
+        the end of the tools, the end of the system prompt, the first large
+        user message (a pasted document or RAG context), the current user
+        turn (the rolling tail the next turn reads back) and, when more
+        blocks than the API's lookback window separate them, the previous
+        user turn. Prefixes below the minimum cacheable size are skipped and
+        the rest are ranked tail > lookback > system > document > tools, up
+        to the four breakpoints the API allows.
+        """
+        budget = self.CACHE_MAX_BREAKPOINTS - self._count_cache_markers(payload)
+        if budget <= 0:
+            return []
+
+        candidates = []
+        tokens = 0
+        if payload.get("tools"):
+            tokens += self._estimate_tokens(payload["tools"])
+            if self.valves.CACHE_TOOLS:
+                candidates.append(CacheBreakpoint("tools", tokens))
+        if payload.get("system"):
+            tokens += self._estimate_tokens(payload["system"])
+            if self.valves.CACHE_SYSTEM_PROMPT and self._can_mark(payload["system"]):
+                candidates.append(CacheBreakpoint("system", tokens))
+
+        messages = payload.get("messages", [])
         if self.valves.CACHE_USER_MESSAGES:
-            messages = payload.get("messages", [])
-            user_message_indices = [
-                i for i, m in enumerate(messages) if m["role"] == "user"
+            ends = []  # Prefix tokens up to the end of each message
+            document = None
+            for i, message in enumerate(messages):
+                message_tokens = self._message_tokens(message)
+                tokens += message_tokens
+                ends.append(tokens)
+                if (document is None and message["role"] == "user"
+                        and message_tokens >= self.CACHE_MIN_TOKENS and self._can_mark(message["content"])):
+                    document = i
+
+            user_indices = [
+                i for i, m in enumerate(messages)
+                if m["role"] == "user" and m.get("content") and self._can_mark(m["content"])
             ]
+            if user_indices:
+                tail = user_indices[-1]
+                previous = user_indices[-2] if len(user_indices) > 1 else None
+                if document is not None and document < (tail if previous is None else previous):
+                    candidates.append(CacheBreakpoint("document", ends[document], document))
+                if previous is not None:
+                    blocks = sum(
+                        len(m["content"]) if isinstance(m["content"], list) else 1
+                        for m in messages[previous + 1:tail + 1]
+                    )
+                    if blocks >= self.CACHE_LOOKBACK_BLOCKS:
+                        candidates.append(CacheBreakpoint("lookback", ends[previous], previous))
+                new_tokens = ends[tail] - (ends[previous] if previous is not None else 0)
+                candidates.append(CacheBreakpoint("tail", ends[tail], tail, new_tokens))
+
+        candidates = [c for c in candidates if c.prefix_tokens >= self.CACHE_MIN_TOKENS]
+        if len(candidates) > budget:
+            candidates.sort(key=lambda c: self.CACHE_BREAKPOINT_PRIORITY.index(c.kind))
+            candidates = sorted(candidates[:budget], key=lambda c: c.prefix_tokens)
+        return candidates
+
+    @staticmethod
+    def _can_mark(content: Any) -> bool:
+        """Whether a cache marker fits: a string, or a list ending in a block"""
+        return isinstance(content, str) or (
+            isinstance(content, list) and bool(content) and isinstance(content[-1], dict)
+        )
 
-            # Need at least 2 user messages to cache the 2nd-to-last
-            if len(user_message_indices) >= 2:
-                idx = user_message_indices[-2]
-                content = messages[idx]["content"]
-
-                if isinstance(content, list) and len(content) > 0:
-                    # Add cache control to last content block of this message
-                    messages[idx]["content"][-1]["cache_control"] = cache_control
-                    cache_points += 1
+    def _apply_caching(
+        self, payload: Dict[str, Any], conversation_id: Optional[str] = None, background: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Place the planned cache breakpoints (see _plan_cache_breakpoints).
+
+        With CACHE_TTL "auto" each breakpoint's TTL comes from the
+        conversation's reply pace (see CacheTtlSelector). Background
+        requests (OpenWebUI's title, tag and follow-up tasks) arrive right
+        after a turn, so they keep the 5-minute default instead of being
+        counted as turns. Marked blocks are
+        replaced by copies: tools come from the shared request profile and
+        pass-through blocks from the caller's body.
+        """
+        if not self.valves.ENABLE_PROMPT_CACHING:
+            return payload
 
-        logger.debug(f"Applied {cache_points} cache breakpoints")
+        plan = self._plan_cache_breakpoints(payload)
+        if self.valves.CACHE_TTL == "auto" and not background:
+            self._cache_ttl.assign(conversation_id, plan, default_ttl="5m")
+        elif self.valves.CACHE_TTL == "1hour":
+            for breakpoint in plan:
+                breakpoint.ttl = "1h"
+        for breakpoint in plan:
+            cache_control = self._cache_control(breakpoint.ttl)
+            if breakpoint.kind == "tools":
+                payload["tools"][-1] = {**payload["tools"][-1], "cache_control": cache_control}
+            elif breakpoint.kind == "system":
+                system = payload["system"]
+                if isinstance(system, str):
+                    payload["system"] = [{"type": "text", "text": system, "cache_control": cache_control}]
+                else:
+                    payload["system"] = system[:-1] + [{**system[-1], "cache_control": cache_control}]
+            else:
+                message = payload["messages"][breakpoint.message_index]
+                content = message["content"]
+                if isinstance(content, str):
+                    message["content"] = [{"type": "text", "text": content, "cache_control": cache_control}]
+                else:
+                    content[-1] = {**content[-1], "cache_control": cache_control}
+
+        if plan:
+            logger.debug(
+                "Cache breakpoints: %s",
+                ", ".join(f"{b.kind}@{b.prefix_tokens}/{b.ttl}" for b in plan)
+            )
         return payload
 
     def _prepare_payload(
@@ -452,7 +2262,9 @@ class Pipe:
         body: Dict[str, Any],
         processed_messages: List[Dict[str, Any]],
         system_message: Optional[str],
-        user_valves
+        profile: RequestProfile,
+        conversation_id: Optional[str] = None,
+        background: bool = False
     ) -> Dict[str, Any]:
         """Assemble the complete API request payload"""
 
@@ -461,7 +2273,7 @@ class Pipe:
             "model": self.MODEL_ID,
             "messages": processed_messages,
             "max_tokens": self._calculate_max_tokens(
-                body.get("max_tokens", self.valves.DEFAULT_MAX_TOKENS)
+                body.get("max_tokens", self.valves.DEFAULT_MAX_TOKENS), profile.thinking
             ),
             "stream": body.get("stream", True)
         }
@@ -487,17 +2299,15 @@ class Pipe:
             payload["system"] = system_message
 
         # Extended thinking
-        thinking_config = self._configure_thinking()
-        if thinking_config:
-            payload["thinking"] = thinking_config
+        if profile.thinking:
+            payload["thinking"] = dict(profile.thinking)
 
         # Tools
-        tools = self._configure_tools(user_valves)
-        if tools:
-            payload["tools"] = tools
+        if profile.tools:
+            payload["tools"] = list(profile.tools)
 
         # Apply caching last (after all content is in place)
-        payload = self._apply_caching(payload)
+        payload = self._apply_caching(payload, conversation_id, background)
 
         return payload
 
@@ -532,7 +2342,7 @@ class Pipe:
                 # Extract media type (e.g., "image/png")
                 media_type = header.split(";")[0].split(":")[1]
 
-                logger.debug(f"Transformed base64 image with media_type={media_type}")
+                logger.debug("Transformed base64 image with media_type=%s", media_type)
                 return {
                     "type": "image",
                     "source": {
@@ -542,7 +2352,7 @@ class Pipe:
                     }
                 }
             except (ValueError, IndexError) as e:
-                logger.warning(f"Malformed data URL: {e}, defaulting to image/jpeg")
+                logger.warning("Malformed data URL: %s, defaulting to image/jpeg", e)
                 # Fallback: try to extract just the data part
                 data = url.split(",", 1)[-1] if "," in url else ""
                 return {
@@ -555,7 +2365,7 @@ class Pipe:
                 }
         else:
             # Regular URL
-            logger.debug(f"Transformed URL image: {url[:50]}...")
+            logger.debug("Transformed URL image: %.50s...", url)
             return {
                 "type": "image",
                 "source": {
@@ -564,42 +2374,651 @@ class Pipe:
                 }
             }
 
+    def _process_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert one OpenWebUI message to Anthropic content blocks"""
+        content = message.get("content")
+        processed_content = []
+
+        if isinstance(content, list):
+            for item in content:
+                item_type = item.get("type")
+                if item_type == "text":
+                    processed_content.append({
+                        "type": "text",
+                        "text": item.get("text", "")
+                    })
+                elif item_type == "image_url":
+                    # Transform OpenAI format to Anthropic format
+                    transformed = self._transform_image_content(item)
+                    processed_content.append(transformed)
+                    logger.debug("Transformed image_url to Anthropic image format")
+                else:
+                    # Pass through other types as-is
+                    processed_content.append(item)
+        else:
+            processed_content = [{"type": "text", "text": str(content)}]
+
+        return {
+            "role": message["role"],
+            "content": processed_content
+        }
+
+    @staticmethod
+    def _message_key(message: Dict[str, Any]) -> Optional[tuple]:
+        """
+        Hashable content key of a message with images, else None.
+
+        Plain text is cheaper to rebuild than to hash, so only messages
+        carrying image_url parts are memoized.
+        """
+        content = message.get("content")
+        if not isinstance(content, list):
+            return None
+        parts = [message["role"]]
+        has_image = False
+        for item in content:
+            item_type = item.get("type")
+            if item_type == "text":
+                parts.append(item.get("text", ""))
+            elif item_type == "image_url":
+                parts.append(("image_url", item.get("image_url", {}).get("url", "")))
+                has_image = True
+            else:
+                return None
+        return tuple(parts) if has_image else None
+
     def _process_messages(
-        self, messages: List[Dict[str, Any]]
+        self, messages: List[Dict[str, Any]], conversation_id: Optional[str] = None, memoize: bool = True
     ) -> List[Dict[str, Any]]:
-        """Process messages to handle different content types"""
+        """
+        Process messages to handle different content types.
+
+        Messages with images that were processed on an earlier turn of the
+        conversation are reused from a memo keyed by their content, so data
+        URLs are only parsed once and later stages see the same image data
+        objects every turn. Blocks are handed out as shallow copies because
+        those stages (caching, image handling) modify them.
+
+        ``memoize=False`` bypasses the memo, for requests that share the
+        conversation's id but not its messages (OpenWebUI's title, tag and
+        follow-up tasks): storing theirs would replace the chat's memo.
+        """
+        max_size = int(self.valves.MESSAGE_CACHE_MAX_MB * 1024 * 1024)
+        if max_size <= 0 or not memoize:
+            return [self._process_message(message) for message in messages]
+
+        conversation_id = conversation_id or ""
+        memo = self._message_cache.get(conversation_id)
+        turn_memo: Dict[tuple, Dict[str, Any]] = {}
+        size = 0
+        hits = 0
         processed = []
 
         for message in messages:
-            content = message.get("content")
-            processed_content = []
-
-            if isinstance(content, list):
-                for item in content:
-                    item_type = item.get("type")
-                    if item_type == "text":
-                        processed_content.append({
-                            "type": "text",
-                            "text": item.get("text", "")
-                        })
-                    elif item_type == "image_url":
-                        # Transform OpenAI format to Anthropic format
-                        transformed = self._transform_image_content(item)
-                        processed_content.append(transformed)
-                        logger.debug("Transformed image_url to Anthropic image format")
-                    else:
-                        # Pass through other types as-is
-                        processed_content.append(item)
+            key = self._message_key(message)
+            if key is None:
+                processed.append(self._process_message(message))
+                continue
+            entry = turn_memo.get(key) or memo.get(key)
+            if entry is None:
+                entry = self._process_message(message)
             else:
-                processed_content = [{"type": "text", "text": str(content)}]
-
+                hits += 1
+            if key not in turn_memo:
+                turn_memo[key] = entry
+                size += sum(len(part if isinstance(part, str) else part[1]) for part in key)
             processed.append({
-                "role": message["role"],
-                "content": processed_content
+                "role": entry["role"],
+                "content": [dict(block) for block in entry["content"]]
             })
 
+        self._message_cache.put(conversation_id, turn_memo, size, max_size)
+        logger.debug("Processed %d messages (%d memoized)", len(messages), hits)
         return processed
 
+    def _get_timeout(self, stream: bool = False) -> httpx.Timeout:
+        """
+        Build the transport timeout (connect / read / write / pool).
+
+        For streams the read timeout is the gap allowed between two reads,
+        which makes it the stall watchdog (``STREAM_IDLE_TIMEOUT``).
+        """
+        read = float(self.valves.REQUEST_TIMEOUT)
+        if stream and self.valves.STREAM_IDLE_TIMEOUT > 0:
+            read = min(read, self.valves.STREAM_IDLE_TIMEOUT)
+        return httpx.Timeout(
+            connect=30.0,
+            read=read,
+            write=30.0,
+            pool=30.0
+        )
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        Return the shared pooled HTTP client.
+
+        The client is rebuilt when the pool-related valves change so that
+        edits in the admin UI take effect without restarting the worker.
+        """
+        config = (
+            self.valves.HTTP_POOL_MAX_CONNECTIONS,
+            self.valves.HTTP_POOL_MAX_KEEPALIVE,
+            self.valves.HTTP_KEEPALIVE_EXPIRY,
+            self.valves.ENABLE_HTTP2,
+            self.valves.REQUEST_TIMEOUT
+        )
+        if self._client is not None and not self._client.is_closed:
+            if config == self._client_config:
+                return self._client
+            # Don't close the old client here - in-flight streams still use
+            # it. It is closed on shutdown.
+            self._retired_clients.append(self._client)
+
+        http2 = self.valves.ENABLE_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("ENABLE_HTTP2 is set but 'h2' is not installed, using HTTP/1.1")
+                http2 = False
+
+        self._client = httpx.AsyncClient(
+            timeout=self._get_timeout(),
+            limits=httpx.Limits(
+                max_connections=max(1, self.valves.HTTP_POOL_MAX_CONNECTIONS),
+                max_keepalive_connections=max(0, self.valves.HTTP_POOL_MAX_KEEPALIVE),
+                keepalive_expiry=self.valves.HTTP_KEEPALIVE_EXPIRY
+            ),
+            http2=http2
+        )
+        self._client_config = config
+        logger.debug(
+            "HTTP client created: pool=%d, keepalive=%d, http2=%s",
+            config[0], config[1], http2
+        )
+        return self._client
+
+    async def on_shutdown(self):
+        """Close the shared HTTP client and release pooled connections"""
+        for client in self._retired_clients:
+            await client.aclose()
+        self._retired_clients = []
+
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._client_config = None
+            logger.info("HTTP client closed")
+
+        if self._file_cache is not None:
+            self._file_cache.save()
+
+        if self._image_executor is not None:
+            self._image_executor.shutdown(wait=False, cancel_futures=True)
+            self._image_executor = None
+
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+
+        if self._delete_task is not None:
+            self._delete_task.cancel()
+            self._delete_task = None
+
+        if self._warmup_task is not None:
+            self._warmup_task.cancel()
+            self._warmup_task = None
+
+        if self._prompt_registry is not None:
+            self._prompt_registry.save()
+
+        self._stop_log_listener()
+
+    # ==================== RETRY HANDLING ====================
+
+    IMAGE_TOKEN_ESTIMATE = 1600
+    RETRYABLE_STATUS_CODES = frozenset((408, 409, 429, 500, 502, 503, 504, 529))
+    RETRYABLE_ERROR_TYPES = frozenset(("overloaded_error", "api_error", "rate_limit_error"))
+
+    def _retry_after(self, headers: httpx.Headers) -> Optional[float]:
+        """
+        Server-provided wait hint: retry-after-ms, retry-after (seconds or
+        HTTP date), else the reset time of any exhausted anthropic-ratelimit-*
+        bucket.
+        """
+        value = headers.get("retry-after-ms")
+        if value:
+            try:
+                return max(0.0, float(value) / 1000)
+            except ValueError:
+                pass
+
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                try:
+                    when = parsedate_to_datetime(value)
+                    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+
+        waits = []
+        for limit in ("requests", "tokens", "input-tokens", "output-tokens"):
+            if headers.get(f"anthropic-ratelimit-{limit}-remaining") == "0":
+                reset = headers.get(f"anthropic-ratelimit-{limit}-reset")
+                wait = seconds_until(reset) if reset else None
+                if wait is not None:
+                    waits.append(wait)
+        return max(waits) if waits else None
+
+    def _retry_delay(
+        self,
+        budget: RetryBudget,
+        headers: Optional[httpx.Headers] = None
+    ) -> Optional[float]:
+        """
+        Seconds to wait before the next attempt, or None to give up.
+
+        Uses the server's hint when there is one, otherwise exponential
+        backoff with jitter. Gives up once RETRY_MAX_ATTEMPTS or the
+        RETRY_BUDGET_SECONDS wait budget is used; a returned delay is
+        charged to ``budget``.
+        """
+        attempt = budget.attempts
+        if attempt >= self.valves.RETRY_MAX_ATTEMPTS:
+            return None
+
+        delay = None
+        if headers is not None:
+            if headers.get("x-should-retry") == "false":
+                return None
+            delay = self._retry_after(headers)
+            if delay is not None and delay > self.valves.RETRY_MAX_DELAY:
+                return None
+
+        if delay is None:
+            backoff = min(
+                self.valves.RETRY_MAX_DELAY,
+                self.valves.RETRY_BASE_DELAY * (2 ** attempt)
+            )
+            delay = random.uniform(backoff / 2, backoff)
+
+        if budget.waited + delay > self.valves.RETRY_BUDGET_SECONDS:
+            return None
+        budget.attempts += 1
+        budget.waited += delay
+        return delay
+
+    def _estimate_tokens(self, value: Any) -> int:
+        """Rough token count of a payload fragment (~4 chars per token)"""
+        if isinstance(value, str):
+            return len(value) // 4
+        if isinstance(value, list):
+            return sum(self._estimate_tokens(item) for item in value)
+        if isinstance(value, dict):
+            if value.get("type") == "image":
+                return self.IMAGE_TOKEN_ESTIMATE
+            return sum(self._estimate_tokens(item) for item in value.values())
+        return 0
+
+    def _estimate_input_tokens(self, payload: Dict[str, Any]) -> int:
+        """Estimate the input tokens of a prepared request payload"""
+        return (
+            self._estimate_tokens(payload.get("system"))
+            + self._estimate_tokens(payload.get("tools"))
+            + self._estimate_tokens(payload.get("messages"))
+        )
+
+    async def _acquire_rate_limit(self, input_tokens: int, __event_emitter__=None) -> None:
+        """Hold the request until the org's rate limits have room for it"""
+        if not self.valves.ENABLE_RATE_LIMITER:
+            return
+
+        async def on_wait(wait: float) -> None:
+            logger.info(
+                "Rate limiter holding request for %.1fs", wait,
+                extra=log_fields("rate_limit_wait", seconds=wait)
+            )
+            if __event_emitter__ and wait >= 1:
+                await __event_emitter__({
+                    "type": "status",
+                    "data": {
+                        "description": f"Waiting {wait:.0f}s for rate limit capacity...",
+                        "done": False
+                    }
+                })
+
+        waited = await self._rate_limiter.acquire(
+            input_tokens,
+            max(0.0, self.valves.RATE_LIMIT_MAX_WAIT),
+            on_wait
+        )
+        if waited >= 1 and __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {"description": "", "done": True}
+            })
+
+    async def _admit(self, __user__=None, __event_emitter__=None, background: bool = False) -> Optional[str]:
+        """
+        Wait for an upstream slot. Returns the user key holding the slot
+        (release it with _release) or None when admission control is off.
+
+        ``background`` requests never queue ahead of users: they take a
+        slot that is free right now or raise AdmissionTimeout.
+        """
+        if not self.valves.MAX_CONCURRENT_REQUESTS and not self.valves.MAX_CONCURRENT_PER_USER:
+            return None
+
+        user = __user__ if isinstance(__user__, dict) else {}
+        user_id = str(user.get("id") or "anonymous")
+        weight = self.valves.ADMIN_QUEUE_WEIGHT if user.get("role") == "admin" else 1.0
+
+        self._admission.configure(
+            self.valves.MAX_CONCURRENT_REQUESTS,
+            self.valves.MAX_CONCURRENT_PER_USER
+        )
+        if background:
+            if not self._admission.try_acquire(user_id):
+                raise AdmissionTimeout()
+            return user_id
+
+        queued = False
+
+        async def on_position(position: int) -> None:
+            nonlocal queued
+            queued = True
+            if __event_emitter__:
+                await __event_emitter__({
+                    "type": "status",
+                    "data": {
+                        "description": f"Queued - position {position}...",
+                        "done": False
+                    }
+                })
+
+        await self._admission.acquire(
+            user_id, weight, max(0.0, self.valves.QUEUE_TIMEOUT), on_position
+        )
+        if queued and __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {"description": "", "done": True}
+            })
+        return user_id
+
+    def _release(self, slot: Optional[str]) -> None:
+        """Return an upstream slot taken by _admit"""
+        if slot is not None:
+            self._admission.release(slot)
+
+    def _encode_payload(self, payload: Dict[str, Any]) -> bytes:
+        return self._payload_encoder.encode(payload, int(self.valves.PAYLOAD_CACHE_MAX_MB * 1024 * 1024))
+
+    async def _send_with_retry(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        payload: Union[Dict[str, Any], bytes],
+        stream: bool,
+        budget: Optional[RetryBudget] = None
+    ) -> httpx.Response:
+        """
+        POST the payload, retrying retryable statuses and connection failures.
+
+        Nothing has reached the user at this point, so retries are safe.
+        Returns the first 200 or non-retryable response; with ``stream`` the
+        body is left unread and the caller must close the response. A
+        payload already encoded (bytes) is sent as is.
+        """
+        client = self._get_client()
+        body = payload if isinstance(payload, bytes) else self._encode_payload(payload)
+        request = client.build_request(
+            "POST", url, headers=headers, content=body, timeout=self._get_timeout(stream)
+        )
+        if budget is None:
+            budget = RetryBudget()
+
+        while True:
+            try:
+                response = await client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout,
+                    httpx.RemoteProtocolError) as e:
+                delay = self._retry_delay(budget)
+                if delay is None:
+                    raise
+                logger.warning(
+                    "Connection failed (%s), retrying in %.1fs (attempt %d/%d)",
+                    type(e).__name__, delay, budget.attempts, self.valves.RETRY_MAX_ATTEMPTS,
+                    extra=log_fields("retry", reason=type(e).__name__, delay=delay, attempt=budget.attempts)
+                )
+            else:
+                self._rate_limiter.update(response.headers)
+                if response.status_code not in self.RETRYABLE_STATUS_CODES:
+                    return response
+                delay = self._retry_delay(budget, response.headers)
+                if delay is None:
+                    return response
+                await response.aclose()
+                logger.warning(
+                    "HTTP %d, retrying in %.1fs (attempt %d/%d)",
+                    response.status_code, delay, budget.attempts, self.valves.RETRY_MAX_ATTEMPTS,
+                    extra=log_fields("retry", reason=response.status_code, delay=delay, attempt=budget.attempts)
+                )
+
+            await asyncio.sleep(delay)
+
+    # ==================== IMAGE HANDLING ====================
+
+    PROCESSED_IMAGE_CACHE_SIZE = 32
+
+    def _get_image_executor(self) -> Executor:
+        """Return the preprocessing pool, rebuilt when the worker count changes"""
+        workers = 0 if self._image_processes_broken else max(0, self.valves.IMAGE_PREPROCESS_WORKERS)
+        if self._image_executor is None or self._image_executor_workers != workers:
+            if self._image_executor is not None:
+                self._image_executor.shutdown(wait=False)
+            if workers:
+                self._image_executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                self._image_executor = ThreadPoolExecutor(max_workers=1)
+            self._image_executor_workers = workers
+        return self._image_executor
+
+    async def _preprocess_source(self, source: Dict[str, Any], known: Dict[str, Optional[str]]) -> Tuple[str, str]:
+        """Downscaled (base64 data, media_type) for one image source, memoized"""
+        max_edge = self.valves.IMAGE_MAX_EDGE
+        quality = min(95, max(1, self.valves.IMAGE_JPEG_QUALITY))
+        key = f"{max_edge}:{quality}:{content_hash(source['data'], known)}"
+        cached = self._processed_images.get(key)
+        if cached is not None:
+            self._processed_images.move_to_end(key)
+            return cached
+
+        raw = base64.b64decode(source["data"])
+        loop = asyncio.get_running_loop()
+        args = (raw, source["media_type"], max_edge, quality)
+        executor = self._get_image_executor()
+        try:
+            data, media_type = await loop.run_in_executor(executor, preprocess_image, *args)
+        except (BrokenProcessPool, pickle.PicklingError, AttributeError) as e:
+            # This module may not be importable in a child process (it is
+            # loaded from the database) - fall back to a thread for good
+            if not isinstance(executor, ProcessPoolExecutor):
+                raise
+            if not self._image_processes_broken:
+                logger.warning("Image worker processes unavailable (%s), using a thread", e)
+                self._image_processes_broken = True
+            data, media_type = await loop.run_in_executor(self._get_image_executor(), preprocess_image, *args)
+
+        result = (source["data"] if data == raw else base64.b64encode(data).decode("ascii"), media_type)
+        logger.debug("Preprocessed image: %d -> %d bytes (%s)", len(raw), len(data), media_type)
+        self._processed_images[key] = result
+        if len(self._processed_images) > self.PROCESSED_IMAGE_CACHE_SIZE:
+            self._processed_images.popitem(last=False)
+        return result
+
+    async def _preprocess_images(self, messages: List[Dict[str, Any]], known: Dict[str, Optional[str]]) -> None:
+        """Downscale and recompress every base64 image block (``known``: see content_hash)"""
+        images = [
+            item
+            for message in messages
+            for item in message["content"]
+            if item.get("type") == "image" and item.get("source", {}).get("type") == "base64"
+        ]
+        if not images:
+            return
+        results = await asyncio.gather(
+            *(self._preprocess_source(item["source"], known) for item in images), return_exceptions=True
+        )
+        for item, result in zip(images, results):
+            if isinstance(result, BaseException):
+                # Undecodable images are sent unchanged and left to the API
+                logger.warning("Image preprocessing failed: %s", result)
+                continue
+            # New source dict: the original may be shared with the message memo
+            item["source"] = {"type": "base64", "media_type": result[1], "data": result[0]}
+
+    def _get_file_cache(self) -> FileIdCache:
+        """Return the file_id index for the configured path"""
+        path = self.valves.IMAGE_CACHE_PATH.strip() or os.path.join(
+            os.getenv("DATA_DIR", tempfile.gettempdir()), "anthropic_file_cache.json"
+        )
+        if self._file_cache is None or self._file_cache.path != path:
+            if self._file_cache is not None:
+                self._file_cache.save()
+            self._file_cache = FileIdCache(path)
+            self._file_cache.load()
+        return self._file_cache
+
+    def _files_headers(self) -> Dict[str, str]:
+        return {
+            "x-api-key": self.valves.ANTHROPIC_API_KEY,
+            "anthropic-version": self.API_VERSION,
+            "anthropic-beta": self.FILES_API_BETA
+        }
+
+    async def _upload_file(self, data: str, media_type: str) -> Optional[str]:
+        """Upload one base64 image; None on failure (the caller keeps base64)"""
+        try:
+            raw = base64.b64decode(data)
+            extension = media_type.split("/")[-1]
+            response = await self._get_client().post(
+                f"{self.API_BASE_URL}/files",
+                headers=self._files_headers(),
+                files={"file": (f"image.{extension}", raw, media_type)}
+            )
+            self._rate_limiter.update(response.headers)
+            if response.status_code != 200:
+                logger.warning("Image upload failed: HTTP %d %.200s", response.status_code, response.text)
+                return None
+            return json_loads(response.content).get("id")
+        except (ValueError, httpx.HTTPError) as e:
+            logger.warning("Image upload failed: %s", e)
+            return None
+
+    async def _delete_files(self, file_ids: List[str]) -> None:
+        """Best-effort removal of uploads evicted from the index"""
+        client = self._get_client()
+        for file_id in file_ids:
+            try:
+                await client.delete(f"{self.API_BASE_URL}/files/{file_id}", headers=self._files_headers())
+            except httpx.HTTPError as e:
+                logger.debug("Could not delete evicted file %s: %s", file_id, e)
+
+    def _schedule_deletes(self, file_ids: List[str], delay: float) -> None:
+        """Delete uploads in the background, no sooner than ``delay`` seconds from now"""
+        due = time.time() + delay
+        for file_id in file_ids:
+            self._pending_deletes[file_id] = max(due, self._pending_deletes.get(file_id, 0.0))
+        if self._pending_deletes and self._delete_task is None:
+            self._delete_task = asyncio.get_running_loop().create_task(self._delete_loop())
+
+    async def _delete_loop(self) -> None:
+        """Delete pending uploads as they come due, until none are left"""
+        try:
+            while self._pending_deletes:
+                await asyncio.sleep(max(0.0, min(self._pending_deletes.values()) - time.time()))
+                now = time.time()
+                due = [file_id for file_id, at in self._pending_deletes.items() if at <= now]
+                for file_id in due:
+                    del self._pending_deletes[file_id]
+                await self._delete_files(due)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("File cleanup stopped: %s", e, exc_info=True)
+        finally:
+            self._delete_task = None
+
+    async def _upload_images(self, messages: List[Dict[str, Any]], known: Dict[str, Optional[str]]) -> bool:
+        """
+        Replace base64 image blocks with Files API references.
+
+        Images are keyed by a hash of their content (and of the API key,
+        since file_ids belong to one workspace; ``known``: see content_hash).
+        Known hashes are reused; new ones are uploaded once, concurrently.
+        Returns True when the payload references at least one file.
+
+        Uploads evicted from the index are deleted in the background after
+        FILE_DELETE_DELAY_SECONDS, because other requests may still hold
+        them. When a concurrent request indexed the same image first, its
+        file is used and the duplicate upload is deleted right away.
+        """
+        blocks = [
+            (message["content"], i)
+            for message in messages
+            for i, item in enumerate(message["content"])
+            if item.get("type") == "image" and item.get("source", {}).get("type") == "base64"
+        ]
+        if not blocks:
+            return False
+
+        cache = self._get_file_cache()
+        ttl = self.valves.IMAGE_CACHE_TTL_HOURS * 3600
+        key_prefix = hashlib.sha256(self.valves.ANTHROPIC_API_KEY.encode()).hexdigest()[:16]
+
+        keys = []
+        file_ids: Dict[str, Optional[str]] = {}
+        missing: Dict[str, Dict[str, Any]] = {}
+        for content, i in blocks:
+            source = content[i]["source"]
+            key = f"{key_prefix}:{content_hash(source['data'], known)}"
+            keys.append(key)
+            if key not in file_ids:
+                file_ids[key] = cache.get(key, ttl)
+                if file_ids[key] is None:
+                    missing[key] = source
+
+        if missing:
+            uploaded = await asyncio.gather(*(
+                self._upload_file(source["data"], source["media_type"])
+                for source in missing.values()
+            ))
+            evicted = []
+            duplicates = []
+            for key, file_id in zip(missing, uploaded):
+                current = cache.get(key, ttl) if file_id else None
+                if current is not None:
+                    # Another request uploaded the same image meanwhile
+                    duplicates.append(file_id)
+                    file_id = current
+                elif file_id:
+                    evicted.extend(cache.put(key, file_id, self.valves.IMAGE_CACHE_MAX_ENTRIES, ttl))
+                file_ids[key] = file_id
+            logger.info("Uploaded %d/%d new images to the Files API", sum(map(bool, uploaded)), len(missing))
+            cache.save()
+            self._schedule_deletes(duplicates, 0.0)
+            self._schedule_deletes(evicted, self.FILE_DELETE_DELAY_SECONDS)
+
+        for (content, i), key in zip(blocks, keys):
+            if file_ids[key]:
+                content[i] = {"type": "image", "source": {"type": "file", "file_id": file_ids[key]}}
+
+        return any(file_ids.values())
+
     # ==================== FORMATTING FUNCTIONS ====================
 
     def _format_token_usage(self, usage: Dict[str, Any]) -> str:
@@ -638,31 +3057,719 @@ class Pipe:
         output += "\n</details>\n"
         return output
 
+    # ==================== CACHE KEEPALIVE ====================
+
+    KEEPALIVE_CHECK_SECONDS = 10.0
+    KEEPALIVE_PROMPT = "Reply with only: OK"
+
+    def _observe_cache_usage(self, conversation_id: Optional[str], usage: Dict[str, Any]) -> None:
+        """Feed a real turn's usage to the TTL selector and the keepalive"""
+        self._cache_ttl.observe(conversation_id, usage)
+        if self._keepalive.observe(conversation_id, usage):
+            keepalive = self._keepalive
+            logger.info(
+                "Cache keepalive: %d refreshes cost $%.4f, saved %d cache-write tokens ($%.4f, ~%.1fs prefill)",
+                keepalive.refreshes, keepalive.cost, keepalive.saved_tokens,
+                keepalive.saved_cost, keepalive.saved_seconds,
+                extra=log_fields(
+                    "cache_keepalive_stats", refreshes=keepalive.refreshes, cost_usd=keepalive.cost,
+                    saved_tokens=keepalive.saved_tokens, saved_usd=keepalive.saved_cost,
+                    saved_seconds=keepalive.saved_seconds
+                )
+            )
+
+    def _track_keepalive(self, conversation_id: str, headers: Dict[str, str], payload: Dict[str, Any], __user__=None) -> None:
+        """
+        Register this turn's cached prefix for keepalive refreshes.
+
+        The refresh request is the same payload (so the prefix, thinking
+        settings and tools - all part of the cache key - match) with
+        ``max_tokens: 1``, which leaves no room to answer or call a tool.
+        Thinking without tools (no interleaved-thinking beta) requires
+        max_tokens above the thinking budget, so there a short instruction
+        is appended after the cached block to keep the thinking brief.
+        The refresh is kept encoded: an entry does not hold on to the
+        conversation's message objects.
+        """
+        last = payload["messages"][-1]
+        marker = last["content"][-1].get("cache_control") if isinstance(last["content"], list) else None
+        if not marker or last["role"] != "user":
+            return
+
+        refresh = dict(payload, stream=False, max_tokens=1)
+        thinking = payload.get("thinking")
+        if thinking and "interleaved-thinking" not in headers.get("anthropic-beta", ""):
+            refresh["max_tokens"] = thinking["budget_tokens"] + 1
+            refresh["messages"] = payload["messages"][:-1] + [{
+                "role": "user",
+                "content": last["content"] + [{"type": "text", "text": self.KEEPALIVE_PROMPT}]
+            }]
+
+        user = __user__ if isinstance(__user__, dict) else {}
+        now = self._cache_ttl.clock()
+        self._keepalive.track(conversation_id, KeepaliveEntry(
+            body=self._encode_payload(refresh),
+            headers=dict(headers),
+            user_id=str(user.get("id") or "anonymous"),
+            prefix_tokens=self._estimate_input_tokens(payload),
+            ttl=3600.0 if marker.get("ttl") == "1h" else 300.0,
+            last_turn=now,
+            touched=now,
+            max_output_tokens=refresh["max_tokens"]
+        ))
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.get_running_loop().create_task(self._keepalive_loop())
+
+    async def _keepalive_loop(self) -> None:
+        """Refresh conversations as they come due, until none are left"""
+        try:
+            while self._keepalive.entries:
+                await asyncio.sleep(self.KEEPALIVE_CHECK_SECONDS)
+                if not (self.valves.ENABLE_CACHE_KEEPALIVE and self.valves.ENABLE_PROMPT_CACHING):
+                    self._keepalive.clear()
+                    break
+                now = self._cache_ttl.clock()
+                max_idle = self.valves.CACHE_KEEPALIVE_MAX_IDLE_MINUTES * 60
+                for conversation_id, entry in self._keepalive.due(now, max_idle):
+                    try:
+                        await self._refresh_cache(conversation_id, entry)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        # One broken refresh must not stop the others
+                        logger.warning("Cache keepalive for %s failed: %s", conversation_id, e, exc_info=True)
+                        self._keepalive.drop(conversation_id, entry)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Cache keepalive stopped: %s", e, exc_info=True)
+        finally:
+            self._keepalive_task = None
+
+    async def _refresh_cache(self, conversation_id: str, entry: KeepaliveEntry) -> None:
+        """
+        Send one keepalive request if it is worth it and within budget.
+
+        Refreshes go through admission control and the rate limiter, but
+        only use capacity that is free right now: a late refresh is
+        worthless, and users' requests come first.
+        """
+        now = self._cache_ttl.clock()
+        p_return = self._cache_ttl.return_probability(conversation_id, now - entry.last_turn, entry.ttl)
+        cost = self._keepalive.refresh_cost(entry, p_return)
+        if cost is None:
+            logger.debug("Cache keepalive skipped for %s: return chance %.0f%% too low", conversation_id, p_return * 100)
+            return
+        if not self._keepalive.affordable(
+            entry.user_id, cost,
+            self.valves.CACHE_KEEPALIVE_BUDGET_USD, self.valves.CACHE_KEEPALIVE_USER_BUDGET_USD, now
+        ):
+            logger.debug("Cache keepalive skipped for %s: budget exhausted", conversation_id)
+            return
+        if self.valves.ENABLE_RATE_LIMITER and self._rate_limiter.wait_time(entry.prefix_tokens) > 0:
+            logger.debug("Cache keepalive skipped for %s: rate limits have no room", conversation_id)
+            return
+        try:
+            slot = await self._admit({"id": entry.user_id}, background=True)
+        except AdmissionTimeout:
+            logger.debug("Cache keepalive skipped for %s: no free upstream slot", conversation_id)
+            return
+
+        try:
+            await self._acquire_rate_limit(entry.prefix_tokens)
+            # No retries: a late refresh is worthless
+            response = await self._send_with_retry(
+                f"{self.API_BASE_URL}/messages", entry.headers, entry.body, stream=False,
+                budget=RetryBudget(attempts=self.valves.RETRY_MAX_ATTEMPTS)
+            )
+        except httpx.HTTPError as e:
+            logger.warning("Cache keepalive request failed: %s", e)
+            return
+        finally:
+            self._release(slot)
+        if response.status_code != 200:
+            logger.warning("Cache keepalive request failed: HTTP %d", response.status_code)
+            self._keepalive.drop(conversation_id, entry)
+            return
+
+        try:
+            usage = json_loads(response.content).get("usage", {})
+        except ValueError as e:
+            logger.warning("Cache keepalive response unreadable: %s", e)
+            self._keepalive.drop(conversation_id, entry)
+            return
+        cost = self._keepalive.record_refresh(conversation_id, entry, usage, self._cache_ttl.clock())
+        logger.debug(
+            "Cache keepalive for %s: read %d tokens, $%.5f (return chance %.0f%%)",
+            conversation_id, usage.get("cache_read_input_tokens", 0), cost, p_return * 100
+        )
+
+    # ==================== CACHE WARMUP ====================
+
+    def _get_prompt_registry(self) -> SystemPromptRegistry:
+        """Return the prompt registry, on disk only with CACHE_WARMUP_PERSIST_PROMPTS"""
+        path = os.path.join(
+            os.getenv("DATA_DIR", tempfile.gettempdir()), "anthropic_system_prompts.json"
+        ) if self.valves.CACHE_WARMUP_PERSIST_PROMPTS else None
+        if self._prompt_registry is None or self._prompt_registry.path != path:
+            if self._prompt_registry is not None:
+                self._prompt_registry.save()
+            self._prompt_registry = SystemPromptRegistry(path)
+            self._prompt_registry.load()
+        return self._prompt_registry
+
+    def _record_system_prompt(self, system_message: Any) -> None:
+        """Count a system prompt large enough to be cached on its own"""
+        if not isinstance(system_message, str) or len(system_message) // 4 < self.CACHE_MIN_TOKENS:
+            return
+        registry = self._get_prompt_registry()
+        if registry.record(system_message):
+            registry.save()
+
+    def _schedule_cache_warmup(self) -> None:
+        """
+        Start a cache warmup when the valves differ from the last warmed set.
+
+        Covers startup (the first pipes() or pipe() call after loading) and
+        valve saves, which OpenWebUI applies in place. Outside a running
+        event loop this is a no-op and the next call schedules it.
+        """
+        if not (self.valves.ENABLE_CACHE_WARMUP and self.valves.ENABLE_PROMPT_CACHING
+                and self.valves.ANTHROPIC_API_KEY):
+            return
+        valves_key = tuple(self.valves.__dict__.values())
+        if valves_key == self._warmup_valves or self._warmup_task is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        # Taken before this request records its system prompt. Prompts sent
+        # from now on are cached with these valves by their own requests;
+        # on a fresh worker so are those sent within the last TTL, because
+        # the valves come back unchanged from OpenWebUI's database
+        prompts = self._get_prompt_registry().top(max(0, self.valves.CACHE_WARMUP_MAX_PROMPTS))
+        cached_since = time.time()
+        if self._warmup_valves is None:
+            cached_since -= 3600 if self.valves.CACHE_TTL == "1hour" else 300
+        self._warmup_valves = valves_key
+        self._warmup_task = loop.create_task(self._warm_cache(prompts, cached_since))
+
+    def _warmup_payload(self, profile: RequestProfile, system: Optional[str], ttl: str) -> Optional[Dict[str, Any]]:
+        """
+        Minimal request whose tools / system prefix matches real requests.
+
+        Thinking is left out: it only keys the cached messages, not the
+        tools and system prompt. None when nothing reaches the minimum
+        cacheable size.
+        """
+        payload = {
+            "model": self.MODEL_ID,
+            "max_tokens": 1,
+            "messages": [{"role": "user", "content": [{"type": "text", "text": self.KEEPALIVE_PROMPT}]}]
+        }
+        marked = False
+        tokens = 0
+        if profile.tools:
+            payload["tools"] = list(profile.tools)
+            tokens += self._estimate_tokens(payload["tools"])
+            if self.valves.CACHE_TOOLS and tokens >= self.CACHE_MIN_TOKENS:
+                payload["tools"][-1] = {**payload["tools"][-1], "cache_control": self._cache_control(ttl)}
+                marked = True
+        if system and self.valves.CACHE_SYSTEM_PROMPT:
+            tokens += self._estimate_tokens(system)
+            if tokens >= self.CACHE_MIN_TOKENS:
+                payload["system"] = [{"type": "text", "text": system, "cache_control": self._cache_control(ttl)}]
+                marked = True
+        return payload if marked else None
+
+    async def _warm_cache(self, prompts: List[str], cached_since: float) -> None:
+        """
+        Write system prompts, with each built tool profile, to the prompt cache.
+
+        Prompts a real request sent after ``cached_since`` are skipped: that
+        request already wrote them.
+        """
+        try:
+            profiles = {}
+            for profile in [self._get_profile(self.user_valves), *self._profiles.values()]:
+                profiles.setdefault(freeze(profile.tools), profile)
+            registry = self._get_prompt_registry()
+            ttl = "1h" if self.valves.CACHE_TTL == "1hour" else "5m"
+
+            for profile in profiles.values():
+                for system in prompts or [None]:
+                    if system is not None and registry.last_used(system) >= cached_since:
+                        logger.debug("Cache warmup skipped a system prompt sent since %.0f", cached_since)
+                        continue
+                    payload = self._warmup_payload(profile, system, ttl)
+                    if payload is None:
+                        continue
+                    # No retries: warming is best effort
+                    response = await self._send_with_retry(
+                        f"{self.API_BASE_URL}/messages", dict(profile.headers), payload, stream=False,
+                        budget=RetryBudget(attempts=self.valves.RETRY_MAX_ATTEMPTS)
+                    )
+                    if response.status_code != 200:
+                        logger.warning("Cache warmup request failed: HTTP %d", response.status_code)
+                        continue
+                    usage = json_loads(response.content).get("usage", {})
+                    logger.info(
+                        "Cache warmup: tools=%d system=%s, wrote %d tokens, %d already cached",
+                        len(profile.tools), bool(system),
+                        usage.get("cache_creation_input_tokens", 0), usage.get("cache_read_input_tokens", 0)
+                    )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Cache warmup failed: %s", e)
+        finally:
+            self._warmup_task = None
+
+    # ==================== STREAM EVENT HANDLERS ====================
+    #
+    # Each table maps a type string to the name of a handler method. Handlers
+    # take (state, data) and return the output chunks to yield, or None.
+    # Supporting a new event, block or delta type is a method plus an entry.
+
+    EVENT_HANDLERS = {
+        "message_start": "_on_message_start",
+        "content_block_start": "_on_block_start",
+        "content_block_delta": "_on_block_delta",
+        "content_block_stop": "_on_block_stop",
+        "message_delta": "_on_message_delta",
+        "message_stop": "_on_message_stop",
+        "error": "_on_error",
+    }
+    BLOCK_START_HANDLERS = {
+        "thinking": "_on_thinking_start",
+        "text": "_on_text_start",
+        "server_tool_use": "_on_server_tool_use_start",
+        "web_search_tool_result": "_on_web_search_result_start",
+    }
+    BLOCK_STOP_HANDLERS = {
+        "server_tool_use": "_on_server_tool_use_stop",
+        "web_search_tool_result": "_on_web_search_result_stop",
+    }
+    DELTA_HANDLERS = {
+        "text_delta": "_on_text_delta",
+        "thinking_delta": "_on_thinking_delta",
+        "input_json_delta": "_on_input_json_delta",
+        "citations_delta": "_on_citations_delta",
+    }
+
+    def _bind_handlers(self, table: Dict[str, str]) -> Dict[str, Callable]:
+        return {key: getattr(self, name) for key, name in table.items()}
+
+    # ---- events ----
+
+    def _on_message_start(self, state: StreamingState, data: Dict[str, Any]):
+        message_data = data.get("message", {})
+        if "usage" in message_data:
+            if state.usage_offset:
+                # A stall continuation: the turn is billed for every leg
+                state.usage = {**state.usage_offset, **add_usage(state.usage_offset, message_data["usage"])}
+            else:
+                state.usage = dict(message_data["usage"])
+                self._observe_cache_usage(state.conversation_id, state.usage)
+        # Complete text blocks may already carry citations
+        for block in message_data.get("content", []):
+            if block.get("type") == "text" and "citations" in block:
+                self._add_citations(state, block["citations"], "message_start")
+
+    def _on_block_start(self, state: StreamingState, data: Dict[str, Any]):
+        content_block = data.get("content_block", {})
+        block_type = content_block.get("type")
+        state.current_block_type = block_type
+        state.current_block_index = data.get("index", 0)
+        handler = self._block_start_handlers.get(block_type)
+        if handler is not None:
+            return handler(state, content_block)
+        if state.debug:
+            logger.debug("Unhandled content block type=%s", block_type)
+
+    def _on_block_delta(self, state: StreamingState, data: Dict[str, Any]):
+        delta = data.get("delta", {})
+        handler = self._delta_handlers.get(delta.get("type"))
+        if handler is not None:
+            return handler(state, delta)
+
+    def _on_block_stop(self, state: StreamingState, data: Dict[str, Any]):
+        # Some streaming implementations include the complete block here
+        block = data.get("content_block")
+        if block and block.get("type") == "text" and "citations" in block:
+            self._add_citations(state, block["citations"], "content_block_stop")
+        handler = self._block_stop_handlers.get(state.current_block_type)
+        if handler is not None:
+            return handler(state, data)
+
+    def _on_message_delta(self, state: StreamingState, data: Dict[str, Any]):
+        if "usage" in data:
+            state.usage.update(add_usage(state.usage_offset, data["usage"]))
+        # Check if message delta contains complete content blocks with citations
+        if "delta" in data and "content" in data["delta"]:
+            for block in data["delta"]["content"]:
+                if block.get("type") == "text" and "citations" in block:
+                    self._add_citations(state, block["citations"], "message_delta")
+
+    def _on_message_stop(self, state: StreamingState, data: Dict[str, Any]):
+        # Close thinking tag if still open
+        if state.thinking_state == ThinkingState.IN_PROGRESS:
+            state.thinking_state = ThinkingState.COMPLETED
+            return (THINK_CLOSE_FINAL,)
+
+    def _on_error(self, state: StreamingState, data: Dict[str, Any]):
+        # In-stream error (e.g. overloaded_error)
+        error = data.get("error", {})
+        if state.current_block_type is None and error.get("type") in self.RETRYABLE_ERROR_TYPES:
+            raise RetryableStreamError(error)
+        logger.error("Stream error event: %s", error)
+        self._dump_recent_events(state, logging.ERROR, "error event")
+        message = f"\n\n❌ **API Error ({error.get('type', 'error')})**: {error.get('message', '')}"
+        if state.thinking_state == ThinkingState.IN_PROGRESS:
+            state.thinking_state = ThinkingState.COMPLETED
+            return (THINK_CLOSE_FINAL, message)
+        return (message,)
+
+    # ---- content block start ----
+
+    def _on_thinking_start(self, state: StreamingState, block: Dict[str, Any]):
+        # DON'T set state here - let first thinking_delta open the tag
+        if state.debug:
+            logger.debug("Thinking content block started")
+
+    def _on_text_start(self, state: StreamingState, block: Dict[str, Any]):
+        # Check for citations in this text block
+        if block.get("citations"):
+            self._add_citations(state, block["citations"], "content_block_start")
+        # Response starting - close thinking tag if open
+        if state.thinking_state == ThinkingState.IN_PROGRESS:
+            state.thinking_state = ThinkingState.COMPLETED
+            if state.debug:
+                logger.debug("Thinking completed, response starting")
+            return (THINK_CLOSE,)
+
+    def _on_server_tool_use_start(self, state: StreamingState, block: Dict[str, Any]):
+        tool_name = block.get("name", "")
+        if state.debug:
+            logger.debug("server_tool_use name=%s index=%d", tool_name, state.current_block_index)
+        # Input is usually empty here and streams in via input_json_delta
+        input_data = block.get("input")
+        state.current_tool = ServerToolCall(
+            name=tool_name,
+            input=input_data if isinstance(input_data, dict) else {}
+        )
+        if tool_name == "web_search":
+            state.current_search = WebSearchResult(query=state.current_tool.input.get("query", ""))
+
+    def _on_web_search_result_start(self, state: StreamingState, block: Dict[str, Any]):
+        # Capture search results - they're in a "content" array
+        if not state.current_search:
+            if state.debug:
+                logger.debug("web_search_tool_result without a pending search")
+            return
+        state.current_search.results = [
+            {
+                "title": item.get("title", ""),
+                "url": item.get("url", ""),
+                "page_age": item.get("page_age", "")
+                # Note: encrypted_content is for Claude's use, not display
+            }
+            for item in block.get("content", [])
+            if item.get("type") == "web_search_result"
+        ]
+
+    # ---- content block stop ----
+
+    def _on_server_tool_use_stop(self, state: StreamingState, data: Dict[str, Any]):
+        if not state.current_tool:
+            return
+        tool_input = state.current_tool.finalize()
+        if state.debug:
+            logger.debug("server_tool_use name=%s input=%s", state.current_tool.name, tool_input)
+        if state.current_tool.name == "web_search" and state.current_search:
+            state.current_search.query = tool_input.get("query", state.current_search.query)
+        state.current_tool = None
+
+    def _on_web_search_result_stop(self, state: StreamingState, data: Dict[str, Any]):
+        # Finalize current search (display at end instead of inline)
+        if state.current_search:
+            if state.debug:
+                logger.debug(
+                    "web_search query=%r results=%d",
+                    state.current_search.query, len(state.current_search.results)
+                )
+            state.web_searches.append(state.current_search)
+            state.current_search = None
+
+    # ---- content block deltas ----
+
+    def _on_text_delta(self, state: StreamingState, delta: Dict[str, Any]):
+        text = delta.get("text", "")
+        if state.prefill_whitespace:
+            # A continuation repeats the whitespace its prefill was cut at
+            pending = state.prefill_whitespace
+            matched = 0
+            while matched < len(text) and matched < len(pending) and text[matched] == pending[matched]:
+                matched += 1
+            state.prefill_whitespace = pending[matched:] if matched == len(text) else ""
+            text = text[matched:]
+            if not text:
+                return None
+        state.output_chars += len(text)
+        if state.response_chunks is not None:
+            state.response_chunks.append(text)
+        # Close thinking tag if still open
+        if state.thinking_state == ThinkingState.IN_PROGRESS:
+            state.thinking_state = ThinkingState.COMPLETED
+            return (THINK_CLOSE, text)
+        return (text,)
+
+    def _on_thinking_delta(self, state: StreamingState, delta: Dict[str, Any]):
+        thinking_text = delta.get("thinking", "")
+        state.output_chars += len(thinking_text)
+        if state.thinking_chunks is not None:
+            state.thinking_chunks.append(thinking_text)
+        # Start <think> tag on first thinking delta
+        if state.thinking_state == ThinkingState.NOT_STARTED:
+            state.thinking_state = ThinkingState.IN_PROGRESS
+            return (THINK_OPEN, thinking_text)
+        return (thinking_text,)
+
+    def _on_input_json_delta(self, state: StreamingState, delta: Dict[str, Any]):
+        # Tool input streams as JSON fragments - parsed once at content_block_stop
+        if state.current_tool:
+            state.current_tool.fragments.append(delta.get("partial_json", ""))
+        else:
+            logger.warning("input_json_delta received outside a server_tool_use block")
+
+    def _on_citations_delta(self, state: StreamingState, delta: Dict[str, Any]):
+        citation = delta.get("citation")
+        if citation:
+            self._add_citations(state, [citation], "citations_delta")
+
     # ==================== STREAMING IMPLEMENTATION ====================
 
+    def _add_citations(
+        self, state: StreamingState, citations: List[Dict[str, Any]], source: str
+    ) -> None:
+        """Record citations as they arrive in the stream"""
+        logger.debug("Found %d citations in %s", len(citations), source)
+        for cit in citations:
+            state.citations.append(CitationData(
+                url=cit.get("url", ""),
+                title=cit.get("title", ""),
+                cited_text=cit.get("cited_text", ""),
+                encrypted_index=cit.get("encrypted_index", "")
+            ))
+
+    async def _iter_sse_events(
+        self, response: httpx.Response
+    ) -> AsyncGenerator[Tuple[bytes, bytes], None]:
+        """Feed raw response chunks through the SSE parser"""
+        parser = SSEParser()
+        async for chunk in response.aiter_bytes():
+            for event in parser.feed(chunk):
+                yield event
+        for event in parser.close():
+            yield event
+
     async def stream_response(
         self,
         url: str,
         headers: Dict[str, str],
         payload: Dict[str, Any],
         user_valves,
-        __event_emitter__=None
-    ) -> Generator[str, None, None]:
-        """Stream response with <think> tags for reasoning"""
+        __event_emitter__=None,
+        __user__=None,
+        conversation_id: Optional[str] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Stream response with <think> tags for reasoning.
+
+        Deltas are coalesced into time/size-bounded batches so the UI gets
+        one update per window instead of one per token. <think> boundaries
+        and the end of the stream are flushed immediately.
+        """
+        chunks = self._stream_chunks(
+            url, headers, payload, user_valves, __event_emitter__, __user__,
+            conversation_id=conversation_id
+        )
+
+        if self.valves.STREAM_COALESCE_MS <= 0:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        coalescer = OutputCoalescer(
+            self.valves.STREAM_COALESCE_MS / 1000,
+            max(1, self.valves.STREAM_COALESCE_MAX_CHARS)
+        )
+        # The next chunk is awaited as a task while a batch is pending so the
+        # batch can be flushed on time without cancelling the upstream read
+        pending: Optional[asyncio.Future] = None
+
+        try:
+            while True:
+                if pending is None and not coalescer.pending:
+                    try:
+                        chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(chunks.__anext__())
+                    done, _ = await asyncio.wait(
+                        (pending,), timeout=coalescer.time_left()
+                    )
+                    if not done:
+                        yield coalescer.flush()
+                        continue
+                    task, pending = pending, None
+                    try:
+                        chunk = task.result()
+                    except StopAsyncIteration:
+                        break
+
+                batch = coalescer.push(chunk, force=chunk in STRUCTURAL_CHUNKS)
+                if batch:
+                    yield batch
+
+            if coalescer.pending:
+                yield coalescer.flush()
+
+        finally:
+            if pending is not None:
+                pending.cancel()
+                try:
+                    await pending
+                except BaseException:
+                    pass
+            await chunks.aclose()
+
+    def _continuation_payload(self, payload: Dict[str, Any], state: StreamingState, stalls: int) -> Dict[str, Any]:
+        """
+        Build the request that picks a stalled stream up where it stopped.
+
+        Nothing shown yet: the same payload is sent again. Otherwise the
+        text streamed so far is prefilled as the assistant turn so the model
+        continues it; thinking is dropped because the API does not allow it
+        together with a prefill (and its signature was never received).
+        """
+        if not state.output_chars:
+            return payload
+
+        messages = list(payload["messages"])
+        if stalls and messages[-1]["role"] == "assistant":
+            # Replace the prefill of the previous continuation
+            messages.pop()
+        # The API rejects a final assistant turn ending in whitespace; the
+        # cut whitespace was shown already, so the continuation's is dropped
+        text = state.response_text()
+        prefill = text.rstrip()
+        state.prefill_whitespace = text[len(prefill):]
+        if prefill:
+            messages.append({"role": "assistant", "content": prefill})
+
+        continuation = dict(payload)
+        continuation.pop("thinking", None)
+        continuation["messages"] = messages
+        return continuation
+
+    def _dump_recent_events(self, state: StreamingState, level: int, reason: str):
+        """Log the DEBUG_EVENT_BUFFER_SIZE replay buffer, then clear it so retries don't repeat it"""
+        if not state.recent_events:
+            return
+        logger.log(
+            level, "Last %d stream events before %s:\n%s", len(state.recent_events), reason,
+            "\n".join(json_dumps(event)[:2000].decode("utf-8", "replace") for event in state.recent_events)
+        )
+        state.recent_events.clear()
+
+    def _record_abort(self, state: StreamingState, payload: Dict[str, Any]):
+        """
+        Count a stream the client abandoned and estimate the output tokens
+        that were not generated.
+
+        The estimate is how much longer recently completed streams that got
+        past this point ran on average (0 when none did or there is no
+        history yet). max_tokens minus what was streamed is kept separately
+        as the upper bound.
+        """
+        streamed = state.output_chars // 4
+        if "output_tokens" in state.usage:
+            # message_delta already arrived - generation had finished
+            saved = saved_max = 0
+        else:
+            saved_max = max(0, payload.get("max_tokens", 0) - streamed)
+            longer = [n for n in self._output_lengths if n > streamed]
+            saved = min(saved_max, int(sum(longer) / len(longer)) - streamed) if longer else 0
+        self.aborted_streams += 1
+        self.aborted_tokens_saved += saved
+        self.aborted_tokens_saved_max += saved_max
+        logger.info(
+            "Stream aborted by client: streamed~%d tokens, ~%d not generated (at most %d); "
+            "total ~%d (at most %d) over %d aborts",
+            streamed, saved, saved_max,
+            self.aborted_tokens_saved, self.aborted_tokens_saved_max, self.aborted_streams,
+            extra=log_fields(
+                "stream_aborted", streamed_tokens=streamed,
+                unsent_tokens=saved, max_unsent_tokens=saved_max
+            )
+        )
+
+    async def _stream_chunks(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        payload: Dict[str, Any],
+        user_valves,
+        __event_emitter__=None,
+        __user__=None,
+        _budget: Optional[RetryBudget] = None,
+        _state: Optional[StreamingState] = None,
+        _stalls: int = 0,
+        conversation_id: Optional[str] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Run the upstream stream and yield output text chunk by chunk.
+
+        An overloaded / api error event that arrives before any content block
+        has started is retried by re-running the whole request (nothing has
+        been shown to the user yet). A stream that stalls is reconnected and
+        continued from the text already shown, reusing the same state so the
+        user sees one answer.
+        """
+
+        budget = _budget or RetryBudget()
+        state = _state
+        if state is None:
+            state = StreamingState(conversation_id=conversation_id)
+            if self.valves.DEBUG_EVENT_BUFFER_SIZE > 0:
+                state.recent_events = deque(maxlen=self.valves.DEBUG_EVENT_BUFFER_SIZE)
+            if self.valves.STREAM_STALL_RETRIES > 0:
+                # The partial answer is the prefill of a continuation request
+                state.response_chunks = []
 
-        state = StreamingState()
-        final_usage = {}
+        # Resolve the level check once per stream; per-event records are sampled
+        debug = state.debug = logger.isEnabledFor(logging.DEBUG)
+        handlers = self._event_handlers
+        sample_rate = max(1, self.valves.LOG_EVENT_SAMPLE_RATE)
+        event_count = 0
+
+        slot = None
 
         try:
-            with requests.post(
-                url,
-                headers=headers,
-                json=payload,
-                stream=True,
-                timeout=(30, self.valves.REQUEST_TIMEOUT)
+            if _budget is None:
+                slot = await self._admit(__user__, __event_emitter__)
+                await self._acquire_rate_limit(self._estimate_input_tokens(payload), __event_emitter__)
+
+            async with aclosing(
+                await self._send_with_retry(url, headers, payload, stream=True, budget=budget)
             ) as response:
 
                 if response.status_code != 200:
+                    await response.aread()
                     error_detail = response.text
                     if response.status_code == 429:
                         msg = "⚠️ **Rate limit exceeded**. Please wait and try again."
@@ -676,225 +3783,38 @@ class Pipe:
                     yield msg
                     return
 
-                for line in response.iter_lines():
-                    if not line:
+                async for sse_event, raw in self._iter_sse_events(response):
+                    if sse_event == b"ping":
                         continue
 
-                    decoded = line.decode("utf-8")
-                    if not decoded.startswith("data: "):
-                        continue
-
-                    raw_json = decoded[6:]
-                    if raw_json.strip() == "[DONE]":
+                    if raw == b"[DONE]":
                         break
 
                     try:
-                        data = json.loads(raw_json)
-                    except json.JSONDecodeError:
-                        logger.warning(f"Failed to parse JSON: {raw_json[:100]}")
+                        data = json_loads(raw)
+                    except ValueError:
+                        logger.warning("Failed to parse JSON: %.100r", raw)
                         continue
 
-                    # Store all events for later citation extraction
-                    state.all_events.append(data)
+                    if state.recent_events is not None:
+                        state.recent_events.append(data)
                     event_type = data.get("type")
-
-                    # Message start - capture initial usage
-                    if event_type == "message_start":
-                        message_data = data.get("message", {})
-                        if "usage" in message_data:
-                            final_usage = message_data["usage"]
-
-                    # Content block start
-                    elif event_type == "content_block_start":
-                        content_block = data.get("content_block", {})
-                        block_type = content_block.get("type")
-                        state.current_block_type = block_type
-                        state.current_block_index = data.get("index", 0)
-
-                        if block_type == "thinking":
-                            # DON'T set state here - let first thinking_delta open the tag
-                            logger.debug("Thinking content block started")
-
-                        elif block_type == "text":
-                            # Check for citations in this text block
-                            if "citations" in content_block:
-                                logger.info(f"Found {len(content_block['citations'])} citations in content_block_start")
-                                for cit in content_block["citations"]:
-                                    state.citations.append(CitationData(
-                                        url=cit.get("url", ""),
-                                        title=cit.get("title", ""),
-                                        cited_text=cit.get("cited_text", ""),
-                                        encrypted_index=cit.get("encrypted_index", "")
-                                    ))
-
-                            # Response starting - close thinking tag if open
-                            if state.thinking_state == ThinkingState.IN_PROGRESS:
-                                yield "\n</think>\n\n"
-                                state.thinking_state = ThinkingState.COMPLETED
-                                logger.debug("Thinking completed, response starting")
-
-                        elif block_type == "server_tool_use":
-                            tool_name = content_block.get("name")
-                            logger.info(f"Server tool use: {tool_name}, block_index={state.current_block_index}")
-                            if tool_name == "web_search":
-                                # Safely extract query - input might be a string or dict
-                                input_data = content_block.get("input", {})
-                                logger.info(f"Input data type: {type(input_data)}, value: {input_data}")
-                                if isinstance(input_data, dict):
-                                    query = input_data.get("query", "")
-                                    logger.info(f"Query from input dict: '{query}'")
-                                else:
-                                    query = ""  # Will be populated by input_json_delta
-                                    logger.info(f"Input is not dict, query will come from input_json_delta")
-                                state.current_search = WebSearchResult(query=query)
-                                logger.info(f"Created search object with query='{query}', block_index={state.current_block_index}")
-
-                        elif block_type == "web_search_tool_result":
-                            # Capture search results - they're in a "content" array
-                            logger.info(f"web_search_tool_result block, current_search={'exists' if state.current_search else 'None'}")
-                            if state.current_search:
-                                content_array = content_block.get("content", [])
-                                logger.info(f"Result content_array has {len(content_array)} items")
-                                # Extract web_search_result items
-                                results = []
-                                for item in content_array:
-                                    if item.get("type") == "web_search_result":
-                                        results.append({
-                                            "title": item.get("title", ""),
-                                            "url": item.get("url", ""),
-                                            "page_age": item.get("page_age", "")
-                                            # Note: encrypted_content is for Claude's use, not display
-                                        })
-                                state.current_search.results = results
-                                logger.info(f"Captured {len(results)} search results. Current query: '{state.current_search.query}'")
-
-                    # Content block delta
-                    elif event_type == "content_block_delta":
-                        delta = data.get("delta", {})
-                        delta_type = delta.get("type")
-
-                        if delta_type == "thinking_delta":
-                            thinking_text = delta.get("thinking", "")
-                            state.thinking_buffer += thinking_text
-                            # Start <think> tag on first thinking delta
-                            if state.thinking_state == ThinkingState.NOT_STARTED:
-                                yield "\n<think>\n"
-                                state.thinking_state = ThinkingState.IN_PROGRESS
-                            # Stream thinking text in real-time
-                            yield thinking_text
-
-                        elif delta_type == "input_json_delta":
-                            # Web search query streaming - accumulate partial JSON fragments!
-                            partial_json = delta.get("partial_json", "")
-                            logger.info(f"input_json_delta received, fragment: {partial_json[:50]}")
-                            if state.current_search:
-                                # Accumulate the fragment
-                                state.current_search.partial_json_buffer += partial_json
-                                logger.debug(f"Buffer now: {state.current_search.partial_json_buffer[:100]}")
-
-                                # Try to parse the accumulated buffer
-                                try:
-                                    parsed = json.loads(state.current_search.partial_json_buffer)
-                                    logger.info(f"✅ Successfully parsed accumulated JSON: {parsed}")
-                                    if "query" in parsed:
-                                        state.current_search.query = parsed["query"]
-                                        logger.info(f"✅ Extracted search query: '{parsed['query']}'")
-                                    else:
-                                        logger.warning(f"No 'query' field in parsed JSON: {parsed}")
-                                except json.JSONDecodeError as e:
-                                    # Still incomplete - keep accumulating
-                                    logger.debug(f"Buffer not yet complete JSON, continuing to accumulate...")
-                            else:
-                                logger.warning(f"⚠️ input_json_delta received but state.current_search is None!")
-
-                        elif delta_type == "text_delta":
-                            text = delta.get("text", "")
-                            state.response_buffer += text
-                            # Close thinking tag if still open
-                            if state.thinking_state == ThinkingState.IN_PROGRESS:
-                                yield "\n</think>\n\n"
-                                state.thinking_state = ThinkingState.COMPLETED
-                            # Stream response text
-                            yield text
-
-                    # Content block stop
-                    elif event_type == "content_block_stop":
-                        stop_index = data.get("index", -1)
-                        logger.info(f"content_block_stop for block_index={stop_index}, block_type={state.current_block_type}")
-                        if state.current_block_type == "web_search_tool_result":
-                            # Finalize current search (display at end instead of inline)
-                            if state.current_search:
-                                logger.info(f"🔚 Finalizing search with query='{state.current_search.query}' and {len(state.current_search.results)} results")
-                                state.web_searches.append(state.current_search)
-
-                                # Just log, don't display inline
-                                if state.current_search.results:
-                                    logger.info(f"Search '{state.current_search.query}' found {len(state.current_search.results)} results")
-
-                                logger.info(f"Setting state.current_search = None")
-                                state.current_search = None
-                                state.current_search_results = []
-
-                    # Message delta - update usage and check for citations
-                    elif event_type == "message_delta":
-                        if "usage" in data:
-                            final_usage.update(data["usage"])
-                        # Check if message delta contains complete content blocks with citations
-                        if "delta" in data and "content" in data["delta"]:
-                            content_blocks = data["delta"]["content"]
-                            for block in content_blocks:
-                                if block.get("type") == "text" and "citations" in block:
-                                    logger.info(f"Found {len(block['citations'])} citations in message_delta")
-                                    for cit in block["citations"]:
-                                        state.citations.append(CitationData(
-                                            url=cit.get("url", ""),
-                                            title=cit.get("title", ""),
-                                            cited_text=cit.get("cited_text", ""),
-                                            encrypted_index=cit.get("encrypted_index", "")
-                                        ))
-
-                    # Message stop
-                    elif event_type == "message_stop":
-                        # Close thinking tag if still open
-                        if state.thinking_state == ThinkingState.IN_PROGRESS:
-                            yield "\n</think>\n"
-                            state.thinking_state = ThinkingState.COMPLETED
-
-                # Extract citations from all events
-                logger.info(f"Processing {len(state.all_events)} events for citations")
-
-                for event in state.all_events:
-                    event_type = event.get("type")
-
-                    # Check message_start for complete message structure
-                    if event_type == "message_start":
-                        message = event.get("message", {})
-                        content = message.get("content", [])
-                        for block in content:
-                            if block.get("type") == "text" and "citations" in block:
-                                logger.info(f"Found {len(block['citations'])} citations in message_start")
-                                for cit in block["citations"]:
-                                    state.citations.append(CitationData(
-                                        url=cit.get("url", ""),
-                                        title=cit.get("title", ""),
-                                        cited_text=cit.get("cited_text", ""),
-                                        encrypted_index=cit.get("encrypted_index", "")
-                                    ))
-
-                    # Check content_block_stop for complete blocks
-                    elif event_type == "content_block_stop":
-                        # Some streaming implementations include the complete block here
-                        if "content_block" in event:
-                            block = event["content_block"]
-                            if block.get("type") == "text" and "citations" in block:
-                                logger.info(f"Found {len(block['citations'])} citations in content_block_stop")
-                                for cit in block["citations"]:
-                                    state.citations.append(CitationData(
-                                        url=cit.get("url", ""),
-                                        title=cit.get("title", ""),
-                                        cited_text=cit.get("cited_text", ""),
-                                        encrypted_index=cit.get("encrypted_index", "")
-                                    ))
+                    event_count += 1
+                    if debug and event_count % sample_rate == 0:
+                        logger.debug(
+                            "stream event n=%d type=%s", event_count, event_type,
+                            extra=log_fields("stream_event", n=event_count, type=event_type)
+                        )
+
+                    handler = handlers.get(event_type)
+                    if handler is None:
+                        if debug:
+                            logger.debug("Unhandled stream event type=%s", event_type)
+                        continue
+                    output = handler(state, data)
+                    if output:
+                        for chunk in output:
+                            yield chunk
 
                 # Show web searches in collapsible section (no icon)
                 if self.valves.SHOW_WEB_SEARCH_DETAILS and state.web_searches:
@@ -910,11 +3830,9 @@ class Pipe:
                                 yield f"  {j}. {title}\n"
                         yield "\n"
                     yield "</details>\n\n"
-                    logger.info(f"Displayed {len(state.web_searches)} web searches in collapsible section")
 
                 # Emit citation events for clickable chips
                 if state.citations:
-                    logger.info(f"Emitting {len(state.citations)} formal citations as citation chips")
                     for i, citation in enumerate(state.citations, 1):
                         # Build document text with cited text if available
                         document_text = citation.title
@@ -938,11 +3856,8 @@ class Pipe:
                                     }
                                 }
                             })
-                    logger.info(f"Emitted {len(state.citations)} formal citation events")
                 # Fallback: If no formal citations but we have web searches, emit as citation events
                 elif state.web_searches and any(s.results for s in state.web_searches):
-                    logger.info("No formal citations, emitting web search results as citation chips")
-
                     ref_num = 1
                     for search in state.web_searches:
                         for result in search.results:
@@ -971,51 +3886,142 @@ class Pipe:
                                 })
                             ref_num += 1
 
-                    logger.info(f"Emitted {ref_num - 1} citation events")
 
                 # Show token usage (no icon)
-                if final_usage:
-                    usage_formatted = self._format_token_usage(final_usage)
+                if state.usage:
+                    usage_formatted = self._format_token_usage(state.usage)
                     if usage_formatted:
                         yield usage_formatted
 
-        except requests.exceptions.Timeout:
+                if "output_tokens" in state.usage:
+                    self._output_lengths.append(state.usage["output_tokens"])
+                logger.info(
+                    "Stream complete: events=%d searches=%d citations=%d output_tokens=%s",
+                    event_count, len(state.web_searches), len(state.citations),
+                    state.usage.get("output_tokens"),
+                    extra=log_fields(
+                        "stream_complete", events=event_count, searches=len(state.web_searches),
+                        citations=len(state.citations), usage=state.usage,
+                        conversation_id=state.conversation_id
+                    )
+                )
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client went away (task cancelled or generator closed) - let it
+            # propagate so aclosing() drops the upstream connection right now
+            # and Anthropic stops generating
+            self._record_abort(state, payload)
+            raise
+
+        except RetryableStreamError as e:
+            delay = self._retry_delay(budget)
+            self._dump_recent_events(state, logging.WARNING if delay is not None else logging.ERROR, "error event")
+            if delay is None:
+                logger.error("Stream error event: %s", e.error)
+                yield f"\n\n❌ **API Error ({e.error.get('type', 'error')})**: {e.error.get('message', '')}"
+                return
+            logger.warning(
+                "Stream %s before output, retrying in %.1fs (attempt %d/%d)",
+                e.error.get("type"), delay, budget.attempts, self.valves.RETRY_MAX_ATTEMPTS,
+                extra=log_fields("retry", reason=e.error.get("type"), delay=delay, attempt=budget.attempts)
+            )
+            await asyncio.sleep(delay)
+            # aclosing() so a disconnect during the retry closes it at once
+            # instead of leaving it to the garbage collector
+            async with aclosing(self._stream_chunks(
+                url, headers, payload, user_valves, __event_emitter__, __user__,
+                _budget=budget, _state=state, _stalls=_stalls
+            )) as retry_chunks:
+                async for chunk in retry_chunks:
+                    yield chunk
+
+        except httpx.ReadTimeout:
+            self._dump_recent_events(
+                state, logging.WARNING if _stalls < self.valves.STREAM_STALL_RETRIES else logging.ERROR, "stall"
+            )
+            if _stalls >= self.valves.STREAM_STALL_RETRIES:
+                logger.error("Stream stalled, no continuations left")
+                yield "\n\n⏱️ **Request timed out**. Partial response may be shown above."
+                return
+            logger.warning(
+                "Stream stalled after ~%d output tokens, continuing (%d/%d)",
+                state.output_chars // 4, _stalls + 1, self.valves.STREAM_STALL_RETRIES,
+                extra=log_fields("stream_stall", output_tokens=state.output_chars // 4, continuation=_stalls + 1)
+            )
+            if state.thinking_state == ThinkingState.IN_PROGRESS:
+                # Thinking cannot be resumed; the continuation answers directly
+                yield THINK_CLOSE
+                state.thinking_state = ThinkingState.COMPLETED
+            # The stalled leg is billed too, but never reports its final output_tokens
+            state.usage_offset = dict(state.usage)
+            state.usage_offset["output_tokens"] = max(state.usage.get("output_tokens", 0), state.output_chars // 4)
+            # Blocks left open by the stalled stream are abandoned
+            state.current_block_type = None
+            state.current_tool = None
+            state.current_search = None
+            if __event_emitter__:
+                await __event_emitter__({
+                    "type": "status",
+                    "data": {"description": "Connection stalled, resuming…", "done": True}
+                })
+            async with aclosing(self._stream_chunks(
+                url, headers, self._continuation_payload(payload, state, _stalls), user_valves,
+                __event_emitter__, __user__,
+                _budget=budget, _state=state, _stalls=_stalls + 1
+            )) as resumed_chunks:
+                async for chunk in resumed_chunks:
+                    yield chunk
+
+        except AdmissionTimeout:
+            logger.warning("Request timed out waiting for an upstream slot")
+            yield "⏳ **Server busy**. Too many requests are in progress, please try again shortly."
+
+        except httpx.TimeoutException:
             error_msg = "\n\n⏱️ **Request timed out**. Partial response may be shown above."
             logger.error("Request timeout")
+            self._dump_recent_events(state, logging.ERROR, "timeout")
             yield error_msg
 
-        except requests.exceptions.ConnectionError:
+        except httpx.TransportError:
             error_msg = "\n\n🔌 **Connection error**. Please check your internet connection."
             logger.error("Connection error")
+            self._dump_recent_events(state, logging.ERROR, "connection error")
             yield error_msg
 
         except Exception as e:
             error_msg = f"\n\n❌ **Unexpected error**: {str(e)}"
-            logger.error(f"Unexpected error in stream_response: {e}", exc_info=True)
+            logger.error("Unexpected error in stream_response: %s", e, exc_info=True)
+            self._dump_recent_events(state, logging.ERROR, "unexpected error")
             yield error_msg
 
+        finally:
+            self._release(slot)
+
     # ==================== NON-STREAMING IMPLEMENTATION ====================
 
-    def non_stream_response(
+    async def non_stream_response(
         self,
         url: str,
         headers: Dict[str, str],
         payload: Dict[str, Any],
-        user_valves
+        user_valves,
+        __event_emitter__=None,
+        __user__=None,
+        conversation_id: Optional[str] = None
     ) -> str:
         """Handle non-streaming requests"""
+        slot = None
         try:
-            response = requests.post(
-                url,
-                headers=headers,
-                json=payload,
-                timeout=(30, self.valves.REQUEST_TIMEOUT)
+            slot = await self._admit(__user__, __event_emitter__)
+            await self._acquire_rate_limit(self._estimate_input_tokens(payload), __event_emitter__)
+            response = await self._send_with_retry(
+                url, headers, payload, stream=False
             )
 
             if response.status_code != 200:
                 return f"Error: API Error ({response.status_code}): {response.text}"
 
-            data = response.json()
+            data = json_loads(response.content)
             content_parts = []
             thinking_parts = []
             citations = []
@@ -1047,14 +4053,29 @@ class Pipe:
                 result += "".join(content_parts)
 
             if "usage" in data:
+                self._observe_cache_usage(conversation_id, data["usage"])
                 result += self._format_token_usage(data["usage"])
 
             return result if result else "No response generated"
 
+        except asyncio.CancelledError:
+            raise
+
+        except httpx.TimeoutException:
+            logger.error("Request timeout in non_stream_response")
+            return "Error: Request timed out"
+
+        except AdmissionTimeout:
+            logger.warning("Request timed out waiting for an upstream slot")
+            return "Error: Server busy, too many requests are in progress. Please try again shortly."
+
         except Exception as e:
-            logger.error(f"Error in non_stream_response: {e}", exc_info=True)
+            logger.error("Error in non_stream_response: %s", e, exc_info=True)
             return f"Error: {str(e)}"
 
+        finally:
+            self._release(slot)
+
     # ==================== MAIN ENTRY POINT ====================
 
     async def pipe(
@@ -1062,7 +4083,8 @@ class Pipe:
         body: Dict[str, Any],
         __user__: Optional[Dict[str, Any]] = None,
         __event_emitter__=None,
-        __event_call__=None
+        __event_call__=None,
+        __metadata__: Optional[Dict[str, Any]] = None
     ):
         """Main entry point for request processing"""
 
@@ -1073,44 +4095,79 @@ class Pipe:
         if "messages" not in body or not body["messages"]:
             return "Error: No messages in request"
 
-        # Check for conflicting domain filters
-        if (self.valves.WEB_SEARCH_DOMAIN_ALLOWLIST and
-            self.valves.WEB_SEARCH_DOMAIN_BLOCKLIST):
-            return "Error: Cannot use both allowed_domains and blocked_domains. Please use only one."
+        # Get user valves
+        user_valves = self.user_valves
+        if __user__ and hasattr(__user__, "valves"):
+            user_valves = __user__.valves
 
+        # Valve-derived headers / tools / thinking, rebuilt only when valves change
         try:
-            # Get user valves
-            user_valves = self.user_valves
-            if __user__ and hasattr(__user__, "valves"):
-                user_valves = __user__.valves
+            profile = self._get_profile(user_valves)
+        except ValueError as e:
+            return f"Error: {e}"
 
+        self._configure_logging()
+        self._schedule_cache_warmup()
+
+        try:
             # Extract and process messages
             system_message, messages = pop_system_message(body.get("messages", []))
+            # OpenWebUI hands back the whole {"role": "system", ...} message
+            if isinstance(system_message, dict):
+                system_message = system_message.get("content")
             if not messages:
                 return "Error: No user messages provided"
+            if self.valves.ENABLE_CACHE_WARMUP:
+                self._record_system_prompt(system_message)
 
-            processed_messages = self._process_messages(messages)
+            conversation_id = (__metadata__ or {}).get("chat_id") or body.get("chat_id")
+            # Background tasks (title, tags, follow-ups) reuse the chat's id
+            task = (__metadata__ or {}).get("task")
+            processed_messages = self._process_messages(messages, conversation_id, memoize=not task)
+            known_hashes = {} if task else self._message_cache.hashes(conversation_id or "")
 
             # Prepare request
-            headers = self._get_headers(user_valves)
+            headers = dict(profile.headers)
+            if self.valves.ENABLE_IMAGE_PREPROCESSING and Image is not None:
+                await self._preprocess_images(processed_messages, known_hashes)
+            if self.valves.ENABLE_IMAGE_FILE_CACHE and await self._upload_images(processed_messages, known_hashes):
+                self._add_beta(headers, self.FILES_API_BETA)
             payload = self._prepare_payload(
-                body, processed_messages, system_message, user_valves
+                body, processed_messages, system_message, profile, conversation_id, background=bool(task)
             )
+            if self.valves.CACHE_TTL == "auto" and self._uses_extended_cache_ttl(payload):
+                self._add_beta(headers, self.EXTENDED_CACHE_TTL_BETA)
+            if self.valves.ENABLE_CACHE_KEEPALIVE and conversation_id and not task:
+                self._track_keepalive(conversation_id, headers, payload, __user__)
             url = f"{self.API_BASE_URL}/messages"
 
             logger.info(
-                f"Request: model={payload['model']}, stream={payload['stream']}, "
-                f"max_tokens={payload['max_tokens']}, thinking={bool(payload.get('thinking'))}, "
-                f"tools={len(payload.get('tools', []))}"
+                "Request: model=%s, stream=%s, max_tokens=%d, thinking=%s, tools=%d",
+                payload["model"], payload["stream"], payload["max_tokens"],
+                bool(payload.get("thinking")), len(payload.get("tools", [])),
+                extra=log_fields(
+                    "request", model=payload["model"], stream=payload["stream"],
+                    max_tokens=payload["max_tokens"], thinking=bool(payload.get("thinking")),
+                    tools=len(payload.get("tools", [])), conversation_id=conversation_id, task=task
+                )
             )
 
+            # Only the chat's own turns are scored against the cache TTL
+            # predictions (and the keepalive)
+            if task:
+                conversation_id = None
+
             # Execute request
             if payload.get("stream", True):
                 return self.stream_response(
-                    url, headers, payload, user_valves, __event_emitter__
+                    url, headers, payload, user_valves, __event_emitter__, __user__,
+                    conversation_id=conversation_id
                 )
             else:
-                return self.non_stream_response(url, headers, payload, user_valves)
+                return await self.non_stream_response(
+                    url, headers, payload, user_valves, __event_emitter__, __user__,
+                    conversation_id=conversation_id
+                )
 
         except Exception as e:
             error_msg = f"Error: {str(e)}"
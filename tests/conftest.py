@@ -0,0 +1,107 @@
+"""
+Shared fixtures: function.py loaded as a module, pipes built from it and a
+mocked Anthropic API.
+
+function.py runs inside OpenWebUI and imports one helper from it. Where
+OpenWebUI is not installed, a stand-in with the same contract is used.
+"""
+
+import asyncio
+import importlib.util
+import sys
+import types
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+import pytest
+
+
+def pop_system_message(messages: List[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    """open_webui.utils.misc.pop_system_message: the system message *dict* (or None) and the rest"""
+    system = next((message for message in messages if message["role"] == "system"), None)
+    return system, [message for message in messages if message["role"] != "system"]
+
+
+def install_open_webui_stub() -> None:
+    try:
+        import open_webui.utils.misc  # noqa: F401
+        return
+    except ImportError:
+        pass
+    for name in ("open_webui", "open_webui.utils"):
+        package = types.ModuleType(name)
+        package.__path__ = []
+        sys.modules[name] = package
+    misc = types.ModuleType("open_webui.utils.misc")
+    misc.pop_system_message = pop_system_message
+    sys.modules["open_webui.utils.misc"] = misc
+    sys.modules["open_webui"].utils = sys.modules["open_webui.utils"]
+    sys.modules["open_webui.utils"].misc = misc
+
+
+install_open_webui_stub()
+
+
+def load_function_module():
+    """A fresh copy of function.py, as OpenWebUI loads (and reloads) it"""
+    path = Path(__file__).resolve().parent.parent / "function.py"
+    spec = importlib.util.spec_from_file_location("function", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def fn():
+    return load_function_module()
+
+
+@pytest.fixture
+def make_pipe(fn) -> Callable[..., Any]:
+    """Pipe factory: a test API key, logging without the queue thread, then ``valves``"""
+    def make(**valves):
+        pipe = fn.Pipe()
+        pipe.valves.ANTHROPIC_API_KEY = "test"
+        pipe.valves.LOG_NONBLOCKING = False
+        for name, value in valves.items():
+            setattr(pipe.valves, name, value)
+        return pipe
+    return make
+
+
+@pytest.fixture
+def run_pipe() -> Callable[[Any, Callable[[Any], Awaitable[Any]]], Any]:
+    """Run ``scenario(pipe)`` in a fresh event loop, then shut the pipe down"""
+    def run(pipe, scenario):
+        async def main():
+            try:
+                return await scenario(pipe)
+            finally:
+                await pipe.on_shutdown()
+        return asyncio.run(main())
+    return run
+
+
+class EventStream(httpx.AsyncByteStream):
+    """Response body produced lazily, so the body itself holds no memory"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = chunks
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for chunk in self.chunks:
+            yield chunk
+
+
+@pytest.fixture
+def mock_api(monkeypatch) -> Callable[[Callable[[httpx.Request], httpx.Response]], None]:
+    """Route every AsyncClient the pipe builds to handler(request) -> Response"""
+    real_client = httpx.AsyncClient
+
+    def install(handler: Callable[[httpx.Request], httpx.Response]) -> None:
+        def client(**kwargs) -> httpx.AsyncClient:
+            return real_client(transport=httpx.MockTransport(handler), timeout=kwargs.get("timeout"))
+        monkeypatch.setattr(httpx, "AsyncClient", client)
+
+    return install
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def queue(controller, admitted, name: str, user_id: str, weight: float, timeout: float = 10):
+    """Start a request that records its name once admitted and keeps its slot"""
+    async def request():
+        await controller.acquire(user_id, weight, timeout)
+        admitted.append(name)
+    return asyncio.ensure_future(request())
+
+
+def test_weighted_fair_order_and_cancelled_waiter(fn):
+    async def run():
+        controller = fn.AdmissionController()
+        controller.configure(global_limit=4, user_limit=0)
+        for _ in range(4):
+            await controller.acquire("holder", 1.0, 10)
+
+        admitted = []
+        tasks = {name: queue(controller, admitted, name, "a", 1.0) for name in ("a1", "a2", "a3", "a4")}
+        tasks.update({name: queue(controller, admitted, name, "b", 3.0) for name in ("b1", "b2", "b3", "b4")})
+        await settle()
+        assert admitted == [] and controller.active_total == 4
+
+        tasks["a2"].cancel()
+        await settle()
+        assert [waiter.user_id for waiter in controller.waiting["a"]] == ["a"] * 3
+
+        # Each freed slot goes to the user with the fewest active requests
+        # per unit of weight, oldest waiter first on ties
+        for _ in range(4):
+            controller.release("holder")
+            await settle()
+        assert admitted == ["a1", "b1", "b2", "b3"]
+        for user_id in ("a", "b", "b"):
+            controller.release(user_id)
+            await settle()
+        assert admitted == ["a1", "b1", "b2", "b3", "a3", "b4", "a4"]
+
+        for user_id in ("a", "a", "b", "b"):
+            controller.release(user_id)
+        assert tasks["a2"].cancelled()
+        return controller
+
+    controller = asyncio.run(run())
+    assert (controller.active_total, controller.active, controller.waiting) == (0, {}, {})
+
+
+def test_waiter_cancelled_after_admission_hands_the_slot_on(fn):
+    async def run():
+        controller = fn.AdmissionController()
+        controller.configure(global_limit=1, user_limit=0)
+        await controller.acquire("holder", 1.0, 10)
+        admitted = []
+        first = queue(controller, admitted, "first", "a", 1.0)
+        second = queue(controller, admitted, "second", "b", 1.0)
+        await settle()
+
+        # The slot reaches "first", which gives up before it resumes
+        controller.release("holder")
+        first.cancel()
+        await settle()
+        assert first.cancelled() and admitted == ["second"]
+        controller.release("b")
+        await second
+        return controller
+
+    controller = asyncio.run(run())
+    assert (controller.active_total, controller.active, controller.waiting) == (0, {}, {})
+
+
+def test_timed_out_waiter_leaves_the_queue(fn):
+    async def run():
+        controller = fn.AdmissionController()
+        controller.configure(global_limit=1, user_limit=0)
+        await controller.acquire("holder", 1.0, 10)
+        with pytest.raises(fn.AdmissionTimeout):
+            await controller.acquire("a", 1.0, 0.05)
+        assert not controller.waiting
+        controller.release("holder")
+        return controller
+
+    controller = asyncio.run(run())
+    assert (controller.active_total, controller.active) == (0, {})
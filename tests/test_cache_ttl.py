@@ -0,0 +1,12 @@
+def test_background_tasks_are_not_counted_as_turns(make_pipe, run_pipe):
+    messages = [{"role": "user", "content": "hello " * 2000}]
+
+    async def scenario(pipe):
+        # Streaming returns a generator, so no request is sent
+        await pipe.pipe({"messages": messages, "stream": True},
+                        __metadata__={"chat_id": "c1", "task": "title_generation"})
+        assert pipe._cache_ttl.last_request is None and not pipe._cache_ttl.conversations
+        await pipe.pipe({"messages": messages, "stream": True}, __metadata__={"chat_id": "c1"})
+        assert pipe._cache_ttl.last_request is not None and "c1" in pipe._cache_ttl.conversations
+
+    run_pipe(make_pipe(CACHE_TTL="auto"), scenario)
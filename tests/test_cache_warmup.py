@@ -0,0 +1,76 @@
+import asyncio
+import hashlib
+import json
+import time
+
+import httpx
+
+OLD_PROMPT = "You review contracts. " * 1200
+CURRENT_PROMPT = "You are a helpful assistant. " * 1200
+
+
+async def wait_for_warmup(pipe):
+    while pipe._warmup_task is not None:
+        await asyncio.sleep(0.01)
+
+
+def first_request(system: str):
+    """Scenario: one streaming request on a fresh worker, then let the warmup finish"""
+    async def scenario(pipe):
+        # Streaming returns a generator, so only the warmup reaches the API
+        await pipe.pipe({"messages": [{"role": "system", "content": system},
+                                      {"role": "user", "content": "hi"}], "stream": True})
+        await wait_for_warmup(pipe)
+    return scenario
+
+
+def warmed_prompts(mock_api):
+    warmed = []
+
+    def handler(request):
+        warmed.extend(block["text"] for block in json.loads(request.content).get("system", []))
+        return httpx.Response(200, json={"usage": {"cache_creation_input_tokens": 6000}})
+
+    mock_api(handler)
+    return warmed
+
+
+def test_prompts_are_not_written_to_disk_by_default(make_pipe, run_pipe, tmp_path, monkeypatch, mock_api):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    mock_api(lambda request: httpx.Response(200, json={"usage": {}}))
+
+    run_pipe(make_pipe(ENABLE_CACHE_WARMUP=True), first_request(CURRENT_PROMPT))
+    assert not list(tmp_path.iterdir())
+
+    run_pipe(make_pipe(ENABLE_CACHE_WARMUP=True, CACHE_WARMUP_PERSIST_PROMPTS=True), first_request(CURRENT_PROMPT))
+    stored = json.loads((tmp_path / "anthropic_system_prompts.json").read_text())
+    assert [entry[0] for entry in stored.values()] == [CURRENT_PROMPT]
+
+
+def test_warmup_skips_prompts_the_first_request_writes(make_pipe, run_pipe, tmp_path, monkeypatch, mock_api):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    now = time.time()
+    (tmp_path / "anthropic_system_prompts.json").write_text(json.dumps({
+        hashlib.sha256(OLD_PROMPT.encode()).hexdigest(): [OLD_PROMPT, 5, now - 3600],
+        hashlib.sha256(CURRENT_PROMPT.encode()).hexdigest(): [CURRENT_PROMPT, 9, now - 3600],
+    }))
+    warmed = warmed_prompts(mock_api)
+    run_pipe(make_pipe(ENABLE_CACHE_WARMUP=True, CACHE_WARMUP_PERSIST_PROMPTS=True), first_request(CURRENT_PROMPT))
+    # The request itself writes CURRENT_PROMPT; warming it too would pay the write twice
+    assert warmed == [OLD_PROMPT]
+
+
+def test_in_memory_prompts_are_warmed_after_a_valve_save(make_pipe, run_pipe, tmp_path, monkeypatch, mock_api):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    warmed = warmed_prompts(mock_api)
+
+    async def scenario(pipe):
+        await first_request(CURRENT_PROMPT)(pipe)
+        # Nothing was known at startup; the request recorded its prompt in memory
+        assert warmed == []
+        pipe.valves.CACHE_WARMUP_MAX_PROMPTS = 2  # a valve save
+        pipe.pipes()
+        await wait_for_warmup(pipe)
+
+    run_pipe(make_pipe(ENABLE_CACHE_WARMUP=True), scenario)
+    assert warmed == [CURRENT_PROMPT]
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import httpx
+
+
+def test_reupload_after_expiry_evicts_the_old_file(fn, tmp_path):
+    cache = fn.FileIdCache(str(tmp_path / "index.json"))
+    assert cache.put("key", "file_old", max_entries=10, ttl=60) == []
+
+    cache.entries["key"][1] = time.time() - 120  # last used two minutes ago
+    assert cache.get("key", ttl=60) is None
+
+    # The re-upload takes the key over; the old upload must still be deleted
+    assert cache.put("key", "file_new", max_entries=10, ttl=60) == ["file_old"]
+    assert cache.get("key", ttl=60) == "file_new"
+
+
+def test_put_evicts_expired_and_least_recently_used(fn, tmp_path):
+    cache = fn.FileIdCache(str(tmp_path / "index.json"))
+    cache.put("a", "file_a", max_entries=2, ttl=60)
+    cache.put("b", "file_b", max_entries=2, ttl=60)
+    cache.entries["a"][1] = time.time() - 120
+    assert cache.put("c", "file_c", max_entries=2, ttl=60) == ["file_a"]
+    assert cache.put("d", "file_d", max_entries=2, ttl=60) == ["file_b"]
+    assert list(cache.entries) == ["c", "d"]
+
+
+def image_message(data: str):
+    return [{"role": "user", "content": [{"type": "image", "source": {
+        "type": "base64", "media_type": "image/png", "data": data}}]}]
+
+
+def files_api(mock_api, deleted):
+    uploads = []
+
+    async def handler(request):
+        if request.method == "DELETE":
+            deleted.append(request.url.path.rsplit("/", 1)[-1])
+            return httpx.Response(200, json={})
+        uploads.append(request)
+        file_id = f"file_{len(uploads)}"
+        await asyncio.sleep(0.01)  # keep concurrent uploads in flight together
+        return httpx.Response(200, json={"id": file_id})
+
+    mock_api(handler)
+
+
+def sent_file_id(messages):
+    return messages[0]["content"][0]["source"]["file_id"]
+
+
+def test_concurrent_uploads_of_one_image_share_the_first_file(make_pipe, run_pipe, mock_api, tmp_path):
+    deleted = []
+    files_api(mock_api, deleted)
+    first, second = image_message("aGVsbG8="), image_message("aGVsbG8=")
+
+    async def scenario(pipe):
+        await asyncio.gather(pipe._upload_images(first, {}), pipe._upload_images(second, {}))
+        while pipe._delete_task is not None:
+            await asyncio.sleep(0.01)
+
+    run_pipe(make_pipe(IMAGE_CACHE_PATH=str(tmp_path / "index.json")), scenario)
+    # Neither request loses its file; only the duplicate upload is deleted
+    assert sent_file_id(first) == sent_file_id(second)
+    assert deleted == list({"file_1", "file_2"} - {sent_file_id(first)})
+
+
+def test_evicted_files_are_deleted_later_in_the_background(make_pipe, run_pipe, mock_api, tmp_path):
+    deleted = []
+    files_api(mock_api, deleted)
+    pipe = make_pipe(IMAGE_CACHE_PATH=str(tmp_path / "index.json"), IMAGE_CACHE_MAX_ENTRIES=1)
+
+    async def scenario(pipe):
+        await pipe._upload_images(image_message("aGVsbG8="), {})
+        await pipe._upload_images(image_message("d29ybGQ="), {})
+        await asyncio.sleep(0.05)
+        return dict(pipe._pending_deletes)
+
+    pending = run_pipe(pipe, scenario)
+    # file_1 left the index, but a request that looked it up may still send it
+    assert deleted == [] and list(pending) == ["file_1"]
+    assert pending["file_1"] >= time.time() + pipe.FILE_DELETE_DELAY_SECONDS - 60
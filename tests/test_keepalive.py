@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import httpx
+
+THINKING = {"type": "enabled", "budget_tokens": 4000}
+TOOLS = [{"type": "web_search_20250305", "name": "web_search", "max_uses": 5}]
+
+
+def turn_payload(text: str, **fields):
+    return {
+        "model": "claude-sonnet-4-5", "max_tokens": 8192, "stream": True, **fields,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+        ]}]
+    }
+
+
+def refresh_request(make_pipe, run_pipe, headers, payload):
+    pipe = make_pipe(ENABLE_CACHE_KEEPALIVE=True)
+
+    async def scenario(pipe):
+        pipe._track_keepalive("c1", headers, payload, {"id": "u1"})
+
+    run_pipe(pipe, scenario)
+    entry = pipe._keepalive.entries["c1"]
+    return json.loads(entry.body), entry
+
+
+def test_refresh_cannot_answer_or_call_tools(fn, make_pipe, run_pipe):
+    # Interleaved thinking lets max_tokens go below the budget, which stays in the cache key
+    headers = {"anthropic-beta": "web-search-2025-03-05,interleaved-thinking-2025-05-14"}
+    body, entry = refresh_request(make_pipe, run_pipe, headers, turn_payload("q " * 3000, thinking=THINKING, tools=TOOLS))
+    assert (body["max_tokens"], body["thinking"], body["tools"], body["stream"]) == (1, THINKING, TOOLS, False)
+    assert len(body["messages"][-1]["content"]) == 1
+    assert entry.max_output_tokens == 1
+
+    # Without tools max_tokens must exceed the budget; the affordability check uses that ceiling
+    body, entry = refresh_request(make_pipe, run_pipe, {}, turn_payload("q " * 3000, thinking=THINKING))
+    assert body["max_tokens"] == entry.max_output_tokens == 4001
+    assert body["messages"][-1]["content"][-1]["text"] == fn.Pipe.KEEPALIVE_PROMPT
+
+
+def test_refresh_bills_server_tool_use(fn):
+    keepalive = fn.CacheKeepalive()
+    entry = fn.KeepaliveEntry(body=b"{}", headers={}, user_id="u1", prefix_tokens=1000, ttl=300.0,
+                              last_turn=0.0, touched=0.0, max_output_tokens=1)
+    usage = {"input_tokens": 0, "cache_read_input_tokens": 1000, "output_tokens": 0,
+             "server_tool_use": {"web_search_requests": 2}}
+    assert abs(keepalive.record_refresh("c1", entry, usage, 0.0) - (1000 * 0.1 * 3e-6 + 2 * 0.01)) < 1e-12
+
+
+def test_background_tasks_are_not_kept_alive(make_pipe, run_pipe):
+    pipe = make_pipe(ENABLE_CACHE_KEEPALIVE=True)
+
+    async def scenario(pipe):
+        await pipe.pipe({"messages": [{"role": "user", "content": "hello " * 2000}], "stream": True},
+                        __metadata__={"chat_id": "c1", "task": "follow_up_generation"})
+
+    run_pipe(pipe, scenario)
+    assert not pipe._keepalive.entries
+
+
+def test_unreadable_refresh_response_does_not_stop_other_refreshes(make_pipe, run_pipe, mock_api):
+    def handler(request):
+        if b"broken" in request.content:
+            return httpx.Response(200, content=b"<html>bad gateway</html>")
+        return httpx.Response(200, json={"usage": {"input_tokens": 5, "cache_read_input_tokens": 50000,
+                                                   "output_tokens": 1}})
+
+    mock_api(handler)
+    pipe = make_pipe(ENABLE_CACHE_KEEPALIVE=True)
+    pipe.KEEPALIVE_CHECK_SECONDS = 0.01
+    clock = [1000.0]
+    pipe._cache_ttl.clock = lambda: clock[0]
+    pipe._cache_ttl.turn_gaps.extend([400, 420, 450, 380])  # users come back after ~7 minutes
+
+    async def scenario(pipe):
+        for conversation_id in ("broken", "fine"):
+            pipe._track_keepalive(conversation_id, {}, turn_payload(conversation_id + " q" * 100000), {"id": "u1"})
+        clock[0] += 280  # both are 20 seconds from expiry
+        while pipe._keepalive_task is not None and pipe._keepalive.refreshes == 0:
+            await asyncio.sleep(0.01)
+
+    run_pipe(pipe, lambda pipe: asyncio.wait_for(scenario(pipe), 10))
+    assert pipe._keepalive.refreshes == 1
+    assert list(pipe._keepalive.entries) == ["fine"]
@@ -0,0 +1,63 @@
+import logging
+from logging.handlers import QueueHandler
+
+import pytest
+
+from conftest import load_function_module
+
+
+class Capture(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def root_handler():
+    handler = Capture()
+    logging.getLogger().addHandler(handler)
+    yield handler
+    logging.getLogger().removeHandler(handler)
+
+
+def queue_handlers(logger):
+    return [h for h in logger.handlers if isinstance(h, QueueHandler)]
+
+
+def test_reloaded_module_stops_previous_log_listener(fn, root_handler):
+    first = fn.Pipe()
+    first.valves.LOG_NONBLOCKING = True
+    first._log_config = None
+    first._configure_logging()
+    [old] = queue_handlers(fn.logger)
+
+    # A reload is a new module object and Pipe sharing the same logger
+    reloaded = load_function_module()
+    second = reloaded.Pipe()
+    try:
+        assert reloaded.logger is fn.logger
+        [new] = queue_handlers(fn.logger)
+        assert new is not old
+        assert old.listener._thread is None  # stopped and joined
+        assert new.listener._thread.is_alive()
+    finally:
+        second._stop_log_listener()
+    assert not queue_handlers(fn.logger) and fn.logger.propagate
+
+
+def test_structured_fields_survive_the_log_queue(fn, root_handler):
+    pipe = fn.Pipe()
+    pipe.valves.LOG_NONBLOCKING = True
+    pipe._log_config = None
+    pipe._configure_logging()
+    try:
+        fn.logger.info("Stream complete: events=%d", 42, extra=fn.log_fields("stream_complete", events=42))
+    finally:
+        pipe._stop_log_listener()  # flushes the queue
+
+    [record] = [r for r in root_handler.records if getattr(r, "event", None) == "stream_complete"]
+    assert record.getMessage() == "Stream complete: events=42"
+    assert record.fields == {"events": 42}
@@ -0,0 +1,40 @@
+import hashlib
+
+import httpx
+
+IMAGE = {"type": "image_url", "image_url": {"url": "data:image/png;base64,iVBORw0KGgo="}}
+
+
+def test_background_task_keeps_the_chat_memo(make_pipe, run_pipe):
+    chat = [{"role": "user", "content": [{"type": "text", "text": "what is this?"}, IMAGE]}]
+    title_task = [{"role": "user", "content": [{"type": "text", "text": "Generate a title"}, IMAGE]}]
+
+    async def scenario(pipe):
+        # Streaming returns a generator, so no request is sent
+        await pipe.pipe({"messages": chat, "stream": True}, __metadata__={"chat_id": "c1"})
+        memo = pipe._message_cache.get("c1")
+        await pipe.pipe({"messages": title_task, "stream": True},
+                        __metadata__={"chat_id": "c1", "task": "title_generation"})
+        return memo
+
+    pipe = make_pipe()
+    memo = run_pipe(pipe, scenario)
+    assert memo and pipe._message_cache.get("c1") is memo
+
+
+def test_image_hashes_live_with_the_memo(fn, make_pipe, run_pipe, mock_api, tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    mock_api(lambda request: httpx.Response(200, json={"id": "file_1"}))
+    chat = [{"role": "user", "content": [{"type": "text", "text": "what is this?"}, IMAGE]}]
+
+    async def scenario(pipe):
+        await pipe.pipe({"messages": chat, "stream": True}, __metadata__={"chat_id": "c1"})
+        return pipe._message_cache.hashes("c1")
+
+    pipe = make_pipe(ENABLE_IMAGE_FILE_CACHE=True, ENABLE_IMAGE_PREPROCESSING=False)
+    hashes = run_pipe(pipe, scenario)
+    assert list(hashes.values()) == [hashlib.sha256(b"iVBORw0KGgo=").hexdigest()]
+
+    # Strings outside the memo are hashed but not kept
+    known = {}
+    assert fn.content_hash("abc", known) == hashlib.sha256(b"abc").hexdigest() and not known
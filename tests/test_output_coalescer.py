@@ -0,0 +1,52 @@
+import httpx
+
+from conftest import EventStream
+from test_streaming import consume, sse
+
+
+def test_size_flush_on_a_structural_chunk_keeps_the_batch(fn):
+    coalescer = fn.OutputCoalescer(window=60, max_chars=10)
+    assert coalescer.push("x" * 8) is None
+    # The boundary itself reaches max_chars: one batch, nothing left behind
+    assert coalescer.push(fn.THINK_CLOSE, force=True) == "x" * 8 + fn.THINK_CLOSE
+    assert not coalescer.pending and coalescer.flush() == ""
+
+
+def test_time_flush_on_a_structural_chunk_keeps_the_batch(fn, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(fn.time, "monotonic", lambda: clock[0])
+    coalescer = fn.OutputCoalescer(window=0.05, max_chars=1000)
+    assert coalescer.push("thought") is None
+    clock[0] += 0.05
+    assert coalescer.push(fn.THINK_CLOSE, force=True) == "thought" + fn.THINK_CLOSE
+    assert coalescer.time_left() is None
+
+
+def test_forced_push_flushes_below_the_limits(fn):
+    coalescer = fn.OutputCoalescer(window=60, max_chars=1000)
+    assert coalescer.push("a") is None
+    assert coalescer.push(fn.THINK_OPEN, force=True) == "a" + fn.THINK_OPEN
+
+
+def test_stream_keeps_thinking_when_its_close_tag_fills_the_batch(fn, make_pipe, run_pipe, mock_api):
+    thinking = "t" * 81
+
+    def events():
+        yield sse({"type": "message_start", "message": {"usage": {"input_tokens": 10, "output_tokens": 1}}})
+        yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "thinking", "thinking": ""}})
+        yield sse({"type": "content_block_delta", "index": 0,
+                   "delta": {"type": "thinking_delta", "thinking": thinking}})
+        yield sse({"type": "content_block_stop", "index": 0})
+        yield sse({"type": "content_block_start", "index": 1, "content_block": {"type": "text", "text": ""}})
+        yield sse({"type": "content_block_delta", "index": 1, "delta": {"type": "text_delta", "text": "ANSWER"}})
+        yield sse({"type": "content_block_stop", "index": 1})
+        yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 5}})
+        yield sse({"type": "message_stop"})
+
+    mock_api(lambda request: httpx.Response(
+        200, headers={"content-type": "text/event-stream"}, stream=EventStream(events())
+    ))
+    # THINK_CLOSE takes the 81 pending characters past STREAM_COALESCE_MAX_CHARS
+    pipe = make_pipe(STREAM_COALESCE_MS=60000, STREAM_COALESCE_MAX_CHARS=90, STREAM_STALL_RETRIES=0)
+    output = run_pipe(pipe, consume)
+    assert output.startswith(fn.THINK_OPEN + thinking + fn.THINK_CLOSE + "ANSWER")
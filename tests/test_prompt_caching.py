@@ -0,0 +1,26 @@
+import json
+
+import httpx
+
+SYSTEM = "You are a helpful assistant. " * 1200
+
+
+def test_openwebui_system_message_is_cached(make_pipe, run_pipe, mock_api):
+    sent = []
+
+    def handler(request):
+        sent.append(json.loads(request.content))
+        return httpx.Response(200, json={"content": [{"type": "text", "text": "ok"}], "usage": {}})
+
+    mock_api(handler)
+    body = {"messages": [{"role": "system", "content": SYSTEM}, {"role": "user", "content": "hi"}], "stream": False}
+    assert run_pipe(make_pipe(), lambda pipe: pipe.pipe(body)) == "ok"
+    assert sent[0]["system"] == [{"type": "text", "text": SYSTEM, "cache_control": {"type": "ephemeral"}}]
+
+
+def test_unmarkable_system_is_left_alone(fn):
+    pipe = fn.Pipe()
+    payload = {"model": "claude-sonnet-4-5", "system": {"role": "system", "content": SYSTEM},
+               "messages": [{"role": "user", "content": "hi"}]}
+    pipe._apply_caching(payload)
+    assert payload["system"] == {"role": "system", "content": SYSTEM}
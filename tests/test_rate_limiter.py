@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import httpx
+
+
+def exhausted(fn, requests_per_minute: int):
+    """A limiter whose request bucket is empty and refills at the given rate"""
+    limiter = fn.RateLimiter()
+    limiter.update(httpx.Headers({
+        "anthropic-ratelimit-requests-limit": str(requests_per_minute),
+        "anthropic-ratelimit-requests-remaining": "0",
+    }))
+    return limiter
+
+
+async def release_times(limiter, count: int, max_wait: float):
+    start = time.monotonic()
+
+    async def one():
+        await limiter.acquire(0, max_wait)
+        return time.monotonic() - start
+
+    return await asyncio.gather(*(one() for _ in range(count)))
+
+
+def test_max_wait_bounds_every_concurrent_request(fn):
+    # 6/min: each request needs 10s of refill, far beyond max_wait
+    limiter = exhausted(fn, 6)
+    released = asyncio.run(release_times(limiter, 5, max_wait=0.5))
+    # Sleeping under a lock released these at 0.5 / 1.0 / 1.5 / 2.0 / 2.5s
+    assert max(released) < 0.8, released
+
+
+def test_concurrent_requests_are_paced_in_arrival_order(fn):
+    # 600/min: one request every 0.1s
+    limiter = exhausted(fn, 600)
+    released = asyncio.run(release_times(limiter, 5, max_wait=10))
+    assert released == sorted(released)
+    for expected, actual in zip((0.1, 0.2, 0.3, 0.4, 0.5), released):
+        assert abs(actual - expected) < 0.08, released
+
+
+def test_sync_keeps_reservations_of_sleeping_requests(fn):
+    limiter = exhausted(fn, 600)
+
+    async def scenario():
+        waiter = asyncio.ensure_future(limiter.acquire(0, 10))
+        await asyncio.sleep(0)
+        # A response arrives while the request is still sleeping
+        limiter.update(httpx.Headers({
+            "anthropic-ratelimit-requests-limit": "600",
+            "anthropic-ratelimit-requests-remaining": "0",
+        }))
+        assert limiter.buckets["requests"].tokens == -1
+        await waiter
+        assert limiter.reserved["requests"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,105 @@
+import json
+
+import httpx
+
+from conftest import EventStream
+from test_streaming import consume, sse
+
+PAYLOAD = {"model": "claude-sonnet-4-5", "max_tokens": 16, "messages": [{"role": "user", "content": "hi"}]}
+
+
+def replies(mock_api, *responses):
+    """Answer successive requests with ``responses``; returns the requests seen"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return responses[len(requests) - 1]
+
+    mock_api(handler)
+    return requests
+
+
+def send(pipe, budget=None):
+    return pipe._send_with_retry(f"{pipe.API_BASE_URL}/messages", {}, PAYLOAD, stream=False, budget=budget)
+
+
+def test_overloaded_and_rate_limited_requests_are_retried(fn, make_pipe, run_pipe, mock_api):
+    requests = replies(mock_api, httpx.Response(529), httpx.Response(429), httpx.Response(200, json={}))
+    budget = fn.RetryBudget()
+    response = run_pipe(make_pipe(RETRY_BASE_DELAY=0.001), lambda pipe: send(pipe, budget))
+    assert response.status_code == 200 and len(requests) == 3
+    assert budget.attempts == 2
+
+
+def test_retry_after_is_waited_out_unless_too_long(fn, make_pipe, run_pipe, mock_api):
+    requests = replies(mock_api, httpx.Response(429, headers={"retry-after": "0.05"}), httpx.Response(200, json={}))
+    budget = fn.RetryBudget()
+    assert run_pipe(make_pipe(), lambda pipe: send(pipe, budget)).status_code == 200
+    # The server's hint replaces the jittered backoff
+    assert (len(requests), budget.attempts, budget.waited) == (2, 1, 0.05)
+
+    requests = replies(mock_api, httpx.Response(529, headers={"retry-after-ms": "30000"}))
+    response = run_pipe(make_pipe(RETRY_MAX_DELAY=20.0), send)
+    assert response.status_code == 529 and len(requests) == 1
+
+    requests = replies(mock_api, httpx.Response(529, headers={"x-should-retry": "false"}))
+    assert run_pipe(make_pipe(), send).status_code == 529 and len(requests) == 1
+
+
+def test_retry_budget_is_shared_by_all_attempts_of_a_request(fn, make_pipe, run_pipe, mock_api):
+    requests = replies(mock_api, httpx.Response(529), httpx.Response(200, json={}),
+                       httpx.Response(529), httpx.Response(529))
+    budget = fn.RetryBudget()
+
+    async def scenario(pipe):
+        first = await send(pipe, budget)
+        return first, await send(pipe, budget)
+
+    first, second = run_pipe(make_pipe(RETRY_MAX_ATTEMPTS=2, RETRY_BASE_DELAY=0.001), scenario)
+    # The second call only has the one retry the first left over
+    assert (first.status_code, second.status_code, len(requests), budget.attempts) == (200, 529, 4, 2)
+
+    # The wait budget caps the total time spent waiting, too
+    requests = replies(mock_api, *[httpx.Response(429, headers={"retry-after": "0.3"})] * 3)
+    budget = fn.RetryBudget()
+    response = run_pipe(make_pipe(RETRY_BUDGET_SECONDS=0.5), lambda pipe: send(pipe, budget))
+    assert response.status_code == 429 and len(requests) == 2
+    assert budget.waited == 0.3
+
+
+def text_stream(text: str, error_after_start: bool = False):
+    yield sse({"type": "message_start", "message": {"usage": {"input_tokens": 10, "output_tokens": 1}}})
+    yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+    yield sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}})
+    if error_after_start:
+        yield sse({"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})
+        return
+    yield sse({"type": "content_block_stop", "index": 0})
+    yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 2}})
+    yield sse({"type": "message_stop"})
+
+
+def overloaded_stream():
+    yield sse({"type": "message_start", "message": {"usage": {"input_tokens": 10, "output_tokens": 1}}})
+    yield sse({"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})
+
+
+def event_stream(events):
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=EventStream(events))
+
+
+def test_stream_overloaded_before_output_is_retried(make_pipe, run_pipe, mock_api):
+    requests = replies(mock_api, event_stream(overloaded_stream()), event_stream(text_stream("hello")))
+    output = run_pipe(make_pipe(RETRY_BASE_DELAY=0.001, STREAM_COALESCE_MS=0), consume)
+    assert len(requests) == 2
+    assert json.loads(requests[1].content) == json.loads(requests[0].content)
+    assert output.startswith("hello") and "API Error" not in output
+
+
+def test_stream_overloaded_after_output_started_is_not_retried(make_pipe, run_pipe, mock_api):
+    requests = replies(mock_api, event_stream(text_stream("partial", error_after_start=True)),
+                       event_stream(text_stream("again")))
+    output = run_pipe(make_pipe(RETRY_BASE_DELAY=0.001, STREAM_COALESCE_MS=0), consume)
+    assert len(requests) == 1
+    assert output.startswith("partial") and "API Error (overloaded_error)" in output and "again" not in output
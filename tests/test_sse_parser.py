@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+STREAM = (
+    b"\xef\xbb\xbf"
+    b": keepalive comment\n"
+    b"event: message_start\ndata: {\"type\": \"message_start\"}\n\n"
+    b"id: 7\nretry: 2500\nevent: ping\ndata: {}\n\n"
+    b"data: first line\ndata: second line\n\n"
+    b"event:\ndata:no space\n\n"
+    b"event: ignored\n\n"
+    b"event: content_block_delta\nunknown: field\ndata: {\"text\": \"a\\nb\"}\n\n"
+)
+EXPECTED = [
+    (b"message_start", b"{\"type\": \"message_start\"}"),
+    (b"ping", b"{}"),
+    (b"message", b"first line\nsecond line"),
+    (b"message", b"no space"),
+    (b"content_block_delta", b"{\"text\": \"a\\nb\"}"),
+]
+# Long enough for the one-regex path over a run of plain events
+RUN_EVENTS = [(b"content_block_delta", json.dumps({"index": i, "text": "x" * 20}).encode()) for i in range(40)]
+RUN = b"".join(b"event: " + event + b"\ndata: " + data + b"\n\n" for event, data in RUN_EVENTS)
+
+
+def with_line_endings(stream: bytes, ending: bytes) -> bytes:
+    return stream.replace(b"\n", ending)
+
+
+def parse(fn, chunks):
+    parser = fn.SSEParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.close())
+    return events, parser
+
+
+@pytest.mark.parametrize("ending", [b"\n", b"\r", b"\r\n"], ids=["LF", "CR", "CRLF"])
+def test_every_split_point_parses_the_same_events(fn, ending):
+    stream = with_line_endings(STREAM, ending)
+    for split in range(len(stream) + 1):
+        events, parser = parse(fn, [stream[:split], stream[split:]])
+        assert events == EXPECTED, (ending, split)
+        assert (parser.last_event_id, parser.retry) == ("7", 2500)
+
+
+@pytest.mark.parametrize("ending", [b"\n", b"\r", b"\r\n"], ids=["LF", "CR", "CRLF"])
+def test_byte_at_a_time_parses_the_same_events(fn, ending):
+    stream = with_line_endings(STREAM, ending)
+    events, _ = parse(fn, [stream[i:i + 1] for i in range(len(stream))])
+    assert events == EXPECTED
+
+
+@pytest.mark.parametrize("ending", [b"\n", b"\r", b"\r\n"], ids=["LF", "CR", "CRLF"])
+def test_event_runs_parse_the_same_at_every_split_point(fn, ending):
+    stream = with_line_endings(RUN + STREAM[3:], ending)
+    expected = RUN_EVENTS + EXPECTED
+    for split in range(0, len(stream) + 1, 7):
+        assert parse(fn, [stream[:split], stream[split:]])[0] == expected, (ending, split)
+
+
+def test_trailing_cr_terminates_the_last_line(fn):
+    events, _ = parse(fn, [b"data: last\r\r"])
+    assert events == [(b"message", b"last")]
+
+    # Without its blank line the last event is incomplete and dropped
+    assert parse(fn, [b"data: done\n\ndata: partial\n"])[0] == [(b"message", b"done")]
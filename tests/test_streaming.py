@@ -0,0 +1,152 @@
+import json
+import logging
+import tracemalloc
+from typing import Any, Dict, Iterator
+
+import httpx
+
+from conftest import EventStream
+
+
+def sse(event: Dict[str, Any]) -> bytes:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+def thinking_stream(deltas: int, error: bool = False) -> Iterator[bytes]:
+    """A thinking block of `deltas` one-token deltas, then a short answer"""
+    yield sse({"type": "message_start", "message": {"usage": {"input_tokens": 10, "output_tokens": 1}}})
+    yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "thinking", "thinking": ""}})
+    for i in range(deltas):
+        yield sse({"type": "content_block_delta", "index": 0,
+                   "delta": {"type": "thinking_delta", "thinking": f" step{i}"}})
+    if error:
+        yield sse({"type": "error", "error": {"type": "api_error", "message": "boom"}})
+        return
+    yield sse({"type": "content_block_stop", "index": 0})
+    yield sse({"type": "content_block_start", "index": 1, "content_block": {"type": "text", "text": ""}})
+    yield sse({"type": "content_block_delta", "index": 1, "delta": {"type": "text_delta", "text": "done"}})
+    yield sse({"type": "content_block_stop", "index": 1})
+    yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": deltas}})
+    yield sse({"type": "message_stop"})
+
+
+async def consume(pipe, keep: bool = True) -> str:
+    body = {"messages": [{"role": "user", "content": "hi"}], "stream": True}
+    out = []
+    result = await pipe.pipe(body)
+    async for chunk in result:
+        if keep:
+            out.append(chunk)
+    return "".join(out)
+
+
+def peak_stream_memory(make_pipe, run_pipe, mock_api, deltas: int) -> int:
+    """Peak traced Python heap while streaming a response of `deltas` thinking events"""
+    mock_api(lambda request: httpx.Response(
+        200, headers={"content-type": "text/event-stream"}, stream=EventStream(thinking_stream(deltas))
+    ))
+    # Stall retries keep the visible answer as a prefill; thinking never is
+    pipe = make_pipe(STREAM_STALL_RETRIES=0)
+
+    async def scenario(pipe) -> int:
+        tracemalloc.start()
+        try:
+            await consume(pipe, keep=False)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return run_pipe(pipe, scenario)
+
+
+def test_stream_memory_does_not_grow_with_stream_length(make_pipe, run_pipe, mock_api):
+    # tracemalloc rather than RSS: the allocator rarely returns freed pages,
+    # so RSS would hide a retained event list behind earlier peaks
+    peak_stream_memory(make_pipe, run_pipe, mock_api, 500)  # warm imports and caches
+    short = peak_stream_memory(make_pipe, run_pipe, mock_api, 1_000)
+    long = peak_stream_memory(make_pipe, run_pipe, mock_api, 20_000)
+    # Retaining the events would cost several hundred bytes each (~10 MB here)
+    assert long - short < 200_000, (short, long)
+
+
+def test_event_buffer_is_logged_on_stream_error(fn, make_pipe, run_pipe, mock_api, caplog):
+    mock_api(lambda request: httpx.Response(
+        200, headers={"content-type": "text/event-stream"}, stream=EventStream(thinking_stream(20, error=True))
+    ))
+    pipe = make_pipe(DEBUG_EVENT_BUFFER_SIZE=5)
+
+    with caplog.at_level(logging.ERROR, logger=fn.logger.name):
+        output = run_pipe(pipe, consume)
+
+    assert "API Error (api_error)" in output
+    dumps = [r for r in caplog.records if r.getMessage().startswith("Last 5 stream events before error event")]
+    assert len(dumps) == 1
+    # Only the newest events survive in the ring buffer
+    assert '"step19"' not in dumps[0].getMessage() and '" step19"' in dumps[0].getMessage()
+    assert '" step14"' not in dumps[0].getMessage()
+
+
+def test_abort_estimate_uses_completed_stream_lengths(fn, make_pipe):
+    pipe = make_pipe()
+    payload = {"max_tokens": 8192}
+
+    def abort_after(tokens):
+        pipe._record_abort(fn.StreamingState(output_chars=tokens * 4), payload)
+
+    abort_after(100)  # no history: nothing claimed beyond the upper bound
+    assert (pipe.aborted_tokens_saved, pipe.aborted_tokens_saved_max) == (0, 8092)
+
+    pipe._output_lengths.extend([50, 400, 800])
+    abort_after(200)  # streams that got past 200 tokens ended at 600 on average
+    assert (pipe.aborted_tokens_saved, pipe.aborted_tokens_saved_max) == (400, 8092 + 7992)
+
+
+def stalling_stream(events, stall: bool) -> Iterator[bytes]:
+    for event in events:
+        yield sse(event)
+    if stall:
+        raise httpx.ReadTimeout("stalled")
+
+
+def text_leg(usage: Dict[str, Any], texts, stall: bool) -> Iterator[bytes]:
+    events = [
+        {"type": "message_start", "message": {"usage": usage}},
+        {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+    ]
+    events += [{"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}}
+               for text in texts]
+    if not stall:
+        events += [
+            {"type": "content_block_stop", "index": 0},
+            {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 3}},
+            {"type": "message_stop"},
+        ]
+    return stalling_stream(events, stall)
+
+
+def test_stall_continuation_joins_text_and_usage(fn, make_pipe, run_pipe, mock_api, caplog):
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        if len(requests) == 1:
+            leg = text_leg({"input_tokens": 10, "cache_read_input_tokens": 100, "output_tokens": 1},
+                           ["one two three", " four "], stall=True)
+        else:
+            leg = text_leg({"input_tokens": 20, "cache_read_input_tokens": 100, "output_tokens": 1},
+                           [" ", "five", " six"], stall=False)
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=EventStream(leg))
+
+    mock_api(handler)
+    pipe = make_pipe(STREAM_STALL_RETRIES=1, STREAM_COALESCE_MS=0)
+
+    with caplog.at_level(logging.INFO, logger=fn.logger.name):
+        output = run_pipe(pipe, consume)
+
+    assert requests[1]["messages"][-1] == {"role": "assistant", "content": "one two three four"}
+    assert "one two three four five six" in output
+    complete = [r for r in caplog.records if getattr(r, "event", None) == "stream_complete"]
+    # The stalled leg's output is estimated from the 19 characters it streamed
+    assert complete[-1].fields["usage"] == {
+        "input_tokens": 30, "cache_read_input_tokens": 200, "output_tokens": 4 + 3
+    }